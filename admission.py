@@ -0,0 +1,157 @@
+import os
+import time
+
+import db
+
+
+# Queue entries nobody has polled for this long have left the waiting room.
+ABANDON_AFTER = 60
+# A poll records that its ticket is still waiting once the last record is
+# this old, well inside ABANDON_AFTER.
+SEEN_REFRESH = ABANDON_AFTER / 2
+# Rows older than this are deleted now and then.
+KEEP_ROWS = 24 * 60 * 60
+PRUNE_EVERY = 500
+
+
+class AdmissionController:
+    # Gates new participant sessions; nothing else passes through it, so
+    # participants already in a session are never held up by a burst of new
+    # ones. A shared token bucket refilled at ``rate`` per second (up to
+    # ``burst``) limits how fast sessions start, and ``max_active`` caps the
+    # sessions admitted in the last ``session_timeout`` seconds that have not
+    # finished. Whoever cannot start yet gets a ticket in a FIFO queue kept
+    # in SQLite, so every worker admits in the same order. Either limit may
+    # be 0 to switch it off.
+
+    def __init__(self, path, rate=0.0, burst=1, max_active=0, session_timeout=3600):
+        self.path = path
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_active = max_active
+        self.session_timeout = session_timeout
+        self._enqueued = 0
+        conn = db.connect(self.path)
+        conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS admission_queue (
+                ticket INTEGER PRIMARY KEY AUTOINCREMENT,
+                created REAL NOT NULL,
+                seen REAL NOT NULL,
+                admitted_at REAL,
+                released INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS admission_waiting ON admission_queue (ticket, seen)
+                WHERE admitted_at IS NULL;
+            CREATE INDEX IF NOT EXISTS admission_active ON admission_queue (admitted_at)
+                WHERE admitted_at IS NOT NULL AND released = 0;
+            CREATE TABLE IF NOT EXISTS admission_bucket (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                tokens REAL NOT NULL,
+                updated REAL NOT NULL
+            );
+            """
+        )
+        conn.execute(
+            "INSERT OR IGNORE INTO admission_bucket (id, tokens, updated) VALUES (1, ?, ?)",
+            (self.burst, time.time()),
+        )
+
+    def _slots(self, conn, now):
+        # How many queued tickets may be admitted right now, and the bucket
+        # level to charge them against.
+        tokens = None
+        slots = float("inf")
+        if self.rate:
+            tokens, updated = conn.execute("SELECT tokens, updated FROM admission_bucket WHERE id = 1").fetchone()
+            tokens = min(self.burst, tokens + max(now - updated, 0) * self.rate)
+            slots = int(tokens)
+        if self.max_active:
+            (active,) = conn.execute(
+                "SELECT COUNT(*) FROM admission_queue WHERE admitted_at > ? AND released = 0",
+                (now - self.session_timeout,),
+            ).fetchone()
+            slots = min(slots, self.max_active - active)
+        return slots, tokens
+
+    def _position(self, conn, ticket, now):
+        (ahead,) = conn.execute(
+            "SELECT COUNT(*) FROM admission_queue WHERE admitted_at IS NULL AND ticket < ? AND seen > ?",
+            (ticket, now - ABANDON_AFTER),
+        ).fetchone()
+        return ahead + 1
+
+    def _try_admit(self, conn, ticket, now):
+        # Admits ``ticket`` if it is within the first ``slots`` live tickets;
+        # returns its queue position, 0 once admitted.
+        row = conn.execute("SELECT admitted_at FROM admission_queue WHERE ticket = ?", (ticket,)).fetchone()
+        if row is None:
+            return None
+        if row[0] is not None:
+            return 0
+        conn.execute("UPDATE admission_queue SET seen = ? WHERE ticket = ?", (now, ticket))
+        position = self._position(conn, ticket, now)
+        slots, tokens = self._slots(conn, now)
+        if position > slots:
+            if tokens is not None:
+                conn.execute("UPDATE admission_bucket SET tokens = ?, updated = ? WHERE id = 1", (tokens, now))
+            return position
+        if tokens is not None:
+            conn.execute("UPDATE admission_bucket SET tokens = ?, updated = ? WHERE id = 1", (tokens - 1, now))
+        conn.execute("UPDATE admission_queue SET admitted_at = ? WHERE ticket = ?", (now, ticket))
+        return 0
+
+    def enqueue(self):
+        # Returns (ticket, position); position 0 means admitted straight away.
+        now = time.time()
+        conn = db.connect(self.path)
+        with db.transaction(conn):
+            ticket = conn.execute(
+                "INSERT INTO admission_queue (created, seen) VALUES (?, ?)", (now, now)
+            ).lastrowid
+            position = self._try_admit(conn, ticket, now)
+        self._enqueued += 1
+        if self._enqueued % PRUNE_EVERY == 0:
+            self.prune()
+        return ticket, position
+
+    def poll(self, ticket):
+        # The waiting room's heartbeat. Returns the current position, 0 once
+        # admitted, or None for an unknown (pruned) ticket. Most polls only
+        # learn that their turn has not come: that is answered with plain
+        # reads, which never queue behind writers in WAL mode. The write
+        # transaction is taken only when the ticket may be admitted or its
+        # ``seen`` needs refreshing, and it checks everything again.
+        now = time.time()
+        conn = db.connect(self.path)
+        row = conn.execute("SELECT admitted_at, seen FROM admission_queue WHERE ticket = ?", (ticket,)).fetchone()
+        if row is None:
+            return None
+        if row[0] is not None:
+            return 0
+        position = self._position(conn, ticket, now)
+        if now - row[1] < SEEN_REFRESH and position > self._slots(conn, now)[0]:
+            return position
+        with db.transaction(conn):
+            return self._try_admit(conn, ticket, now)
+
+    def release(self, ticket):
+        # The session finished and no longer counts against max_active.
+        db.connect(self.path).execute("UPDATE admission_queue SET released = 1 WHERE ticket = ?", (ticket,))
+
+    def prune(self):
+        db.connect(self.path).execute("DELETE FROM admission_queue WHERE seen < ?", (time.time() - KEEP_ROWS,))
+
+
+def init_app(app):
+    rate = app.config["ADMISSION_RATE"]
+    max_active = app.config["ADMISSION_MAX_ACTIVE"]
+    if rate or max_active:
+        path = app.config.get("ADMISSION_DB") or os.path.join(app.config["STATE_DIR"], "admission.sqlite3")
+        app.extensions["admission"] = AdmissionController(
+            path,
+            rate=rate,
+            burst=app.config["ADMISSION_BURST"],
+            max_active=max_active,
+            session_timeout=app.config["ADMISSION_SESSION_TIMEOUT"],
+        )
@@ -0,0 +1,139 @@
+import logging
+import os
+
+import db
+import storage
+
+
+logger = logging.getLogger(__name__)
+
+DIMENSIONS = [
+    "Clarity",
+    "Sufficiency",
+    "PredictiveCapability",
+    "Actionability",
+    "Trustworthiness",
+    "Accountability",
+    "Satisfaction",
+]
+
+SCALE = range(1, 8)
+
+
+class AggregateStore:
+    # Running count, sum, sum of squares and 1-7 histogram for every
+    # ErrorType x ExplanationQuality x dimension cell, kept in SQLite so every
+    # worker updates and reads the same numbers. Each saved submission is
+    # recorded by ref and counted at most once.
+
+    def __init__(self, path):
+        self.path = path
+        conn = db.connect(self.path)
+        conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS aggregates (
+                error_type TEXT NOT NULL,
+                explanation_quality TEXT NOT NULL,
+                dimension TEXT NOT NULL,
+                n INTEGER NOT NULL,
+                total INTEGER NOT NULL,
+                total_sq INTEGER NOT NULL,
+                h1 INTEGER NOT NULL, h2 INTEGER NOT NULL, h3 INTEGER NOT NULL,
+                h4 INTEGER NOT NULL, h5 INTEGER NOT NULL, h6 INTEGER NOT NULL,
+                h7 INTEGER NOT NULL,
+                PRIMARY KEY (error_type, explanation_quality, dimension)
+            );
+            CREATE TABLE IF NOT EXISTS aggregate_sources (
+                ref TEXT PRIMARY KEY,
+                saved_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS aggregate_meta (
+                key TEXT PRIMARY KEY,
+                value REAL NOT NULL
+            );
+            """
+        )
+
+    def add(self, submissions):
+        conn = db.connect(self.path)
+        added = 0
+        with db.transaction(conn):
+            for ref, _, saved_at, rows, _ in submissions:
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO aggregate_sources (ref, saved_at) VALUES (?, ?)",
+                    (ref, saved_at),
+                )
+                if cursor.rowcount == 0:
+                    continue
+                self._apply(conn, rows)
+                added += 1
+        return added
+
+    @staticmethod
+    def _apply(conn, rows):
+        deltas = {}
+        for row in rows:
+            for dimension in DIMENSIONS:
+                value = int(row[dimension])
+                key = (row["ErrorType"], row["ExplanationQuality"], dimension)
+                delta = deltas.setdefault(key, [0, 0, 0] + [0] * len(SCALE))
+                delta[0] += 1
+                delta[1] += value
+                delta[2] += value * value
+                if value in SCALE:
+                    delta[2 + value] += 1
+
+        conn.executemany(
+            """
+            INSERT INTO aggregates VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (error_type, explanation_quality, dimension) DO UPDATE SET
+                n = n + excluded.n,
+                total = total + excluded.total,
+                total_sq = total_sq + excluded.total_sq,
+                h1 = h1 + excluded.h1, h2 = h2 + excluded.h2, h3 = h3 + excluded.h3,
+                h4 = h4 + excluded.h4, h5 = h5 + excluded.h5, h6 = h6 + excluded.h6,
+                h7 = h7 + excluded.h7
+            """,
+            [key + tuple(delta) for key, delta in deltas.items()],
+        )
+
+    def rebuild(self, store):
+        # Warm start: only submissions the store wrote after the last
+        # checkpoint are read back.
+        return storage.replay_since_checkpoint(self.path, "aggregate_meta", store, self.add)
+
+    def snapshot(self):
+        rows = db.connect(self.path).execute(
+            "SELECT * FROM aggregates ORDER BY error_type, explanation_quality, dimension"
+        ).fetchall()
+
+        cells = {}
+        for error_type, quality, dimension, n, total, total_sq, *histogram in rows:
+            mean = total / n if n else None
+            variance = (total_sq - total * total / n) / (n - 1) if n > 1 else None
+            cell = cells.setdefault(
+                (error_type, quality),
+                {"ErrorType": error_type, "ExplanationQuality": quality, "dimensions": {}},
+            )
+            cell["dimensions"][dimension] = {
+                "count": n,
+                "mean": mean,
+                "variance": variance,
+                "histogram": dict(zip((str(value) for value in SCALE), histogram)),
+            }
+        return {"cells": list(cells.values())}
+
+
+def init_app(app):
+    path = app.config.get("AGGREGATES_DB") or os.path.join(app.config["STATE_DIR"], "aggregates.sqlite3")
+    aggregate_store = AggregateStore(path)
+    app.extensions["aggregates"] = aggregate_store
+
+    def on_saved(sender, submissions):
+        try:
+            aggregate_store.add(submissions)
+        except Exception:
+            # The rows are already saved; the next rebuild picks them up.
+            logger.exception("Updating live aggregates failed")
+
+    storage.responses_saved.connect(on_saved, sender=app, weak=False)
@@ -0,0 +1,393 @@
+"""Summarise the saved responses from a memory-mapped columnar cache.
+
+Converts every participant_*.csv in the data directory into a compact
+cache of flat column files (int8 ratings, categorical codes for ErrorType
+and ExplanationQuality) and computes summaries on top of it with NumPy:
+cell means, Cronbach's alpha and 2x2 effect sizes.
+
+    python analysis.py build
+    python analysis.py summary
+    python analysis.py summary --json > summary.json
+
+Conversion is incremental: files already in the cache are skipped and new
+ones are parsed in parallel over a process pool, so a rerun after more
+participants arrive only reads the new files. A file that changed or
+disappeared since it was cached triggers a full rebuild. ``summary``
+brings the cache up to date first unless --no-build is given.
+
+The data directory defaults to HCAI_DATA_DIR (else ./data) and the cache
+to HCAI_STATE_DIR/analysis (else ./state/analysis). With RESPONSE_STORE=
+sqlite, write the files first with "flask export-responses --files DIR"
+and pass --data-dir DIR. Requires numpy, which the app itself does not:
+pip install -r requirements-analysis.txt.
+"""
+
+import argparse
+import concurrent.futures
+import csv
+import json
+import os
+import sys
+import tempfile
+
+try:
+    import numpy as np
+except ImportError:
+    raise SystemExit("analysis.py needs numpy: pip install -r requirements-analysis.txt")
+
+from storage import FIELDNAMES
+
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+RATINGS = FIELDNAMES[4:11]
+CATEGORIES = ("ErrorType", "ExplanationQuality")
+
+# One flat file per column; rows are appended, never rewritten.
+COLUMNS = {
+    "submission": (np.int32, ()),
+    "trial": (np.int16, ()),
+    "error_type": (np.uint8, ()),
+    "explanation_quality": (np.uint8, ()),
+    "control": (np.int8, ()),
+    "ratings": (np.int8, (len(RATINGS),)),
+}
+
+# Files handed to one worker at a time.
+CHUNK_SIZE = 256
+
+
+def _rating(value):
+    # 0 marks a missing or out-of-range answer.
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        return 0
+    return number if 1 <= number <= 7 else 0
+
+
+def convert_files(paths):
+    # Parses a chunk of participant files. Runs in a worker process, so it
+    # returns plain arrays; categorical columns come back as their distinct
+    # values plus per-row indexes into them, and the parent maps those onto
+    # the cache's codes.
+    counts = []
+    participants = []
+    trials = []
+    controls = []
+    ratings = []
+    labels = {name: [] for name in CATEGORIES}
+    for path in paths:
+        with open(path, newline="", encoding="utf-8") as csvfile:
+            reader = csv.reader(csvfile)
+            header = next(reader, None)
+            rows = list(reader)
+        if header is None:
+            rows = []
+        position = {name: idx for idx, name in enumerate(header or [])}
+        counts.append(len(rows))
+        participants.append(rows[0][position["ParticipantID"]] if rows else "")
+        for row in rows:
+            trials.append(int(row[position["TrialNum"]]))
+            control = row[position["ControlVar"]] if "ControlVar" in position else ""
+            controls.append(_rating(control) or -1)
+            ratings.append([_rating(row[position[name]]) for name in RATINGS])
+            for name in CATEGORIES:
+                labels[name].append(row[position[name]])
+
+    categorical = {}
+    for name in CATEGORIES:
+        values, inverse = np.unique(np.array(labels[name], dtype=str), return_inverse=True)
+        categorical[name] = (values.tolist(), inverse.astype(np.int64))
+    return {
+        "counts": counts,
+        "participants": participants,
+        "trial": np.array(trials, dtype=np.int16),
+        "control": np.array(controls, dtype=np.int8),
+        "ratings": np.array(ratings, dtype=np.int8).reshape(-1, len(RATINGS)),
+        "categorical": categorical,
+    }
+
+
+class ColumnCache:
+    # Column files plus meta.json, which records the row count, the category
+    # labels behind each code and every source file converted so far. Rows
+    # past the recorded count (a conversion that died half-way) are cut off
+    # before the next append, so meta.json is the commit point.
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.meta_path = os.path.join(directory, "meta.json")
+        self.meta = self._load_meta()
+
+    @staticmethod
+    def _empty_meta():
+        return {
+            "rows": 0,
+            "categories": {name: [] for name in CATEGORIES},
+            # name -> [mtime_ns, size, first_row, rows, participant_id]
+            "sources": {},
+        }
+
+    def _load_meta(self):
+        try:
+            with open(self.meta_path, encoding="utf-8") as meta_file:
+                return json.load(meta_file)
+        except (OSError, ValueError):
+            return self._empty_meta()
+
+    def _column_path(self, name):
+        return os.path.join(self.directory, f"{name}.bin")
+
+    def _write_meta(self):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as meta_file:
+            json.dump(self.meta, meta_file)
+        os.replace(tmp_path, self.meta_path)
+
+    def _reset(self):
+        self.meta = self._empty_meta()
+        for name in COLUMNS:
+            try:
+                os.remove(self._column_path(name))
+            except FileNotFoundError:
+                pass
+
+    def update(self, data_dir, workers=None):
+        # Returns the number of files converted.
+        os.makedirs(self.directory, exist_ok=True)
+        current = {}
+        if os.path.isdir(data_dir):
+            for entry in os.scandir(data_dir):
+                if entry.name.startswith("participant_") and entry.name.endswith(".csv"):
+                    stat = entry.stat()
+                    current[entry.name] = (entry.path, stat.st_mtime_ns, stat.st_size)
+
+        sources = self.meta["sources"]
+        stale = any(
+            name not in current or current[name][1:] != tuple(source[:2]) for name, source in sources.items()
+        )
+        if stale:
+            self._reset()
+            sources = self.meta["sources"]
+        new = sorted(name for name in current if name not in sources)
+        if not new:
+            if stale:
+                self._write_meta()
+            return 0
+
+        self._truncate()
+        chunks = [new[start:start + CHUNK_SIZE] for start in range(0, len(new), CHUNK_SIZE)]
+        paths = [[current[name][0] for name in chunk] for chunk in chunks]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            # map() keeps chunk order, so rows land in file-name order.
+            for chunk, result in zip(chunks, pool.map(convert_files, paths)):
+                self._append(chunk, current, result)
+        self._write_meta()
+        return len(new)
+
+    def _truncate(self):
+        for name, (dtype, shape) in COLUMNS.items():
+            path = self._column_path(name)
+            size = self.meta["rows"] * np.dtype(dtype).itemsize * int(np.prod(shape, dtype=np.int64))
+            with open(path, "ab") as column_file:
+                column_file.truncate(size)
+
+    def _code_table(self, name, values):
+        known = self.meta["categories"][name]
+        for value in values:
+            if value not in known:
+                known.append(value)
+        if len(known) > np.iinfo(np.uint8).max:
+            raise ValueError(f"Too many {name} categories for the cache")
+        return np.array([known.index(value) for value in values], dtype=np.uint8)
+
+    def _append(self, chunk, current, result):
+        first_submission = len(self.meta["sources"])
+        counts = np.array(result["counts"], dtype=np.int64)
+        columns = {
+            "submission": np.repeat(
+                np.arange(first_submission, first_submission + len(chunk), dtype=np.int32), counts
+            ),
+            "trial": result["trial"],
+            "control": result["control"],
+            "ratings": result["ratings"],
+        }
+        for name, column in zip(CATEGORIES, ("error_type", "explanation_quality")):
+            values, inverse = result["categorical"][name]
+            columns[column] = self._code_table(name, values)[inverse]
+
+        for name, values in columns.items():
+            with open(self._column_path(name), "ab") as column_file:
+                column_file.write(np.ascontiguousarray(values, dtype=COLUMNS[name][0]).tobytes())
+
+        row = self.meta["rows"]
+        for name, count, participant_id in zip(chunk, result["counts"], result["participants"]):
+            _, mtime_ns, size = current[name]
+            self.meta["sources"][name] = [mtime_ns, size, row, count, participant_id]
+            row += count
+        self.meta["rows"] = row
+
+    def columns(self):
+        # Read-only memory maps over the committed rows.
+        rows = self.meta["rows"]
+        mapped = {}
+        for name, (dtype, shape) in COLUMNS.items():
+            if rows == 0:
+                mapped[name] = np.zeros((0,) + shape, dtype=dtype)
+            else:
+                mapped[name] = np.memmap(self._column_path(name), dtype=dtype, mode="r", shape=(rows,) + shape)
+        return mapped
+
+
+def cronbach_alpha(ratings):
+    # ratings: (rows, items) of complete answers.
+    items = ratings.shape[1]
+    if ratings.shape[0] < 2 or items < 2:
+        return None
+    item_variance = ratings.var(axis=0, ddof=1).sum()
+    total_variance = ratings.sum(axis=1).var(ddof=1)
+    if total_variance == 0:
+        return None
+    return float(items / (items - 1) * (1 - item_variance / total_variance))
+
+
+def _cohens_d(a, b):
+    if len(a) < 2 or len(b) < 2:
+        return None
+    within = (len(a) - 1) * a.var(axis=0, ddof=1) + (len(b) - 1) * b.var(axis=0, ddof=1)
+    pooled = within / (len(a) + len(b) - 2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        d = (a.mean(axis=0) - b.mean(axis=0)) / np.sqrt(pooled)
+    return [None if not np.isfinite(value) else float(value) for value in d]
+
+
+def summarise(cache):
+    columns = cache.columns()
+    ratings = np.asarray(columns["ratings"])
+    complete = (ratings > 0).all(axis=1)
+    ratings = ratings[complete].astype(np.float64)
+    error_type = np.asarray(columns["error_type"])[complete]
+    quality = np.asarray(columns["explanation_quality"])[complete]
+    error_labels = cache.meta["categories"]["ErrorType"]
+    quality_labels = cache.meta["categories"]["ExplanationQuality"]
+
+    cells = []
+    # Cell index e * len(quality_labels) + q; bincount does the grouping.
+    cell = error_type.astype(np.int64) * max(len(quality_labels), 1) + quality
+    size = len(error_labels) * len(quality_labels)
+    counts = np.bincount(cell, minlength=size)
+    sums = np.stack(
+        [np.bincount(cell, weights=ratings[:, idx], minlength=size) for idx in range(len(RATINGS))], axis=1
+    )
+    squares = np.stack(
+        [np.bincount(cell, weights=ratings[:, idx] ** 2, minlength=size) for idx in range(len(RATINGS))], axis=1
+    )
+    for e, error_label in enumerate(error_labels):
+        for q, quality_label in enumerate(quality_labels):
+            idx = e * len(quality_labels) + q
+            n = int(counts[idx])
+            if not n:
+                continue
+            means = sums[idx] / n
+            if n > 1:
+                sd = np.sqrt(np.maximum(squares[idx] - n * means**2, 0) / (n - 1))
+            else:
+                sd = np.full(len(RATINGS), np.nan)
+            cells.append(
+                {
+                    "ErrorType": error_label,
+                    "ExplanationQuality": quality_label,
+                    "n": n,
+                    "mean": dict(zip(RATINGS, means.round(4).tolist())),
+                    "sd": {
+                        name: None if np.isnan(value) else round(float(value), 4) for name, value in zip(RATINGS, sd)
+                    },
+                    "alpha": cronbach_alpha(ratings[cell == idx]),
+                }
+            )
+
+    effects = None
+    if len(error_labels) == 2 and len(quality_labels) == 2:
+        effects = {}
+        factors = (("ErrorType", error_type, error_labels), ("ExplanationQuality", quality, quality_labels))
+        for factor, codes, labels in factors:
+            d = _cohens_d(ratings[codes == 0], ratings[codes == 1])
+            effects[factor] = {"contrast": f"{labels[0]} - {labels[1]}", "d": d and dict(zip(RATINGS, d))}
+        # Interaction as the difference of simple effects, in pooled
+        # within-cell SD units.
+        groups = [ratings[cell == idx] for idx in range(4)]
+        if all(len(group) > 1 for group in groups):
+            means = np.stack([group.mean(axis=0) for group in groups])
+            within = sum((len(group) - 1) * group.var(axis=0, ddof=1) for group in groups)
+            pooled = np.sqrt(within / (sum(len(group) for group in groups) - 4))
+            with np.errstate(divide="ignore", invalid="ignore"):
+                d = (means[0] - means[1] - means[2] + means[3]) / pooled
+            effects["Interaction"] = {
+                "contrast": "simple effect of ExplanationQuality under "
+                f"{error_labels[0]} minus under {error_labels[1]}",
+                "d": {name: None if not np.isfinite(value) else float(value) for name, value in zip(RATINGS, d)},
+            }
+
+    return {
+        "participants": len(cache.meta["sources"]),
+        "rows": int(len(complete)),
+        "complete_rows": int(complete.sum()),
+        "alpha": cronbach_alpha(ratings),
+        "cells": cells,
+        "effects": effects,
+    }
+
+
+def _format(value, width=8):
+    return f"{'-':>{width}}" if value is None else f"{value:>{width}.2f}"
+
+
+def print_summary(summary):
+    print(
+        f"{summary['participants']} participants, {summary['rows']} rows "
+        f"({summary['complete_rows']} with all ratings), Cronbach's alpha {_format(summary['alpha'], 0)}"
+    )
+    header = "".join(f"{name[:8]:>9}" for name in RATINGS)
+    print(f"\n{'cell':<12} {'n':>6} {header} {'alpha':>7}")
+    for cell in summary["cells"]:
+        label = f"{cell['ErrorType']}/{cell['ExplanationQuality']}"
+        means = "".join(" " + _format(cell["mean"][name]) for name in RATINGS)
+        print(f"{label:<12} {cell['n']:>6} {means} {_format(cell['alpha'], 7)}")
+    if summary["effects"]:
+        print(f"\n{'effect (d)':<20} {header}")
+        for factor, effect in summary["effects"].items():
+            d = effect["d"] or {}
+            print(f"{factor:<20} " + "".join(" " + _format(d.get(name)) for name in RATINGS))
+            print(f"  {effect['contrast']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["build", "summary"])
+    parser.add_argument("--data-dir", default=os.environ.get("HCAI_DATA_DIR") or os.path.join(BASE_DIR, "data"))
+    parser.add_argument(
+        "--cache-dir",
+        default=os.path.join(os.environ.get("HCAI_STATE_DIR") or os.path.join(BASE_DIR, "state"), "analysis"),
+    )
+    parser.add_argument("--workers", type=int, default=None, help="conversion processes (default: CPU count)")
+    parser.add_argument("--no-build", action="store_true", help="summarise the cache as it is")
+    parser.add_argument("--json", action="store_true", help="print the summary as JSON")
+    args = parser.parse_args(argv)
+
+    cache = ColumnCache(args.cache_dir)
+    if args.command == "build" or not args.no_build:
+        converted = cache.update(args.data_dir, workers=args.workers)
+        print(f"Converted {converted} new file(s); {cache.meta['rows']} rows cached.", file=sys.stderr)
+    if args.command == "summary":
+        summary = summarise(cache)
+        if args.json:
+            json.dump(summary, sys.stdout, indent=2)
+            print()
+        else:
+            print_summary(summary)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,346 +1,251 @@
-import csv
-import datetime
+import functools
 import os
-import random
+import secrets
+import sys
+import time
 
+import click
 from flask import (
     Flask,
+    current_app,
     render_template,
     request,
     redirect,
     url_for,
     session,
     flash,
+    abort,
+    jsonify,
+    Response,
 )
+from flask.cli import with_appcontext
+from jinja2 import FileSystemBytecodeCache
+
+import admission
+import aggregates
+import assets
+import catalog
+import comments
+import export
+import metrics
+import monitor
+import page_cache
+import participants
+from ratings import RATING_FIELDS, validate_ratings
+import response_log
+import scheduler
+import screening
+import session_store
+import storage
+import synthetic
+import timing
+import writer
 
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(BASE_DIR, "data")
+STATE_DIR = os.path.join(BASE_DIR, "state")
 
-app = Flask(__name__)
-app.secret_key = "hcaiexperimentsecret"
-
+DEFAULT_CONFIG = dict(
+    # None generates a key once per STATE_DIR (see load_secret_key); set it
+    # explicitly when workers on several hosts must share sessions.
+    SECRET_KEY=None,
+    DATA_DIR=DATA_DIR,
+    STATE_DIR=STATE_DIR,
+    # "cookie" keeps Flask's signed-cookie session; "sqlite" keeps session data
+    # on the server and only puts an opaque ID in the cookie.
+    SESSION_BACKEND="cookie",
+    SESSION_DB=None,
+    SESSION_TTL=24 * 60 * 60,
+    SESSION_CACHE_SIZE=1024,
+    RESPONSE_LOG_DIR=None,
+    # An append waits up to this long for appends already under way in other
+    # threads to share its fsync; one with no company fsyncs at once.
+    RESPONSE_LOG_COMMIT_INTERVAL=0.005,
+    # "csv" writes one file per participant into DATA_DIR; "sqlite" writes
+    # every participant into a single database (RESPONSE_DB).
+    RESPONSE_STORE="csv",
+    RESPONSE_DB=None,
+    # Persist finished sessions on a background thread instead of inside the
+    # debrief request.
+    ASYNC_WRITES=False,
+    WRITE_QUEUE_SIZE=1000,
+    WRITE_BATCH_SIZE=50,
+    WRITE_QUEUE_TIMEOUT=0.05,
+    # Bearer token for the /researcher/ routes; they answer 404 while unset.
+    RESEARCHER_TOKEN=None,
+    AGGREGATES_DB=None,
+    # Full-text index of debrief comments behind /researcher/comments.
+    COMMENTS_DB=None,
+    # Each saved session is screened for straight-lining (this share of
+    # trials with one answer on every dimension), runs of this many identical
+    # answers and fewer seconds per trial than this; flags go to SCREENING_DB.
+    SCREENING_DB=None,
+    SCREEN_STRAIGHTLINE_FRACTION=0.75,
+    SCREEN_RUN_LENGTH=21,
+    SCREEN_MIN_SECONDS_PER_TRIAL=4.0,
+    # "random" draws each session's trials independently; "balanced" hands
+    # out rows of a counterbalanced assignment table in sequence.
+    # "adaptive" picks the items that most reduce the uncertainty of the
+    # cell means, from rating statistics re-read in the background every
+    # SCHEDULER_REFRESH_INTERVAL seconds, within SCHEDULER_TIME_BUDGET
+    # seconds per session.
+    TRIAL_SCHEDULER="random",
+    SCHEDULER_DB=None,
+    SCHEDULER_BLOCK_SIZE=8,
+    SCHEDULER_REFRESH_INTERVAL=5.0,
+    SCHEDULER_TIME_BUDGET=0.0015,
+    # Stimuli are read from this versioned JSON catalog (default
+    # stimuli.json next to this file) and reloaded when it changes.
+    STIMULI_PATH=None,
+    CATALOG_CHECK_INTERVAL=2.0,
+    # Rendered trial and practice pages kept per worker; 0 disables.
+    PAGE_CACHE_SIZE=256,
+    # Fingerprinted, precompressed copies of static/ served from /assets/.
+    # Turn the startup build off when "flask build-assets" runs at deploy.
+    ASSETS_DIR=None,
+    ASSETS_BUILD_ON_STARTUP=True,
+    # Per-worker metric snapshots are merged from METRICS_DIR on scrape.
+    METRICS_DIR=None,
+    METRICS_FLUSH_INTERVAL=1.0,
+    # Fraction of requests to profile with cProfile into STATE_DIR/profiles.
+    # A request can also ask for it by sending the researcher token in an
+    # X-Profile header.
+    PROFILE_SAMPLE_RATE=0.0,
+    # "html" runs study trials as one page per trial; "api" serves a single
+    # page that fetches trials in blocks of API_BLOCK_SIZE from /api/trials
+    # and posts each block's ratings to /api/responses in one request.
+    CLIENT_MODE="html",
+    API_BLOCK_SIZE=8,
+    # Every participant ID's status (in progress or completed), used to turn
+    # away repeat participants and to resume unfinished sessions.
+    PARTICIPANT_DB=None,
+    # Admission control for new sessions: at most ADMISSION_RATE starts per
+    # second (bursts of up to ADMISSION_BURST) and ADMISSION_MAX_ACTIVE
+    # sessions in progress at once; 0 switches a limit off. Participants
+    # over the limit wait in /waiting, which polls every
+    # ADMISSION_POLL_INTERVAL seconds. Sessions already running are never
+    # held back.
+    ADMISSION_RATE=0.0,
+    ADMISSION_BURST=10,
+    ADMISSION_MAX_ACTIVE=0,
+    ADMISSION_SESSION_TIMEOUT=60 * 60,
+    ADMISSION_POLL_INTERVAL=5,
+    ADMISSION_DB=None,
+    # Compiled templates are cached on disk (default STATE_DIR/jinja) so a
+    # fresh worker skips compiling them; TEMPLATE_WARMUP compiles every
+    # template at startup instead of on its first request.
+    TEMPLATE_BYTECODE_CACHE=True,
+    TEMPLATE_CACHE_DIR=None,
+    TEMPLATE_WARMUP=False,
+    # Trial and practice pages report when each trial was shown, first rated
+    # and submitted, batched to /beacon. Every worker buffers them into its
+    # own file in TIMING_DIR, flushed every TIMING_FLUSH_INTERVAL seconds;
+    # "flask join-timings" folds them into TIMING_DB for the export.
+    CLIENT_TIMING=True,
+    TIMING_DIR=None,
+    TIMING_FLUSH_INTERVAL=1.0,
+    TIMING_DB=None,
+    # Session events (started, trial submitted, completed) from every worker
+    # go to one append-only file (default STATE_DIR/events.jsonl, rotated
+    # past MONITOR_MAX_BYTES) and the last MONITOR_BUFFER_SIZE of them are
+    # streamed to /researcher/monitor. Each stream ends after
+    # MONITOR_STREAM_SECONDS and the browser reconnects where it left off,
+    # so a viewer never pins a worker thread for long.
+    MONITOR_EVENTS_PATH=None,
+    MONITOR_BUFFER_SIZE=1000,
+    MONITOR_MAX_BYTES=16 * 1024 * 1024,
+    MONITOR_STREAM_SECONDS=300,
+    # Under asgi.py: threads per process that run the Flask views (and with
+    # them all file and database I/O); connections themselves are held on
+    # the event loop.
+    ASGI_THREADS=32,
+)
 
 TOTAL_TRIALS_PER_SESSION = 16
-TOTAL_POOL_SIZE = 32
-
-
-PRACTICE_TRIALS = [
-    {
-        "stimulus_id": "PRAC_FP",
-        "description": "A patient shows mild cough and runny nose, but the chest X-ray image appears normal.",
-        "ai_decision": "The AI predicts that the patient has pneumonia (positive).",
-        "ground_truth": "The patient does not have pneumonia (false positive).",
-        "error_type": "FP",
-        "explanation": "The system noticed higher brightness in the image center and therefore predicted pneumonia.",
-    },
-    {
-        "stimulus_id": "PRAC_FN",
-        "description": "A patient has a temperature of 38.8°C along with shortness of breath and chest tightness.",
-        "ai_decision": "The AI predicts that the patient does not have pneumonia (negative).",
-        "ground_truth": "The patient does have pneumonia (false negative).",
-        "error_type": "FN",
-        "explanation": "The model did not detect abnormal patterns, so it kept the negative prediction.",
-    },
-]
-
-
-TRIALS = [
-    # FP + Poor explanation
-    {
-        "stimulus_id": "FP_Poor_1",
-        "description": "An online homework submission shows two minor similarities to a classmate, but the system logs match normal behavior.",
-        "ai_decision": "The AI flags the student for plagiarism (positive).",
-        "ground_truth": "The student did not plagiarize (false positive).",
-        "error_type": "FP",
-        "explanation_quality": "Poor",
-        "explanation": "The system thought the answers looked too similar, so it labeled the submission as plagiarism.",
-    },
-    {
-        "stimulus_id": "FP_Poor_2",
-        "description": "A customer makes a nighttime credit card purchase of $120, which fits their typical spending pattern.",
-        "ai_decision": "The AI flags the purchase as fraud (positive).",
-        "ground_truth": "The transaction is legitimate (false positive).",
-        "error_type": "FP",
-        "explanation_quality": "Poor",
-        "explanation": "The model saw the amount appear suddenly and assumed it must be fraud.",
-    },
-    {
-        "stimulus_id": "FP_Poor_3",
-        "description": "Factory sensors occasionally show a temperature spike, yet the average readings remain normal.",
-        "ai_decision": "The AI predicts the equipment is about to fail (positive).",
-        "ground_truth": "The equipment is operating normally (false positive).",
-        "error_type": "FP",
-        "explanation_quality": "Poor",
-        "explanation": "Because the data looked jumpy, the system concluded the machine would soon break.",
-    },
-    {
-        "stimulus_id": "FP_Poor_4",
-        "description": "A patient’s blood glucose is measured at 6.0 mmol/L, which is within the healthy range.",
-        "ai_decision": "The AI flags the blood glucose as abnormal (positive).",
-        "ground_truth": "The level is normal (false positive).",
-        "error_type": "FP",
-        "explanation_quality": "Poor",
-        "explanation": "The model saw the number was not 5, so it labeled it as abnormal.",
-    },
-    {
-        "stimulus_id": "FP_Poor_5",
-        "description": "Airport security scans a traveler’s bag containing a 90 ml bottle, and valid documentation is provided.",
-        "ai_decision": "The AI flags the liquid as prohibited (positive).",
-        "ground_truth": "The item fully complies with regulations (false positive).",
-        "error_type": "FP",
-        "explanation_quality": "Poor",
-        "explanation": "The system thought the liquid looked dangerous and therefore denied it.",
-    },
-    {
-        "stimulus_id": "FP_Poor_6",
-        "description": "A smart agriculture monitor notices a slightly lighter color on one plot of leaves.",
-        "ai_decision": "The AI predicts a crop disease outbreak (positive).",
-        "ground_truth": "The leaves are healthy (false positive).",
-        "error_type": "FP",
-        "explanation_quality": "Poor",
-        "explanation": "Because the color seemed off, the model assumed there was a disease.",
-    },
-    {
-        "stimulus_id": "FP_Poor_7",
-        "description": "A call-center sentiment tool detects minor pitch fluctuations in a customer’s voice.",
-        "ai_decision": "The AI labels the caller as extremely angry (positive).",
-        "ground_truth": "The caller’s tone is calm (false positive).",
-        "error_type": "FP",
-        "explanation_quality": "Poor",
-        "explanation": "The system heard some variation and decided the caller must be upset.",
-    },
-    {
-        "stimulus_id": "FP_Poor_8",
-        "description": "A smart logistics scale finds a package weighing 30 grams more than the label indicates.",
-        "ai_decision": "The AI flags the package as hazardous (positive).",
-        "ground_truth": "The weight difference is normal variance (false positive).",
-        "error_type": "FP",
-        "explanation_quality": "Poor",
-        "explanation": "The model saw a slight excess weight and triggered an alarm.",
-    },
-    # FP + Good explanation
-    {
-        "stimulus_id": "FP_Good_1",
-        "description": "A warehouse security camera captures nighttime movement and a brief spike in heat signatures.",
-        "ai_decision": "The AI reports an intruder (positive).",
-        "ground_truth": "It was a security guard on patrol (false positive).",
-        "error_type": "FP",
-        "explanation_quality": "Good",
-        "explanation": "The system matched the unusual motion pattern and heat peak with past intrusion incidents, leading to an alert.",
-    },
-    {
-        "stimulus_id": "FP_Good_2",
-        "description": "A university network logs 30 login attempts from the same IP over 30 minutes.",
-        "ai_decision": "The AI flags a brute-force attack (positive).",
-        "ground_truth": "A student simply forgot their password (false positive).",
-        "error_type": "FP",
-        "explanation_quality": "Good",
-        "explanation": "The model compared the failure frequency and timing to known attack patterns, so it raised an alarm.",
-    },
-    {
-        "stimulus_id": "FP_Good_3",
-        "description": "An autonomous car detects flickering reflections ahead while radar readings stay steady.",
-        "ai_decision": "The AI reports an obstacle (positive).",
-        "ground_truth": "The reflection came from a wet road surface (false positive).",
-        "error_type": "FP",
-        "explanation_quality": "Good",
-        "explanation": "Visual sensors found bright points matching obstacle signatures, so the system issued a hazard warning despite radar stability.",
-    },
-    {
-        "stimulus_id": "FP_Good_4",
-        "description": "A banking risk model observes three large international transfers in quick succession.",
-        "ai_decision": "The AI flags the account as compromised (positive).",
-        "ground_truth": "The customer is paying overseas tuition (false positive).",
-        "error_type": "FP",
-        "explanation_quality": "Good",
-        "explanation": "Short-term spikes in amount, geography, and frequency resembled past fraud cases, so it triggered a security warning.",
-    },
-    {
-        "stimulus_id": "FP_Good_5",
-        "description": "A public health dashboard registers three consecutive days of elevated temperatures in one neighborhood.",
-        "ai_decision": "The AI declares a flu outbreak (positive).",
-        "ground_truth": "The community is healthy (false positive).",
-        "error_type": "FP",
-        "explanation_quality": "Good",
-        "explanation": "The model compared rolling averages with historical baselines and found a sustained increase that exceeded its alert threshold.",
-    },
-    {
-        "stimulus_id": "FP_Good_6",
-        "description": "An academic integrity tool finds a 42% similarity between a student paper and database sources.",
-        "ai_decision": "The AI flags the paper for plagiarism (positive).",
-        "ground_truth": "The citations follow proper style (false positive).",
-        "error_type": "FP",
-        "explanation_quality": "Good",
-        "explanation": "Extended sections matched existing text and the reference count was below the model’s benchmark, so it labeled the submission as a violation.",
-    },
-    {
-        "stimulus_id": "FP_Good_7",
-        "description": "A warehouse robot registers that a pallet is tilted 6 degrees, slightly above the safety limit.",
-        "ai_decision": "The AI predicts the pallet will collapse (positive).",
-        "ground_truth": "The pallet remains stable (false positive).",
-        "error_type": "FP",
-        "explanation_quality": "Good",
-        "explanation": "The gyroscope exceeded 5 degrees for over 20 seconds, matching previous collapse data, so the system sent a warning.",
-    },
-    {
-        "stimulus_id": "FP_Good_8",
-        "description": "An anti-money-laundering system spots multiple transfers to the same offshore account within seven days.",
-        "ai_decision": "The AI flags the activity as potential laundering (positive).",
-        "ground_truth": "The customer is making legitimate investments (false positive).",
-        "error_type": "FP",
-        "explanation_quality": "Good",
-        "explanation": "Transaction frequency, amounts, and destination all aligned with high-risk patterns in the training data, so it labeled the account as high risk.",
-    },
-    # FN + Poor explanation
-    {
-        "stimulus_id": "FN_Poor_1",
-        "description": "A patient runs a fever of 39°C with a rapid pulse and a productive cough.",
-        "ai_decision": "The AI predicts the patient does not have pneumonia (negative).",
-        "ground_truth": "The patient has pneumonia (false negative).",
-        "error_type": "FN",
-        "explanation_quality": "Poor",
-        "explanation": "The system did not see anything special, so it assumed the patient was fine.",
-    },
-    {
-        "stimulus_id": "FN_Poor_2",
-        "description": "Factory vibration sensors stay 15% above the safety line and show sudden spikes.",
-        "ai_decision": "The AI predicts the machine is normal (negative).",
-        "ground_truth": "The bearing is failing (false negative).",
-        "error_type": "FN",
-        "explanation_quality": "Poor",
-        "explanation": "The model thought the vibration wasn’t too high, so it kept the normal label.",
-    },
-    {
-        "stimulus_id": "FN_Poor_3",
-        "description": "An email security system spots an executable attachment from an unfamiliar sender.",
-        "ai_decision": "The AI labels the email as safe (negative).",
-        "ground_truth": "The email contains malware (false negative).",
-        "error_type": "FN",
-        "explanation_quality": "Poor",
-        "explanation": "The system skipped deeper analysis and concluded the message was harmless.",
-    },
-    {
-        "stimulus_id": "FN_Poor_4",
-        "description": "A bank account records purchases in three cities within half an hour.",
-        "ai_decision": "The AI marks the account as normal (negative).",
-        "ground_truth": "The account was compromised (false negative).",
-        "error_type": "FN",
-        "explanation_quality": "Poor",
-        "explanation": "The model didn’t detect a strong pattern, so it allowed the activity.",
-    },
-    {
-        "stimulus_id": "FN_Poor_5",
-        "description": "A roadway monitoring system receives several driver reports about severe flooding on the same street.",
-        "ai_decision": "The AI reports normal road conditions (negative).",
-        "ground_truth": "The street is impassable (false negative).",
-        "error_type": "FN",
-        "explanation_quality": "Poor",
-        "explanation": "Because it didn’t see major data changes, the system kept the road marked as clear.",
-    },
-    {
-        "stimulus_id": "FN_Poor_6",
-        "description": "A corporate security platform logs two failed logins from unusual regions.",
-        "ai_decision": "The AI says the account is safe (negative).",
-        "ground_truth": "The account was taken over (false negative).",
-        "error_type": "FN",
-        "explanation_quality": "Poor",
-        "explanation": "The model felt the number of attempts was too low to matter, so it ignored them.",
-    },
-    {
-        "stimulus_id": "FN_Poor_7",
-        "description": "A smart farming system records an overnight temperature drop of 8°C and a sharp humidity increase.",
-        "ai_decision": "The AI says the crops will not be harmed (negative).",
-        "ground_truth": "The crops suffer frost damage (false negative).",
-        "error_type": "FN",
-        "explanation_quality": "Poor",
-        "explanation": "The system thought the change was not extreme enough and took no action.",
-    },
-    {
-        "stimulus_id": "FN_Poor_8",
-        "description": "An automated support bot sees three consecutive messages complaining about billing errors.",
-        "ai_decision": "The AI classifies the interaction as a non-complaint (negative).",
-        "ground_truth": "The customer is filing a formal complaint (false negative).",
-        "error_type": "FN",
-        "explanation_quality": "Poor",
-        "explanation": "Because nothing was specifically flagged, the system treated it as a routine inquiry.",
-    },
-    # FN + Good explanation
-    {
-        "stimulus_id": "FN_Good_1",
-        "description": "A patient in the emergency department has an SpO₂ level of 90%, and the CT scan shows faint shadows under heavy noise.",
-        "ai_decision": "The AI predicts no pneumonia (negative).",
-        "ground_truth": "The patient has pneumonia (false negative).",
-        "error_type": "FN",
-        "explanation_quality": "Good",
-        "explanation": "The shadow area was below the internal threshold and the scan had low signal-to-noise ratio, so the model kept a negative result.",
-    },
-    {
-        "stimulus_id": "FN_Good_2",
-        "description": "A customer service bot receives a short message about a billing issue with mild emotional wording.",
-        "ai_decision": "The AI classifies it as a non-complaint (negative).",
-        "ground_truth": "The customer is formally complaining (false negative).",
-        "error_type": "FN",
-        "explanation_quality": "Good",
-        "explanation": "Phrase length and sentiment scores stayed below the complaint threshold, so it was labeled routine.",
-    },
-    {
-        "stimulus_id": "FN_Good_3",
-        "description": "A manufacturing line experiences a 5°C rise and mild noise increases, still near the historical boundary.",
-        "ai_decision": "The AI predicts normal operation (negative).",
-        "ground_truth": "Internal components are loosening (false negative).",
-        "error_type": "FN",
-        "explanation_quality": "Good",
-        "explanation": "Temperature and noise shifts did not cross multiple thresholds simultaneously, so the system kept the normal status.",
-    },
-    {
-        "stimulus_id": "FN_Good_4",
-        "description": "A cybersecurity monitor detects abnormal traffic spread across many ports with low peaks.",
-        "ai_decision": "The AI reports no attack (negative).",
-        "ground_truth": "A low-frequency scanning attack is underway (false negative).",
-        "error_type": "FN",
-        "explanation_quality": "Good",
-        "explanation": "Because no single port showed a large spike, the pattern was treated as background noise and ignored.",
-    },
-    {
-        "stimulus_id": "FN_Good_5",
-        "description": "A clinical decision tool analyzes a patient with chest pain, mild shortness of breath, and a noisy ECG.",
-        "ai_decision": "The AI predicts no heart attack (negative).",
-        "ground_truth": "The patient is experiencing a myocardial infarction (false negative).",
-        "error_type": "FN",
-        "explanation_quality": "Good",
-        "explanation": "The ST-segment elevation was below the alert threshold and the signal quality was poor, so the risk score remained low.",
-    },
-    {
-        "stimulus_id": "FN_Good_6",
-        "description": "An environmental monitor records factory emissions slightly above the daily mean.",
-        "ai_decision": "The AI deems the emissions compliant (negative).",
-        "ground_truth": "Emissions exceed legal limits (false negative).",
-        "error_type": "FN",
-        "explanation_quality": "Good",
-        "explanation": "The readings stayed within the historical fluctuation band, so the system did not label them as violations.",
-    },
-    {
-        "stimulus_id": "FN_Good_7",
-        "description": "A recommendation engine ignores user safety concerns that appear across several contexts.",
-        "ai_decision": "The AI states the item is safe to use (negative).",
-        "ground_truth": "The item has a safety risk (false negative).",
-        "error_type": "FN",
-        "explanation_quality": "Good",
-        "explanation": "Positive feedback carried greater weight than isolated warnings, so the risk signals were not reflected in the score.",
-    },
-    {
-        "stimulus_id": "FN_Good_8",
-        "description": "A smart grid observes city electricity demand rise by 12% for 30 minutes.",
-        "ai_decision": "The AI labels supply as stable (negative).",
-        "ground_truth": "Transmission lines are nearing overload (false negative).",
-        "error_type": "FN",
-        "explanation_quality": "Good",
-        "explanation": "Based on historical patterns, similar short spikes usually drop within 45 minutes and remained within predicted upper bounds, so no alert fired.",
-    },
-]
+
+# The complete page re-checks a background save every 2 seconds, this many
+# times at most.
+COMPLETE_REFRESH_LIMIT = 15
+
+
+def get_response_log():
+    return current_app.extensions["response_log"]
+
+
+def get_metrics():
+    return current_app.extensions["metrics"]
+
+
+def get_participants():
+    return current_app.extensions["participants"]
+
+
+def publish_event(event_type, participant_id, **fields):
+    current_app.extensions["event_feed"].publish(event_type, participant_id, **fields)
+
+
+def get_catalog(version=None):
+    return current_app.extensions["catalog"].get(version)
+
+
+def researcher_status(config, req):
+    # 404 while no researcher token is configured, 401 for a wrong one, else
+    # None. Takes any werkzeug request, so the ASGI front end can check it
+    # without a Flask request context.
+    token = config["RESEARCHER_TOKEN"]
+    if not token:
+        return 404
+    supplied = req.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+    supplied = supplied or req.args.get("token", "")
+    if not secrets.compare_digest(supplied.encode(), token.encode()):
+        return 401
+    return None
+
+
+def researcher_required(view):
+    @functools.wraps(view)
+    def wrapped(*args, **kwargs):
+        status = researcher_status(current_app.config, request)
+        if status is not None:
+            abort(status)
+        return view(*args, **kwargs)
+
+    return wrapped
+
+
+def study_endpoint():
+    return "study" if current_app.config["CLIENT_MODE"] == "api" else "experiment"
+
+
+# Resume codes avoid characters that are easy to misread (0/O, 1/I/L).
+RESUME_CODE_ALPHABET = "ABCDEFGHJKMNPQRSTUVWXYZ23456789"
+RESUME_CODE_LENGTH = 6
 
 
+def new_resume_code():
+    return "".join(secrets.choice(RESUME_CODE_ALPHABET) for _ in range(RESUME_CODE_LENGTH))
+
+
+def resume_code_matches(state, supplied):
+    # Sessions logged before resume codes existed cannot be resumed.
+    expected = state.get("resume_code")
+    supplied = supplied.strip().upper()
+    return bool(expected and supplied) and secrets.compare_digest(supplied.encode(), expected.encode())
+
+
+def restore_session(state):
+    # Puts an unfinished session read back from its response log into the
+    # cookie, past the practice trials.
+    session.clear()
+    session["participant"] = state["participant"]
+    session["catalog_version"] = state["catalog_version"]
+    session["trial_order"] = state["order"]
+    session["current_trial"] = len(state["responses"])
+    session["practice_index"] = len(get_catalog(state["catalog_version"]).practice)
+    session["log_id"] = state["log_id"]
+    timing.issue_cookie(state["participant"]["id"])
+
 
 def ensure_session():
     if "participant" not in session:
@@ -349,7 +254,6 @@ def ensure_session():
     return True
 
 
-@app.route("/", methods=["GET", "POST"])
 def intro():
     if request.method == "POST":
         consent = request.form.get("consent")
@@ -364,79 +268,158 @@ def intro():
             flash("Please enter your participant ID or alias.")
             return render_template("intro.html")
 
-        session.clear()
-        session["participant"] = {
-            "id": participant_id,
-            "control_var": control_var,
-        }
-        selected_indices = random.sample(range(len(TRIALS)), TOTAL_TRIALS_PER_SESSION)
-        random.shuffle(selected_indices)
-        session["trial_order"] = selected_indices
-        session["current_trial"] = 0
-        session["responses"] = []
-        session["practice_index"] = 0
+        index = get_participants()
+        known = index.lookup(participant_id)
+        if known is not None:
+            status, log_id = known
+            state = get_response_log().read(log_id) if log_id else None
+            if status == participants.IN_PROGRESS and state is not None and not state["completed"]:
+                # Somebody else may have picked the same ID; only the
+                # resume code proves the session is this person's.
+                flash(
+                    "This participant ID is already in use by a session that has not finished. If it is yours, "
+                    "continue it on the Resume page with your resume code; otherwise choose a different ID."
+                )
+                return render_template("intro.html")
+            if status == participants.COMPLETED or state is not None:
+                if status != participants.COMPLETED:
+                    index.complete(participant_id)
+                flash("This participant ID has already completed the study. Thank you for taking part!")
+                return render_template("intro.html")
+
+        ticket = None
+        gate = current_app.extensions.get("admission")
+        if gate is not None:
+            # Submitting again from the waiting room keeps the same place.
+            queued = session.get("waiting")
+            position = gate.poll(queued["ticket"]) if queued else None
+            if position is None:
+                ticket, position = gate.enqueue()
+                get_metrics().inc("hcai_admissions_total", outcome="queued" if position else "admitted")
+            else:
+                ticket = queued["ticket"]
+            if position:
+                session["waiting"] = {"ticket": ticket, "participant_id": participant_id, "control_var": control_var}
+                return redirect(url_for("waiting"))
 
+        if not start_session(participant_id, control_var, replace=known is not None, ticket=ticket):
+            return render_template("intro.html")
         return redirect(url_for("practice"))
 
     return render_template("intro.html")
 
 
-@app.route("/practice", methods=["GET", "POST"])
+def start_session(participant_id, control_var, replace=False, ticket=None):
+    participant = {
+        "id": participant_id,
+        "control_var": control_var,
+    }
+    stimuli = get_catalog()
+    trial_order, allocators = current_app.extensions["scheduler"].next_assignment(stimuli)
+    resume_code = new_resume_code()
+    with get_metrics().timed("hcai_io_seconds", operation="log_append"):
+        log_id = get_response_log().start(participant, trial_order, stimuli.version, allocators, resume_code)
+    # An in-progress entry whose log has gone is taken over; otherwise
+    # losing the race to another request with the same ID turns this away.
+    if not get_participants().start(participant_id, log_id, replace=replace):
+        get_response_log().remove(log_id)
+        if ticket is not None:
+            current_app.extensions["admission"].release(ticket)
+        flash("This participant ID is already in use. Please use Resume to continue that session.")
+        return False
+
+    session.clear()
+    session["participant"] = participant
+    session["catalog_version"] = stimuli.version
+    session["trial_order"] = trial_order
+    session["current_trial"] = 0
+    session["practice_index"] = 0
+    session["log_id"] = log_id
+    timing.issue_cookie(participant_id)
+    if ticket is not None:
+        session["admission_ticket"] = ticket
+    get_metrics().inc("hcai_sessions_started_total")
+    publish_event("started", participant_id, total=len(trial_order))
+    flash(
+        f"Your resume code is {resume_code}. Please note it down: with your participant ID it lets you continue "
+        "if your session is interrupted."
+    )
+    return True
+
+
+def waiting():
+    queued = session.get("waiting")
+    gate = current_app.extensions.get("admission")
+    if not queued or gate is None:
+        return redirect(url_for("intro"))
+
+    position = gate.poll(queued["ticket"])
+    if position is None:
+        session.pop("waiting")
+        flash("Your place in the queue has expired. Please start again.")
+        return redirect(url_for("intro"))
+    if position:
+        return render_template(
+            "waiting.html", position=position, poll_interval=current_app.config["ADMISSION_POLL_INTERVAL"]
+        )
+
+    session.pop("waiting")
+    participant_id = queued["participant_id"]
+    replace = get_participants().lookup(participant_id) is not None
+    if not start_session(participant_id, queued["control_var"], replace=replace, ticket=queued["ticket"]):
+        return redirect(url_for("intro"))
+    return redirect(url_for("practice"))
+
+
+def waiting_status():
+    # Polled by the waiting room: no template and no session write, just
+    # one short transaction. Once ``ready``, the page reloads /waiting,
+    # which starts the session (or explains why it cannot).
+    queued = session.get("waiting")
+    gate = current_app.extensions.get("admission")
+    position = gate.poll(queued["ticket"]) if queued and gate is not None else None
+    return jsonify({"position": position or 0, "ready": not position})
+
+
 def practice():
     if not ensure_session():
         return redirect(url_for("intro"))
 
     practice_index = session.get("practice_index", 0)
+    practice_trials = get_catalog(session.get("catalog_version")).practice
 
-    if practice_index >= len(PRACTICE_TRIALS):
-        return redirect(url_for("experiment"))
+    if practice_index >= len(practice_trials):
+        return redirect(url_for(study_endpoint()))
 
-    trial = PRACTICE_TRIALS[practice_index]
+    trial = practice_trials[practice_index]
 
     if request.method == "POST":
-        clarity = request.form.get("clarity")
-        sufficiency = request.form.get("sufficiency")
-        predictive = request.form.get("predictive_capability")
-        actionability = request.form.get("actionability")
-        trustworthiness = request.form.get("trustworthiness")
-        accountability = request.form.get("accountability")
-        satisfaction = request.form.get("satisfaction")
-
-        if not all(
-            [
-                clarity,
-                sufficiency,
-                predictive,
-                actionability,
-                trustworthiness,
-                accountability,
-                satisfaction,
-            ]
-        ):
+        ratings, _ = validate_ratings(request.form)
+        if ratings is None:
             flash("Please complete all ratings in the practice trials to continue.")
             return render_template(
                 "practice.html",
                 trial=trial,
                 step=practice_index + 1,
-                total=len(PRACTICE_TRIALS),
+                total=len(practice_trials),
             )
 
         session["practice_index"] = practice_index + 1
 
-        if session["practice_index"] >= len(PRACTICE_TRIALS):
-            return redirect(url_for("experiment"))
+        if session["practice_index"] >= len(practice_trials):
+            return redirect(url_for(study_endpoint()))
 
         return redirect(url_for("practice"))
 
-    return render_template(
+    return page_cache.render_cached(
         "practice.html",
+        (session.get("catalog_version"), trial["stimulus_id"], practice_index + 1, len(practice_trials)),
         trial=trial,
         step=practice_index + 1,
-        total=len(PRACTICE_TRIALS),
+        total=len(practice_trials),
     )
 
 
-@app.route("/experiment", methods=["GET", "POST"])
 def experiment():
     if not ensure_session():
         return redirect(url_for("intro"))
@@ -447,29 +430,12 @@ def experiment():
     if current_trial >= len(order):
         return redirect(url_for("debrief"))
 
-    trial_idx = order[current_trial]
-    trial = TRIALS[trial_idx]
+    stimulus_id = order[current_trial]
+    trial = get_catalog(session.get("catalog_version")).by_id[stimulus_id]
 
     if request.method == "POST":
-        clarity = request.form.get("clarity")
-        sufficiency = request.form.get("sufficiency")
-        predictive = request.form.get("predictive_capability")
-        actionability = request.form.get("actionability")
-        trustworthiness = request.form.get("trustworthiness")
-        accountability = request.form.get("accountability")
-        satisfaction = request.form.get("satisfaction")
-
-        if not all(
-            [
-                clarity,
-                sufficiency,
-                predictive,
-                actionability,
-                trustworthiness,
-                accountability,
-                satisfaction,
-            ]
-        ):
+        ratings, _ = validate_ratings(request.form)
+        if ratings is None:
             flash("Please rate all items before moving on.")
             return render_template(
                 "trial.html",
@@ -478,20 +444,13 @@ def experiment():
                 total=len(order),
             )
 
-        responses = session.get("responses", [])
-        responses.append(
-            {
-                "trial_idx": trial_idx,
-                "clarity": int(clarity),
-                "sufficiency": int(sufficiency),
-                "predictive_capability": int(predictive),
-                "actionability": int(actionability),
-                "trustworthiness": int(trustworthiness),
-                "accountability": int(accountability),
-                "satisfaction": int(satisfaction),
-            }
-        )
-        session["responses"] = responses
+        with get_metrics().timed("hcai_io_seconds", operation="log_append"):
+            get_response_log().append(
+                session["log_id"],
+                dict(ratings, k="trial", n=current_trial + 1, stimulus_id=stimulus_id),
+            )
+        get_metrics().inc("hcai_trials_submitted_total", trial=current_trial + 1)
+        publish_event("trial", session["participant"]["id"], n=current_trial + 1)
         session["current_trial"] = current_trial + 1
 
         if session["current_trial"] >= len(order):
@@ -499,78 +458,241 @@ def experiment():
 
         return redirect(url_for("experiment"))
 
-    return render_template(
+    return page_cache.render_cached(
         "trial.html",
+        (session.get("catalog_version"), stimulus_id, current_trial + 1, len(order)),
         trial=trial,
         trial_number=current_trial + 1,
         total=len(order),
     )
 
 
-@app.route("/debrief", methods=["GET", "POST"])
+def study():
+    if not ensure_session():
+        return redirect(url_for("intro"))
+    if session.get("current_trial", 0) >= len(session.get("trial_order", [])):
+        return redirect(url_for("debrief"))
+    return render_template("study.html", rating_fields=RATING_FIELDS)
+
+
+def api_error(message, status=400, details=None):
+    return jsonify({"error": message, "details": details or []}), status
+
+
+def api_trials():
+    if "participant" not in session:
+        return api_error("No active session.", 401)
+
+    order = session.get("trial_order", [])
+    current_trial = session.get("current_trial", 0)
+    count = request.args.get("count", current_app.config["API_BLOCK_SIZE"], type=int)
+    stimuli = get_catalog(session.get("catalog_version"))
+
+    trials = []
+    for number in range(current_trial + 1, min(len(order), current_trial + max(count, 1)) + 1):
+        stimulus = stimuli.by_id[order[number - 1]]
+        trials.append(
+            {
+                "number": number,
+                "stimulus_id": stimulus["stimulus_id"],
+                "description": stimulus["description"],
+                "ai_decision": stimulus["ai_decision"],
+                "explanation": stimulus["explanation"],
+                "ground_truth": stimulus["ground_truth"],
+            }
+        )
+
+    return jsonify(
+        {
+            "current_trial": current_trial,
+            "total": len(order),
+            "trials": trials,
+            "debrief_url": url_for("debrief"),
+        }
+    )
+
+
+def api_responses():
+    if "participant" not in session:
+        return api_error("No active session.", 401)
+
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict) or not isinstance(payload.get("responses"), list):
+        return api_error('Expected a JSON object with a "responses" list.')
+
+    order = session.get("trial_order", [])
+    current_trial = session.get("current_trial", 0)
+    records = []
+    details = []
+
+    for item in payload["responses"]:
+        if not isinstance(item, dict) or not isinstance(item.get("ratings"), dict):
+            details.append("Each response needs a number, a stimulus_id and a ratings object.")
+            continue
+        number = item.get("number")
+        if not isinstance(number, int) or number < 1 or number > len(order):
+            details.append(f"Trial number {number!r} is out of range.")
+            continue
+        if number <= current_trial:
+            # Already stored; a retried request is not an error.
+            continue
+        if number != current_trial + len(records) + 1:
+            details.append(f"Trial {number} was sent before trial {current_trial + len(records) + 1}.")
+            continue
+        if item.get("stimulus_id") != order[number - 1]:
+            details.append(f"Trial {number} does not show stimulus {item.get('stimulus_id')!r}.")
+            continue
+        ratings, errors = validate_ratings(item["ratings"])
+        if ratings is None:
+            details.extend(f"Trial {number}: {error}" for error in errors)
+            continue
+        records.append(dict(ratings, k="trial", n=number, stimulus_id=order[number - 1]))
+
+    if details:
+        return api_error("Some responses were rejected; nothing was saved.", details=details)
+
+    if records:
+        with get_metrics().timed("hcai_io_seconds", operation="log_append"):
+            get_response_log().append_many(session["log_id"], records)
+        for record in records:
+            get_metrics().inc("hcai_trials_submitted_total", trial=record["n"])
+        current_trial = records[-1]["n"]
+        session["current_trial"] = current_trial
+        publish_event("trial", session["participant"]["id"], n=current_trial)
+
+    return jsonify(
+        {
+            "current_trial": current_trial,
+            "total": len(order),
+            "done": current_trial >= len(order),
+            "debrief_url": url_for("debrief"),
+        }
+    )
+
+
 def debrief():
     if not ensure_session():
         return redirect(url_for("intro"))
 
     if request.method == "POST":
         comment = request.form.get("comment", "").strip()
-        session["debrief_comment"] = comment
+        with get_metrics().timed("hcai_io_seconds", operation="log_append"):
+            get_response_log().append(session["log_id"], {"k": "end", "comment": comment})
+        get_participants().complete(session["participant"]["id"])
+        ticket = session.get("admission_ticket")
+        if ticket is not None and "admission" in current_app.extensions:
+            current_app.extensions["admission"].release(ticket)
         save_responses()
+        get_metrics().inc("hcai_sessions_completed_total")
+        publish_event("completed", session["participant"]["id"])
         data_file = session.get("data_file")
         comment_file = session.get("comment_file")
+        persist_token = session.get("persist_token")
         session.clear()
         session["data_file"] = data_file
         session["comment_file"] = comment_file
+        if persist_token:
+            session["persist_token"] = persist_token
         return redirect(url_for("complete"))
 
     return render_template("debrief.html")
 
 
-@app.route("/complete")
 def complete():
     data_file = session.get("data_file")
     comment_file = session.get("comment_file")
-    return render_template("complete.html", data_file=data_file, comment_file=comment_file)
+    # With ASYNC_WRITES the log is deleted once the writer has saved it, in
+    # whichever worker that happened.
+    persist_token = session.get("persist_token")
+    log = get_response_log()
+    saved = persist_token is None or not log.exists(persist_token)
+    # If the save failed (or is taking far too long) the responses are still
+    # safe in the log, and "flask compact-logs" recovers them; the page
+    # stops refreshing and says so.
+    attempt = request.args.get("attempt", 0, type=int)
+    recovering = not saved and (log.failed(persist_token) or attempt >= COMPLETE_REFRESH_LIMIT)
+    return render_template(
+        "complete.html",
+        data_file=data_file,
+        comment_file=comment_file,
+        saved=saved,
+        recovering=recovering,
+        next_attempt=attempt + 1,
+    )
+
+
+def resume():
+    if request.method == "POST":
+        participant_id = request.form.get("participant_id", "").strip()
+        known = get_participants().lookup(participant_id) if participant_id else None
+        state = None
+        if known is not None and known[0] == participants.IN_PROGRESS and known[1]:
+            state = get_response_log().read(known[1])
+
+        # One message for every failure, so the page does not reveal which
+        # IDs are in use.
+        if state is None or state["completed"] or not resume_code_matches(state, request.form.get("resume_code", "")):
+            flash("We could not find an unfinished session for that participant ID and resume code.")
+            return render_template("resume.html")
+
+        restore_session(state)
+        return redirect(url_for(study_endpoint()))
+
+    return render_template("resume.html")
 
 
 def save_responses():
-    participant = session.get("participant")
-    responses = session.get("responses", [])
-    order = session.get("trial_order", [])
-    comment = session.get("debrief_comment", "")
+    log_id = session.get("log_id")
+    if not log_id:
+        return
+
+    if current_app.config["ASYNC_WRITES"] and current_app.extensions["background_writer"].submit(log_id):
+        session["persist_token"] = log_id
+        return
 
-    if not participant or not responses or not order:
+    saved = compact_log(log_id)
+    if saved is None:
         return
 
-    os.makedirs(DATA_DIR, exist_ok=True)
-
-    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    participant_id = participant["id"]
-    filename = f"participant_{participant_id}_{timestamp}.csv"
-    file_path = os.path.join(DATA_DIR, filename)
-
-    fieldnames = [
-        "ParticipantID",
-        "TrialNum",
-        "ErrorType",
-        "ExplanationQuality",
-        "Clarity",
-        "Sufficiency",
-        "PredictiveCapability",
-        "Actionability",
-        "Trustworthiness",
-        "Accountability",
-        "Satisfaction",
-        "ControlVar",
-    ]
-
-    with open(file_path, "w", newline="", encoding="utf-8") as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
+    session["data_file"], comment_path = saved
+    if comment_path:
+        session["comment_file"] = comment_path
+
+
+def compact_log(log_id, recover=False):
+    return compact_logs([log_id], recover=recover)[0]
 
+
+def compact_logs(log_ids, recover=False):
+    # Claims each completed log, saves all of them to the response store in
+    # one batch and only then deletes the logs. With ``recover`` a log that
+    # was claimed by a process that died before finishing is picked up too.
+    log = get_response_log()
+    submissions = []
+    claimed = []
+    observed = []
+    timings = []
+
+    for log_id in log_ids:
+        state = log.read(log_id)
+        if state is None or not state["completed"]:
+            continue
+        if not log.claim(log_id) and not recover:
+            continue
+
+        participant = state["participant"]
+        responses = state["responses"]
+        if not participant or not responses or not state["order"]:
+            log.remove(log_id)
+            continue
+
+        participant_id = participant["id"]
+        stimuli = get_catalog(state["catalog_version"])
+        allocators = state["allocators"]
+        rows = []
         for idx, response in enumerate(responses, start=1):
-            trial_info = TRIALS[response["trial_idx"]]
-            writer.writerow(
+            trial_info = stimuli.by_id[response["stimulus_id"]]
+            rows.append(
                 {
                     "ParticipantID": participant_id,
                     "TrialNum": idx,
@@ -584,18 +706,486 @@ def save_responses():
                     "Accountability": response["accountability"],
                     "Satisfaction": response["satisfaction"],
                     "ControlVar": participant.get("control_var", ""),
+                    "Allocator": allocators[response["n"] - 1] if response["n"] <= len(allocators) else "",
                 }
             )
+        submissions.append((participant_id, rows, state["comment"], state["completed_at"]))
+        claimed.append(log_id)
+        observed.extend(responses)
+        timings.append(screening.seconds_per_trial(state))
 
-    session["data_file"] = file_path
+    def remove_logs():
+        # Right after the store has the rows, before anything that may fail.
+        for log_id in claimed:
+            log.remove(log_id)
 
-    if comment:
-        comment_filename = filename.replace(".csv", "_comment.txt")
-        comment_path = os.path.join(DATA_DIR, comment_filename)
-        with open(comment_path, "w", encoding="utf-8") as comment_file:
-            comment_file.write(comment)
-        session["comment_file"] = comment_path
+    refs = store_submissions(submissions, observed, timings, on_saved=remove_logs)
+    saved = dict(zip(claimed, refs))
+    return [saved.get(log_id) for log_id in log_ids]
+
+
+def store_submissions(submissions, observed, timings, on_saved=None):
+    # What happens to finished sessions once their rows are built, shared by
+    # compact_logs() and the synthetic data generator: one batch into the
+    # response store, then the participant index, the scheduler's statistics,
+    # screening and the responses_saved receivers. ``observed`` is the saved
+    # trial records, ``timings`` the seconds per trial of each submission.
+    with get_metrics().timed("hcai_io_seconds", operation="store_save"):
+        refs = current_app.extensions["response_store"].save_many(submissions)
+    if on_saved is not None:
+        on_saved()
+    # Debrief normally marks these already; this covers recovered logs and
+    # generated data.
+    get_participants().complete_many(participant_id for participant_id, _, _, _ in submissions)
+    if observed:
+        current_app.extensions["scheduler"].observe(observed)
+    current_app.extensions["screening"].observe(
+        [
+            (ref[0], participant_id, saved_at, rows, seconds)
+            for ref, (participant_id, rows, _, saved_at), seconds in zip(refs, submissions, timings)
+        ]
+    )
+    if submissions:
+        storage.responses_saved.send(
+            current_app._get_current_object(),
+            submissions=[
+                (ref[0], participant_id, saved_at, rows, comment)
+                for ref, (participant_id, rows, comment, saved_at) in zip(refs, submissions)
+            ],
+        )
+    return refs
+
+
+@researcher_required
+def researcher_aggregates():
+    aggregate_store = current_app.extensions["aggregates"]
+    if not current_app.extensions.get("aggregates_warmed"):
+        # Picks up anything saved while this app was not running.
+        aggregate_store.rebuild(current_app.extensions["response_store"])
+        current_app.extensions["aggregates_warmed"] = True
+    return jsonify(aggregate_store.snapshot())
+
+
+@researcher_required
+def researcher_comments():
+    query = request.args.get("q", "").strip()
+    if not query:
+        abort(400)
+    try:
+        since = export.parse_since(request.args.get("since"))
+        until = export.parse_since(request.args.get("until"))
+    except ValueError:
+        abort(400)
+    limit = min(max(request.args.get("limit", 50, type=int), 1), 500)
+    offset = max(request.args.get("offset", 0, type=int), 0)
+
+    index = current_app.extensions["comments"]
+    if not current_app.extensions.get("comments_warmed"):
+        index.rebuild(current_app.extensions["response_store"])
+        current_app.extensions["comments_warmed"] = True
+    started = time.perf_counter()
+    results = index.search(
+        query,
+        participant_id=request.args.get("participant") or None,
+        since=since,
+        until=until,
+        sort="recent" if request.args.get("sort") == "recent" else "rank",
+        limit=limit,
+        offset=offset,
+    )
+    return jsonify(
+        {
+            "query": query,
+            "results": results,
+            "took_ms": (time.perf_counter() - started) * 1000,
+        }
+    )
+
+
+@researcher_required
+def researcher_exclusions():
+    flags = request.args.getlist("flag") or list(screening.FLAGS)
+    if any(flag not in screening.FLAGS for flag in flags):
+        abort(400)
+    quality = current_app.extensions["screening"]
+    excluded = quality.exclusions(flags)
+    if request.args.get("format") == "csv":
+        body = "".join(f"{participant_id}\n" for participant_id in excluded)
+        return Response(body, mimetype="text/plain")
+    return jsonify({"summary": quality.summary(), "flags": flags, "participants": excluded})
+
+
+@researcher_required
+def metrics_endpoint():
+    return Response(get_metrics().render(), mimetype="text/plain; version=0.0.4")
+
+
+@researcher_required
+def researcher_schedule():
+    return jsonify(current_app.extensions["scheduler"].report())
+
+
+@researcher_required
+def researcher_monitor():
+    events_url = url_for("researcher_monitor_events", token=request.args.get("token") or None)
+    return render_template("monitor.html", title="Live monitor", events_url=events_url)
+
+
+@researcher_required
+def researcher_monitor_events():
+    # Server-sent events: the buffered backlog first (or, on reconnect,
+    # whatever came after Last-Event-ID), then each new event as the feed's
+    # tailer thread reads it. A comment line keeps idle connections open.
+    feed = current_app.extensions["event_feed"]
+    last_id = request.headers.get("Last-Event-ID") or None
+    deadline = time.monotonic() + current_app.config["MONITOR_STREAM_SECONDS"]
+
+    def stream(last_id):
+        yield monitor.SSE_PREAMBLE
+        while time.monotonic() < deadline:
+            events = feed.wait(last_id, timeout=min(15.0, max(deadline - time.monotonic(), 0)))
+            if not events:
+                yield monitor.SSE_KEEPALIVE
+                continue
+            yield monitor.format_events(events)
+            last_id = events[-1][0]
+
+    response = Response(stream(last_id), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-store"
+    # Keeps nginx from buffering the stream.
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+@researcher_required
+def researcher_export():
+    export_format = request.args.get("format", "csv")
+    comments = request.args.get("comments", "") in ("1", "true", "yes")
+    timings = None
+    if request.args.get("timings", "") in ("1", "true", "yes"):
+        timings = current_app.extensions["timing"]
+        timing_log = current_app.extensions["timing_log"]
+        timing_log.flush()
+        timings.join(timing_log.directory)
+    try:
+        since = export.parse_since(request.args.get("since"))
+    except ValueError:
+        abort(400)
+
+    store = current_app.extensions["response_store"]
+    # Everything the store had written when the export began, in the
+    # store's own insertion order rather than by completion time, so a
+    # session saved late still turns up in the next pull.
+    until = store.cursor()
+    stamp = time.strftime("%Y%m%d_%H%M%S")
+
+    if export_format == "csv":
+        body = export.iter_response_csv(store, since, until, comments, timings)
+        mimetype = "text/csv"
+    elif export_format == "zip":
+        body = export.iter_zip(store, since, until, comments, timings)
+        mimetype = "application/zip"
+    else:
+        abort(400)
+
+    response = Response(body, mimetype=mimetype)
+    response.headers["Content-Disposition"] = f"attachment; filename=responses_{stamp}.{export_format}"
+    # Pass this back as ``since`` on the next pull to fetch only newer data.
+    response.headers["X-Export-Cursor"] = repr(until)
+    return response
+
+
+@click.command("compact-logs")
+@with_appcontext
+def compact_logs_command():
+    """Save completed response logs to the response store."""
+    log = get_response_log()
+    log_ids = list(log.log_ids()) + list(log.log_ids(claimed=True))
+    compacted = sum(saved is not None for saved in compact_logs(log_ids, recover=True))
+    click.echo(f"Compacted {compacted} response log(s).")
+
+
+@click.command("rebuild-aggregates")
+@with_appcontext
+def rebuild_aggregates_command():
+    """Fold submissions saved since the last checkpoint into the live aggregates."""
+    added = current_app.extensions["aggregates"].rebuild(current_app.extensions["response_store"])
+    click.echo(f"Added {added} submission(s) to the aggregates.")
+
+
+@click.command("rebuild-comment-index")
+@with_appcontext
+def rebuild_comment_index_command():
+    """Index debrief comments saved since the last checkpoint."""
+    added = current_app.extensions["comments"].rebuild(current_app.extensions["response_store"])
+    click.echo(f"Indexed {added} comment(s).")
+
+
+@click.command("screen-responses")
+@click.option("--rescreen", is_flag=True, help="Re-derive all flags with the current thresholds.")
+@with_appcontext
+def screen_responses_command(rescreen):
+    """Screen saved submissions that have not been screened yet."""
+    quality = current_app.extensions["screening"]
+    added = quality.rebuild(current_app.extensions["response_store"])
+    click.echo(f"Screened {added} new submission(s).", err=True)
+    if rescreen:
+        click.echo(f"Re-screened {quality.rescreen()} submission(s).", err=True)
+    for flag, count in quality.summary()["flagged"].items():
+        click.echo(f"{flag}: {count} participant(s)", err=True)
+
+
+@click.command("exclusions")
+@click.option("--flag", "flags", multiple=True, type=click.Choice(screening.FLAGS), help="Only these flags.")
+@with_appcontext
+def exclusions_command(flags):
+    """Print the IDs of participants with screening flags, one per line."""
+    for participant_id in current_app.extensions["screening"].exclusions(flags or screening.FLAGS):
+        click.echo(participant_id)
+
+
+@click.command("join-timings")
+@with_appcontext
+def join_timings_command():
+    """Fold client timings flushed by the workers into the timing store."""
+    joined = current_app.extensions["timing"].join(current_app.extensions["timing_log"].directory)
+    click.echo(f"Joined {joined} trial timing(s).")
+
+
+@click.command("rebuild-participant-index")
+@with_appcontext
+def rebuild_participant_index_command():
+    """Backfill the participant index from saved responses and open logs."""
+    completed, opened = get_participants().rebuild(current_app.extensions["response_store"], get_response_log())
+    click.echo(f"Indexed {completed} completed and {opened} in-progress participant(s).")
+
+
+@click.command("build-assets")
+@with_appcontext
+def build_assets_command():
+    """Write fingerprinted and precompressed copies of static/."""
+    out_dir = current_app.extensions["assets"].out_dir
+    manifest = assets.build_assets(current_app.static_folder, out_dir)
+    for name, hashed in sorted(manifest.items()):
+        click.echo(f"{name} -> {hashed}")
+    if assets.brotli is None:
+        click.echo("brotli is not installed; only gzip variants were written.", err=True)
+
+
+@click.command("export-responses")
+@with_appcontext
+@click.option("--files", "directory", help="Write one participant_*.csv per participant into this directory.")
+def export_responses_command(directory):
+    """Export the SQLite store as one CSV on stdout, or as per-participant files."""
+    store = current_app.extensions["response_store"]
+    if not isinstance(store, storage.SqliteResponseStore):
+        raise click.UsageError("export-responses needs RESPONSE_STORE=sqlite; CSV files are already in DATA_DIR.")
+    if directory:
+        exported = store.export_files(directory)
+        click.echo(f"Exported {exported} participant file(s) to {directory}.", err=True)
+    else:
+        store.export_csv(sys.stdout)
+
+
+def _parse_effect(ctx, param, values):
+    try:
+        return dict(synthetic.parse_effect(value) for value in values) or None
+    except ValueError as exc:
+        raise click.BadParameter(str(exc))
+
+
+@click.command("generate-responses")
+@click.option("--participants", type=click.IntRange(min=1), required=True, help="Participants to simulate.")
+@click.option("--seed", type=int, default=0, show_default=True)
+@click.option(
+    "--effect",
+    "effects",
+    multiple=True,
+    callback=_parse_effect,
+    metavar="ERRORTYPE/QUALITY=SHIFT",
+    help="Mean rating shift for one cell, in scale points; replaces the default effects when given.",
+)
+@click.option("--dropout", type=click.FloatRange(0, 1), default=0.1, show_default=True)
+@click.option("--straightliners", type=click.FloatRange(0, 1), default=0.05, show_default=True)
+@click.option("--comments", type=click.FloatRange(0, 1), default=0.3, show_default=True, help="Share who comment.")
+@click.option("--chunk-size", type=click.IntRange(min=1), default=500, show_default=True)
+@click.option("--workers", type=click.IntRange(min=1), default=None, help="Generator processes (default: CPU count).")
+@click.option("--yes", is_flag=True, help="Do not ask before writing.")
+@with_appcontext
+def generate_responses_command(participants, seed, effects, dropout, straightliners, comments, chunk_size, workers,
+                               yes):
+    """Write a reproducible synthetic dataset through the normal save path.
+
+    Rows are generated in parallel and saved batch by batch exactly as
+    completed sessions are, so the participant index, aggregates, comment
+    index and screening all see them. The same seed and chunk size always
+    give the same data. Participant IDs start with "synthetic-" and the
+    Allocator column says "synthetic"; point DATA_DIR and STATE_DIR at a
+    scratch location rather than a live study.
+    """
+    # Cells are checked here rather than in the option callback, which runs
+    # before there is an app (and so a catalog) to check them against.
+    cells = {f"{error_type}/{quality}" for error_type, quality in get_catalog().by_cell}
+    unknown = sorted(set(effects or ()) - cells)
+    if unknown:
+        raise click.BadParameter(
+            f"unknown cell {', '.join(unknown)}; the catalog has {', '.join(sorted(cells))}", param_hint="'--effect'"
+        )
+    if not yes:
+        click.confirm(
+            f"Write {participants} synthetic participant(s) into {current_app.config['DATA_DIR']}?", abort=True
+        )
+    started = time.perf_counter()
+    saved = dropped = rows = 0
+    chunks = synthetic.generate(
+        get_catalog(),
+        participants,
+        TOTAL_TRIALS_PER_SESSION,
+        seed=seed,
+        effects=effects,
+        dropout=dropout,
+        straightliners=straightliners,
+        comments=comments,
+        chunk_size=chunk_size,
+        workers=workers,
+    )
+    for results, chunk_dropped in chunks:
+        store_submissions(
+            [submission for submission, _, _ in results],
+            [record for _, records, _ in results for record in records],
+            [seconds for _, _, seconds in results],
+        )
+        saved += len(results)
+        dropped += chunk_dropped
+        rows += sum(len(submission[1]) for submission, _, _ in results)
+        elapsed = time.perf_counter() - started
+        click.echo(f"{saved} saved, {dropped} dropped out, {rows / elapsed:.0f} rows/s", err=True)
+
+
+def load_secret_key(state_dir):
+    # The first worker to start writes the key; linking a fully written temp
+    # file into place means the others never read a partial one.
+    path = os.path.join(state_dir, "secret_key")
+    if not os.path.exists(path):
+        os.makedirs(state_dir, exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.write(fd, secrets.token_hex(32).encode("ascii"))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        try:
+            os.link(temp_path, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(temp_path)
+    with open(path, encoding="ascii") as handle:
+        return handle.read().strip()
+
+
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config.from_mapping(DEFAULT_CONFIG)
+    # Overrides, later ones winning: a Python file named by HCAI_CONFIG,
+    # HCAI_-prefixed environment variables (e.g. HCAI_SESSION_BACKEND=sqlite
+    # or HCAI_SECRET_KEY=...) and finally ``config``.
+    app.config.from_envvar("HCAI_CONFIG", silent=True)
+    app.config.from_prefixed_env("HCAI")
+    if config:
+        app.config.from_mapping(config)
+    if not app.config["SECRET_KEY"]:
+        app.config["SECRET_KEY"] = load_secret_key(app.config["STATE_DIR"])
+
+    if app.config["TEMPLATE_BYTECODE_CACHE"]:
+        cache_dir = app.config.get("TEMPLATE_CACHE_DIR") or os.path.join(app.config["STATE_DIR"], "jinja")
+        os.makedirs(cache_dir, exist_ok=True)
+        app.jinja_options = dict(app.jinja_options, bytecode_cache=FileSystemBytecodeCache(cache_dir))
+
+    metrics.init_app(app, TOTAL_TRIALS_PER_SESSION)
+    session_store.init_app(app)
+    response_log.init_app(app)
+    storage.init_app(app)
+    participants.init_app(app)
+    admission.init_app(app)
+    catalog.init_app(app)
+    aggregates.init_app(app)
+    comments.init_app(app)
+    screening.init_app(app)
+    timing.init_app(app)
+    monitor.init_app(app)
+    page_cache.init_app(app)
+    assets.init_app(app)
+    scheduler.init_app(app, TOTAL_TRIALS_PER_SESSION)
+
+    def compact_in_app_context(log_ids):
+        with app.app_context():
+            try:
+                return compact_logs(log_ids)
+            except Exception:
+                # The writer logs the error; the complete page needs to know.
+                get_response_log().mark_failed(log_ids)
+                raise
+
+    app.extensions["background_writer"] = writer.BackgroundWriter(
+        compact_in_app_context,
+        maxsize=app.config["WRITE_QUEUE_SIZE"],
+        batch_size=app.config["WRITE_BATCH_SIZE"],
+        put_timeout=app.config["WRITE_QUEUE_TIMEOUT"],
+    )
+
+    app.add_url_rule("/", view_func=intro, methods=["GET", "POST"])
+    app.add_url_rule("/waiting", view_func=waiting)
+    app.add_url_rule("/waiting/status", view_func=waiting_status)
+    app.add_url_rule("/practice", view_func=practice, methods=["GET", "POST"])
+    app.add_url_rule("/experiment", view_func=experiment, methods=["GET", "POST"])
+    app.add_url_rule("/study", view_func=study)
+    app.add_url_rule("/api/trials", view_func=api_trials)
+    app.add_url_rule("/api/responses", view_func=api_responses, methods=["POST"])
+    app.add_url_rule("/debrief", view_func=debrief, methods=["GET", "POST"])
+    app.add_url_rule("/complete", view_func=complete)
+    app.add_url_rule("/resume", view_func=resume, methods=["GET", "POST"])
+    app.add_url_rule("/researcher/aggregates", view_func=researcher_aggregates)
+    app.add_url_rule("/researcher/comments", view_func=researcher_comments)
+    app.add_url_rule("/researcher/exclusions", view_func=researcher_exclusions)
+    app.add_url_rule("/metrics", view_func=metrics_endpoint)
+    app.add_url_rule("/researcher/schedule", view_func=researcher_schedule)
+    app.add_url_rule("/researcher/monitor", view_func=researcher_monitor)
+    app.add_url_rule("/researcher/monitor/events", view_func=researcher_monitor_events)
+    app.add_url_rule("/researcher/export", view_func=researcher_export)
+
+    app.cli.add_command(compact_logs_command)
+    app.cli.add_command(rebuild_aggregates_command)
+    app.cli.add_command(rebuild_comment_index_command)
+    app.cli.add_command(rebuild_participant_index_command)
+    app.cli.add_command(screen_responses_command)
+    app.cli.add_command(join_timings_command)
+    app.cli.add_command(exclusions_command)
+    app.cli.add_command(build_assets_command)
+    app.cli.add_command(export_responses_command)
+    app.cli.add_command(generate_responses_command)
+
+    if app.config["TEMPLATE_WARMUP"]:
+        for name in app.jinja_env.list_templates():
+            app.jinja_env.get_template(name)
+
+    return app
+
+
+_app = None
+
+
+def __getattr__(name):
+    # ``app:app`` (gunicorn, flask --app app) builds the application on first
+    # use, so importing this module for create_app() stays cheap.
+    global _app
+    if name == "app":
+        if _app is None:
+            _app = create_app()
+        return _app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    create_app().run(debug=True)
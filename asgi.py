@@ -0,0 +1,324 @@
+"""Serve the study under an ASGI server.
+
+    uvicorn asgi:app --workers 4
+    hypercorn asgi:app
+
+The participant routes (intro, practice, experiment, debrief, complete and
+the rest) are the same Flask views as under WSGI. The difference is what
+holds a connection. An ASGI server keeps every open connection on one
+event loop, idle keep-alives included, and a request only borrows a thread
+from a bounded pool (ASGI_THREADS) while its view runs. That is where the
+response log, response store and SQLite I/O happen, so the loop never
+blocks on disk and memory grows with the number of active requests, not
+with the number of participants connected.
+
+Two paths never take a thread at all. /beacon is ingested on the loop,
+since it is a few microseconds of work. The researcher monitor stream
+(/researcher/monitor/events) is served natively. One pump thread per
+process waits on the event feed and wakes every open stream, so a
+thousand viewers cost a thousand idle coroutines rather than a thousand
+threads.
+
+Uses only the standard library; any ASGI 3 server will do.
+"""
+
+import asyncio
+import concurrent.futures
+import io
+import sys
+import threading
+import time
+
+from werkzeug.wrappers import Request
+
+import monitor
+from app import create_app, researcher_status
+
+
+class AsyncEventFeed:
+    # Bridges monitor.EventFeed onto the event loop: a single thread blocks
+    # in feed.wait() and, whenever events arrive, sets the current
+    # asyncio.Event and swaps in a fresh one. Streams read the events from
+    # the feed's ring themselves. The pump belongs to the loop that started
+    # it; stop() ends it, and a stream on another loop starts a new one.
+
+    def __init__(self, feed):
+        self.feed = feed
+        self._changed = None
+        self._loop = None
+        self._stopped = None
+        self._thread = None
+
+    def _pump(self, loop, stopped):
+        last_id = None
+        while not stopped.is_set():
+            # A short wait so that stop() is noticed promptly.
+            events = self.feed.wait(last_id, timeout=1.0)
+            if events and not stopped.is_set():
+                last_id = events[-1][0]
+                try:
+                    loop.call_soon_threadsafe(self._notify)
+                except RuntimeError:
+                    # The loop has been closed without a lifespan shutdown.
+                    return
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def start(self, loop):
+        if self._stopped is not None:
+            # Left to finish on its own rather than blocking this loop.
+            self._stopped.set()
+        self._loop = loop
+        self._changed = asyncio.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._pump, args=(loop, self._stopped), name="event-feed-pump", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+            self._loop = None
+
+    async def wait(self, last_id, timeout, disconnected):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self.start(loop)
+        events = self.feed.after(last_id)
+        if events:
+            return events
+        waiters = [asyncio.ensure_future(self._changed.wait()), asyncio.ensure_future(disconnected.wait())]
+        _, pending = await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        for waiter in pending:
+            waiter.cancel()
+        return [] if disconnected.is_set() else self.feed.after(last_id)
+
+
+def build_environ(scope, body):
+    # PEP 3333 environ for an ASGI HTTP scope.
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for raw_name, raw_value in scope["headers"]:
+        name = raw_name.decode("latin-1").upper().replace("-", "_")
+        value = raw_value.decode("latin-1")
+        if name == "CONTENT_TYPE" or name == "CONTENT_LENGTH":
+            key = name
+        else:
+            key = f"HTTP_{name}"
+        if key in environ:
+            value = environ[key] + ("; " if key == "HTTP_COOKIE" else ",") + value
+        environ[key] = value
+    environ.setdefault("CONTENT_LENGTH", str(len(body)))
+    return environ
+
+
+class AsgiApp:
+    def __init__(self, flask_app, threads=None):
+        self.flask_app = flask_app
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=threads or flask_app.config["ASGI_THREADS"], thread_name_prefix="asgi-view"
+        )
+        self.beacon = flask_app.extensions.get("beacon")
+        self.events = AsyncEventFeed(flask_app.extensions["event_feed"])
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            if scope["path"] == "/researcher/monitor/events" and scope["method"] == "GET":
+                await self.monitor_stream(scope, receive, send)
+                return
+            body = await self.read_body(receive)
+            if body is None:
+                return
+            environ = build_environ(scope, body)
+            if self.beacon is not None and scope["path"] == "/beacon":
+                status = self.beacon.ingest(environ)
+                await self.respond(send, status, [("Content-Length", "0"), ("Cache-Control", "no-store")], b"")
+                return
+            await self.run_wsgi(environ, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await asyncio.get_running_loop().run_in_executor(None, self.shutdown)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def shutdown(self):
+        self.events.stop()
+        self.executor.shutdown(wait=True)
+        self.flask_app.extensions["background_writer"].close()
+
+    @staticmethod
+    async def read_body(receive):
+        # The whole request body, or None if the client went away. Bodies
+        # here are form posts and small JSON documents.
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return None
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                return b"".join(chunks)
+
+    @staticmethod
+    def start_message(status, headers):
+        return {
+            "type": "http.response.start",
+            "status": int(status.split(" ", 1)[0]),
+            "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers],
+        }
+
+    @classmethod
+    async def respond(cls, send, status, headers, body, more_body=False):
+        await send(cls.start_message(status, headers))
+        await send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+    def _stream_wsgi(self, environ, put, cancelled):
+        # Runs a view from start to close() in one pool thread, handing its
+        # ASGI messages to the loop through ``put``, so a streamed export
+        # keeps the thread-local SQLite connection it started with. Chunks
+        # are read one ahead so the last goes out with more_body False;
+        # iteration stops early once the client has gone (``cancelled``).
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started["status"] = status
+            started["headers"] = headers
+
+        result = self.flask_app(environ, start_response)
+        try:
+            chunks = iter(result)
+            chunk = next(chunks, None)
+            put(self.start_message(started["status"], started["headers"]))
+            while not cancelled.is_set():
+                following = None if chunk is None else next(chunks, None)
+                put({"type": "http.response.body", "body": chunk or b"", "more_body": following is not None})
+                if following is None:
+                    break
+                chunk = following
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+
+    async def run_wsgi(self, environ, receive, send):
+        # Messages come back through a queue with a few slots, so a slow
+        # client holds the view's thread back rather than filling memory,
+        # while a page that fits in the slots never waits on the loop.
+        loop = asyncio.get_running_loop()
+        messages = asyncio.Queue()
+        slots = threading.Semaphore(4)
+        cancelled = threading.Event()
+
+        def put(message):
+            while not slots.acquire(timeout=1.0):
+                if cancelled.is_set():
+                    return
+            loop.call_soon_threadsafe(messages.put_nowait, message)
+
+        def stream():
+            try:
+                self._stream_wsgi(environ, put, cancelled)
+            finally:
+                put(None)
+
+        async def watch():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            cancelled.set()
+
+        watcher = asyncio.ensure_future(watch())
+        worker = loop.run_in_executor(self.executor, stream)
+        try:
+            while (message := await messages.get()) is not None:
+                slots.release()
+                if not cancelled.is_set():
+                    await send(message)
+        finally:
+            # Also releases the thread if sending failed part-way.
+            cancelled.set()
+            watcher.cancel()
+        await worker
+
+    async def monitor_stream(self, scope, receive, send):
+        config = self.flask_app.config
+        status = researcher_status(config, Request(build_environ(scope, b"")))
+        if status is not None:
+            await self.respond(send, f"{status} ", [("Content-Length", "0")], b"")
+            return
+
+        disconnected = asyncio.Event()
+
+        async def watch():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            disconnected.set()
+
+        watcher = asyncio.ensure_future(watch())
+        last_id = dict(scope["headers"]).get(b"last-event-id", b"").decode("latin-1") or None
+        deadline = time.monotonic() + config["MONITOR_STREAM_SECONDS"]
+        headers = [
+            ("Content-Type", "text/event-stream; charset=utf-8"),
+            ("Cache-Control", "no-store"),
+            ("X-Accel-Buffering", "no"),
+        ]
+        try:
+            await self.respond(send, "200 OK", headers, monitor.SSE_PREAMBLE.encode("utf-8"), more_body=True)
+            while not disconnected.is_set() and time.monotonic() < deadline:
+                timeout = min(15.0, max(deadline - time.monotonic(), 0))
+                events = await self.events.wait(last_id, timeout, disconnected)
+                if disconnected.is_set():
+                    return
+                data = monitor.format_events(events) if events else monitor.SSE_KEEPALIVE
+                await send({"type": "http.response.body", "body": data.encode("utf-8"), "more_body": True})
+                if events:
+                    last_id = events[-1][0]
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            watcher.cancel()
+
+
+def create_asgi_app(config=None):
+    return AsgiApp(create_app(config))
+
+
+_app = None
+
+
+def __getattr__(name):
+    # ``uvicorn asgi:app`` builds the application on first use, as app.py
+    # does for WSGI servers.
+    global _app
+    if name == "app":
+        if _app is None:
+            _app = create_asgi_app()
+        return _app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,114 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import tempfile
+
+from flask import abort, request, send_file, url_for
+
+try:
+    import brotli
+except ImportError:  # optional: without it only gzip variants are written
+    brotli = None
+
+
+# Encodings in order of preference, with the suffix of the variant file.
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+
+ONE_YEAR = 365 * 24 * 60 * 60
+
+
+def _write_atomic(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "wb") as out:
+        out.write(data)
+    os.replace(tmp_path, path)
+
+
+def fingerprint(name, data):
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    root, ext = os.path.splitext(name)
+    return f"{root}.{digest}{ext}"
+
+
+def build_assets(static_dir, out_dir):
+    # Copies every static file to a content-hashed name next to gzip (and,
+    # with the brotli package, brotli) variants, and writes manifest.json
+    # mapping each original name to its fingerprinted one. Outputs are
+    # content-addressed, so rebuilding is cheap and safe to race.
+    manifest = {}
+    for root, _, files in os.walk(static_dir):
+        for filename in sorted(files):
+            source = os.path.join(root, filename)
+            name = os.path.relpath(source, static_dir).replace(os.sep, "/")
+            with open(source, "rb") as source_file:
+                data = source_file.read()
+
+            hashed = fingerprint(name, data)
+            target = os.path.join(out_dir, hashed)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if not os.path.exists(target):
+                _write_atomic(target + ".gz", gzip.compress(data, compresslevel=9, mtime=0))
+                if brotli is not None:
+                    _write_atomic(target + ".br", brotli.compress(data, quality=11))
+                _write_atomic(target, data)
+            manifest[name] = hashed
+
+    _write_atomic(
+        os.path.join(out_dir, "manifest.json"),
+        json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8"),
+    )
+    return manifest
+
+
+class Assets:
+    def __init__(self, out_dir, manifest):
+        self.out_dir = out_dir
+        self.manifest = manifest
+        self.hashed_names = set(manifest.values())
+
+    def url(self, name):
+        hashed = self.manifest.get(name)
+        if hashed is None:
+            return url_for("static", filename=name)
+        return url_for("fingerprinted_asset", filename=hashed)
+
+    def send(self, filename):
+        if filename not in self.hashed_names:
+            abort(404)
+
+        path = os.path.join(self.out_dir, filename)
+        mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        encoding = None
+        for candidate, suffix in ENCODINGS:
+            if request.accept_encodings[candidate] and os.path.exists(path + suffix):
+                encoding = candidate
+                path += suffix
+                break
+
+        # send_file hands the open file to the server's wsgi.file_wrapper,
+        # which gunicorn turns into sendfile().
+        response = send_file(path, mimetype=mimetype, conditional=True, etag=True, max_age=ONE_YEAR)
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+        response.vary.add("Accept-Encoding")
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+
+def init_app(app):
+    out_dir = app.config.get("ASSETS_DIR") or os.path.join(app.config["STATE_DIR"], "assets")
+    manifest_path = os.path.join(out_dir, "manifest.json")
+
+    if app.config["ASSETS_BUILD_ON_STARTUP"] or not os.path.exists(manifest_path):
+        manifest = build_assets(app.static_folder, out_dir)
+    else:
+        with open(manifest_path, encoding="utf-8") as manifest_file:
+            manifest = json.load(manifest_file)
+
+    assets = Assets(out_dir, manifest)
+    app.extensions["assets"] = assets
+    app.add_url_rule("/assets/<path:filename>", "fingerprinted_asset", assets.send)
+    app.add_template_global(assets.url, "asset_url")
@@ -0,0 +1,536 @@
+"""Load-test the participant flow and report per-route latency.
+
+Drives N concurrent synthetic participants through
+intro -> practice -> experiment x 16 -> debrief -> complete, either
+in-process through Flask's test client or over HTTP against a local
+threaded WSGI server, and reports per-route latency percentiles,
+throughput, response and cookie sizes and disk writes per participant.
+
+    python benchmark.py --participants 50
+    python benchmark.py --participants 200 --transport http --save baseline.json
+    python benchmark.py --participants 200 --transport http --compare baseline.json
+    python benchmark.py --startup 10
+    python benchmark.py --participants 200 --transport asgi --open-connections 2000
+
+--startup N instead starts N fresh Python processes one after another and
+reports how long each took to import the app, run create_app() and serve
+its first response (GET /, then a practice page), which is what an
+autoscaled worker costs before it is useful. The first run starts with an
+empty template bytecode cache; the rest reuse it, as workers on one host
+do.
+
+--transport asgi serves the same app through asgi.py under uvicorn (which
+must be installed) instead of the threaded WSGI server. --open-connections
+N additionally holds N researcher monitor streams open for the whole run,
+the long-lived connections that pin a thread each under WSGI, and the
+report gains the peak thread count and resident memory of the benchmark
+process (server and simulated participants together) so the two
+transports can be compared.
+
+Unless --use-configured-dirs is given, DATA_DIR and STATE_DIR point at a
+temporary directory so a run never touches real study data. Any other
+HCAI_* environment variables (session backend, response store, ...) apply
+as usual, which is how configurations are compared.
+"""
+
+import argparse
+import atexit
+import http.client
+import json
+import os
+import random
+import secrets
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+
+RATING_FIELDS = [
+    "clarity",
+    "sufficiency",
+    "predictive_capability",
+    "actionability",
+    "trustworthiness",
+    "accountability",
+    "satisfaction",
+]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def read_io_counters():
+    # Linux only: write syscalls and bytes passed to write() by this process.
+    try:
+        with open("/proc/self/io", encoding="ascii") as io_file:
+            counters = dict(line.split(": ") for line in io_file.read().splitlines())
+        return int(counters["syscw"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def read_rss_bytes():
+    # Linux only: resident set size of this process.
+    try:
+        with open("/proc/self/status", encoding="ascii") as status_file:
+            for line in status_file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+class ResourceSampler:
+    # Peak thread count and resident memory, sampled in the background.
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak_threads = threading.active_count()
+        self.peak_rss = read_rss_bytes()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+            rss = read_rss_bytes()
+            if rss is not None:
+                self.peak_rss = max(self.peak_rss or 0, rss)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def open_streams(port, count, token):
+    # Long-lived connections: monitor streams that are opened and then only
+    # kept open. The server's keep-alive lines are left in socket buffers.
+    streams = []
+    request = f"GET /researcher/monitor/events?token={token} HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n".encode("ascii")
+    for _ in range(count):
+        stream = socket.create_connection(("127.0.0.1", port), timeout=60)
+        stream.sendall(request)
+        streams.append(stream)
+    return streams
+
+
+def directory_usage(*directories):
+    files = size = 0
+    for directory in directories:
+        for root, _, names in os.walk(directory):
+            for name in names:
+                try:
+                    size += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    continue
+                files += 1
+    return files, size
+
+
+class TestClientTransport:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        response = self.client.open(path, method=method, data=data)
+        body = response.get_data()
+        cookie = sum(len(value) for value in response.headers.getlist("Set-Cookie"))
+        return response.status_code, len(body), cookie
+
+
+class HttpTransport:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.cookies = {}
+
+    def request(self, method, path, data=None):
+        headers = {}
+        if self.cookies:
+            headers["Cookie"] = "; ".join(f"{name}={value}" for name, value in self.cookies.items())
+        body = None
+        if data is not None:
+            body = urllib.parse.urlencode(data)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            payload = response.read()
+            cookie = 0
+            for header in response.headers.get_all("Set-Cookie") or []:
+                cookie += len(header)
+                name, _, rest = header.partition("=")
+                value = rest.split(";", 1)[0]
+                if value:
+                    self.cookies[name] = value
+                else:
+                    self.cookies.pop(name, None)
+            return response.status, len(payload), cookie
+        finally:
+            conn.close()
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.errors = []
+
+    def record(self, route, seconds, size, cookie, status):
+        with self.lock:
+            self.samples.setdefault(route, []).append((seconds, size, cookie))
+            if status >= 400:
+                self.errors.append((route, status))
+
+
+def participant_journey(number, transport, recorder, think):
+    def call(method, path, data=None, expected=(200, 302)):
+        started = time.perf_counter()
+        status, size, cookie = transport.request(method, path, data)
+        recorder.record(f"{method} {path}", time.perf_counter() - started, size, cookie, status)
+        if status not in expected:
+            raise RuntimeError(f"{method} {path} returned {status}")
+
+    rng = random.Random(number)
+
+    def ratings():
+        # Mostly varied answers with the occasional straight-line.
+        if rng.random() < 0.1:
+            value = str(rng.randint(1, 7))
+            return {field: value for field in RATING_FIELDS}
+        return {field: str(rng.randint(1, 7)) for field in RATING_FIELDS}
+
+    call("GET", "/")
+    think()
+    call("POST", "/", {"consent": "yes", "participant_id": f"bench-{number}", "control_var": "4"})
+    for _ in range(2):
+        call("GET", "/practice")
+        think()
+        call("POST", "/practice", ratings())
+    for _ in range(16):
+        call("GET", "/experiment")
+        think()
+        call("POST", "/experiment", ratings())
+    call("GET", "/debrief")
+    think()
+    call("POST", "/debrief", {"comment": "synthetic benchmark participant"})
+    call("GET", "/complete")
+
+
+# Runs in a fresh interpreter for --startup; prints one JSON line of timings.
+STARTUP_PROBE = """
+import json, time, uuid
+started = time.perf_counter()
+import app as module
+imported = time.perf_counter()
+app = module.create_app()
+created = time.perf_counter()
+client = app.test_client()
+client.get("/")
+first = time.perf_counter()
+# A fresh ID per probe: a reused one is already in progress from the previous
+# run and never reaches the practice page.
+client.post("/", data={"consent": "yes", "participant_id": f"startup-probe-{uuid.uuid4().hex}"})
+assert client.get("/practice").status_code == 200
+practice = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - started) * 1000,
+    "create_app_ms": (created - imported) * 1000,
+    "first_response_ms": (first - created) * 1000,
+    "practice_ms": (practice - first) * 1000,
+    "total_ms": (practice - started) * 1000,
+}))
+"""
+
+
+def startup(runs):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, "-c", STARTUP_PROBE],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        timing = json.loads(output.strip().splitlines()[-1])
+        timing["process_ms"] = (time.perf_counter() - started) * 1000
+        timings.append(timing)
+
+    keys = list(timings[0])
+    print(f"{'':<10}" + "".join(f"{key.removesuffix('_ms'):>16}" for key in keys))
+    print(f"{'cold':<10}" + "".join(f"{timings[0][key]:>16.1f}" for key in keys))
+    if len(timings) > 1:
+        warm = {key: statistics.median(timing[key] for timing in timings[1:]) for key in keys}
+        print(f"{'warm p50':<10}" + "".join(f"{warm[key]:>16.1f}" for key in keys))
+    return {"runs": runs, "cold": timings[0], "warm": timings[1:]}
+
+
+def start_asgi_server(app):
+    # Returns (port, stop) for uvicorn serving asgi.py's front end in a thread.
+    # Stopping runs the lifespan shutdown, as a deployment would.
+    try:
+        import uvicorn
+    except ImportError:
+        raise SystemExit("--transport asgi needs an ASGI server: pip install uvicorn")
+    from asgi import AsgiApp
+
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    server = uvicorn.Server(uvicorn.Config(AsgiApp(app), log_level="warning", lifespan="on"))
+    thread = threading.Thread(target=server.run, kwargs={"sockets": [listener]}, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+
+    def stop():
+        server.should_exit = True
+        thread.join()
+
+    return listener.getsockname()[1], stop
+
+
+def run(args, app, background_writer):
+    recorder = Recorder()
+    stop_server = None
+    streams = []
+
+    if args.transport in ("http", "asgi"):
+        if args.transport == "http":
+            from werkzeug.serving import WSGIRequestHandler, make_server
+
+            class QuietHandler(WSGIRequestHandler):
+                def log_request(self, *args, **kwargs):
+                    pass
+
+            server = make_server("127.0.0.1", 0, app, threaded=True, request_handler=QuietHandler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            port = server.server_port
+            stop_server = server.shutdown
+        else:
+            port, stop_server = start_asgi_server(app)
+
+        def make_transport():
+            return HttpTransport("127.0.0.1", port)
+
+    else:
+
+        def make_transport():
+            return TestClientTransport(app)
+
+    think_rng = random.Random(args.seed)
+    think_lock = threading.Lock()
+
+    def think():
+        if args.think_median <= 0:
+            return
+        with think_lock:
+            delay = think_rng.lognormvariate(0, args.think_sigma) * args.think_median
+        time.sleep(delay)
+
+    failures = []
+
+    def worker(number):
+        if args.ramp:
+            time.sleep(args.ramp * number / args.participants)
+        try:
+            participant_journey(number, make_transport(), recorder, think)
+        except Exception as exc:
+            failures.append(repr(exc))
+
+    sampler = ResourceSampler()
+    threads_before = threading.active_count()
+    sampler.start()
+    if args.open_connections:
+        token = app.config["RESEARCHER_TOKEN"] or secrets.token_urlsafe(16)
+        app.config["RESEARCHER_TOKEN"] = token
+        streams = open_streams(port, args.open_connections, token)
+
+    data_dirs = (app.config["DATA_DIR"], app.config["STATE_DIR"])
+    files_before, bytes_before = directory_usage(*data_dirs)
+    io_before = read_io_counters()
+    started = time.perf_counter()
+
+    threads = [threading.Thread(target=worker, args=(number,)) for number in range(args.participants)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Let a background writer, if configured, finish before measuring disk.
+    background_writer.close()
+
+    elapsed = time.perf_counter() - started
+    io_after = read_io_counters()
+    files_after, bytes_after = directory_usage(*data_dirs)
+    sampler.stop()
+    for stream in streams:
+        stream.close()
+    if stop_server is not None:
+        stop_server()
+
+    routes = {}
+    total_requests = 0
+    for route, samples in sorted(recorder.samples.items()):
+        latencies = [sample[0] * 1000 for sample in samples]
+        total_requests += len(samples)
+        routes[route] = {
+            "requests": len(samples),
+            "p50_ms": percentile(latencies, 0.50),
+            "p95_ms": percentile(latencies, 0.95),
+            "p99_ms": percentile(latencies, 0.99),
+            "mean_bytes": statistics.fmean(sample[1] for sample in samples),
+            "max_cookie_bytes": max(sample[2] for sample in samples),
+        }
+
+    completed = args.participants - len(failures)
+    per_participant = max(completed, 1)
+    disk = {
+        "files_per_participant": (files_after - files_before) / per_participant,
+        "bytes_on_disk_per_participant": (bytes_after - bytes_before) / per_participant,
+    }
+    if io_before and io_after:
+        disk["write_calls_per_participant"] = (io_after[0] - io_before[0]) / per_participant
+        disk["bytes_written_per_participant"] = (io_after[1] - io_before[1]) / per_participant
+
+    return {
+        "transport": args.transport,
+        "participants": args.participants,
+        "completed": completed,
+        "failures": failures[:10],
+        "errors": len(recorder.errors),
+        "elapsed_s": elapsed,
+        "requests": total_requests,
+        "requests_per_s": total_requests / elapsed if elapsed else None,
+        "routes": routes,
+        "disk": disk,
+        "process": {
+            "open_connections": args.open_connections,
+            # Threads beyond the simulated participants' own.
+            "peak_server_threads": sampler.peak_threads - threads_before - args.participants,
+            "peak_rss_mb": sampler.peak_rss / 2**20 if sampler.peak_rss else None,
+        },
+        "config": {
+            key: app.config[key]
+            for key in ("SESSION_BACKEND", "RESPONSE_STORE", "ASYNC_WRITES", "TRIAL_SCHEDULER", "PAGE_CACHE_SIZE")
+        },
+    }
+
+
+def print_report(result):
+    print(
+        f"{result['completed']}/{result['participants']} participants, {result['requests']} requests "
+        f"in {result['elapsed_s']:.2f}s ({result['requests_per_s']:.1f} req/s) over {result['transport']}"
+    )
+    print(f"{'route':<18} {'n':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'bytes':>8} {'cookie':>7}")
+    for route, stats in result["routes"].items():
+        print(
+            f"{route:<18} {stats['requests']:>6} {stats['p50_ms']:>8.2f} {stats['p95_ms']:>8.2f} "
+            f"{stats['p99_ms']:>8.2f} {stats['mean_bytes']:>8.0f} {stats['max_cookie_bytes']:>7}"
+        )
+    for key, value in result["disk"].items():
+        print(f"{key}: {value:.1f}")
+    process = result.get("process")
+    if process:
+        rss = process["peak_rss_mb"]
+        print(
+            f"open connections: {process['open_connections']}, peak server threads: "
+            f"{process['peak_server_threads']}, peak RSS: {'-' if rss is None else f'{rss:.1f} MB'}"
+        )
+    if result["failures"]:
+        print("failures:", *result["failures"], sep="\n  ")
+
+
+def compare(result, baseline, tolerance):
+    # A route regresses when its p95 grows by more than ``tolerance``.
+    regressions = []
+    for route, stats in baseline["routes"].items():
+        current = result["routes"].get(route)
+        if current is None:
+            continue
+        if current["p95_ms"] > stats["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{route}: p95 {stats['p95_ms']:.2f} -> {current['p95_ms']:.2f} ms")
+    if result["requests_per_s"] < baseline["requests_per_s"] * (1 - tolerance):
+        regressions.append(
+            f"throughput {baseline['requests_per_s']:.1f} -> {result['requests_per_s']:.1f} req/s"
+        )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--participants", type=int, default=20)
+    parser.add_argument("--transport", choices=["client", "http", "asgi"], default="client")
+    parser.add_argument("--think-median", type=float, default=0.0,
+                        help="median think time per page in seconds (log-normal); 0 disables")
+    parser.add_argument("--think-sigma", type=float, default=0.6)
+    parser.add_argument("--ramp", type=float, default=0.0, help="spread participant arrivals over this many seconds")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--open-connections", type=int, default=0, metavar="N",
+                        help="hold N monitor streams open during the run (http and asgi transports)")
+    parser.add_argument("--save", metavar="PATH", help="write the results as a JSON baseline")
+    parser.add_argument("--compare", metavar="PATH", help="fail if results regress against this baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--use-configured-dirs", action="store_true")
+    parser.add_argument("--startup", type=int, metavar="N", help="measure N cold starts instead of a load test")
+    args = parser.parse_args(argv)
+    if args.open_connections and args.transport == "client":
+        parser.error("--open-connections needs --transport http or asgi")
+
+    if not args.use_configured_dirs:
+        scratch = tempfile.mkdtemp(prefix="hcai-bench-")
+        os.environ["HCAI_DATA_DIR"] = os.path.join(scratch, "data")
+        os.environ["HCAI_STATE_DIR"] = os.path.join(scratch, "state")
+        # Registered before the app exists, so it runs after the app's own
+        # exit handlers (metrics flush, writer drain) have used the directory.
+        atexit.register(shutil.rmtree, scratch, ignore_errors=True)
+
+    if args.startup:
+        result = startup(args.startup)
+    else:
+        from app import create_app
+
+        app = create_app()
+        result = run(args, app, app.extensions["background_writer"])
+
+    if args.startup:
+        if args.save:
+            with open(args.save, "w", encoding="utf-8") as baseline_file:
+                json.dump(result, baseline_file, indent=2, sort_keys=True)
+        return 0
+
+    print_report(result)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as baseline_file:
+            json.dump(result, baseline_file, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as baseline_file:
+            regressions = compare(result, json.load(baseline_file), args.tolerance)
+        if regressions:
+            print(f"Regressions against {args.compare}:", *regressions, sep="\n  ")
+            return 1
+    return 1 if result["failures"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,163 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from types import MappingProxyType
+
+
+logger = logging.getLogger(__name__)
+
+REQUIRED_FIELDS = ("stimulus_id", "description", "ai_decision", "ground_truth", "error_type", "explanation")
+
+
+class CatalogError(ValueError):
+    pass
+
+
+class Catalog:
+    # One immutable version of the stimulus pool, indexed by stimulus_id and
+    # by (error_type, explanation_quality). Nothing here is mutated after
+    # construction, so a reload just swaps the reference.
+
+    def __init__(self, version, practice, trials):
+        self.version = version
+        self.practice = tuple(MappingProxyType(dict(stimulus)) for stimulus in practice)
+        self.trials = tuple(MappingProxyType(dict(stimulus)) for stimulus in trials)
+
+        by_id = {}
+        by_cell = {}
+        for stimulus in self.practice + self.trials:
+            missing = [field for field in REQUIRED_FIELDS if field not in stimulus]
+            if missing:
+                raise CatalogError(f"Stimulus {stimulus.get('stimulus_id')!r} is missing {', '.join(missing)}")
+            if stimulus["stimulus_id"] in by_id:
+                raise CatalogError(f"Duplicate stimulus_id {stimulus['stimulus_id']!r}")
+            by_id[stimulus["stimulus_id"]] = stimulus
+        for stimulus in self.trials:
+            if "explanation_quality" not in stimulus:
+                raise CatalogError(f"Stimulus {stimulus['stimulus_id']!r} is missing explanation_quality")
+            by_cell.setdefault((stimulus["error_type"], stimulus["explanation_quality"]), []).append(stimulus)
+
+        self.by_id = MappingProxyType(by_id)
+        self.by_cell = MappingProxyType({cell: tuple(stimuli) for cell, stimuli in sorted(by_cell.items())})
+
+    @classmethod
+    def from_dict(cls, data):
+        try:
+            return cls(str(data["version"]), data["practice"], data["trials"])
+        except KeyError as exc:
+            raise CatalogError(f"Catalog is missing {exc.args[0]!r}") from None
+
+    def to_dict(self):
+        return {
+            "version": self.version,
+            "practice": [dict(stimulus) for stimulus in self.practice],
+            "trials": [dict(stimulus) for stimulus in self.trials],
+        }
+
+
+def load_catalog(path):
+    with open(path, encoding="utf-8") as catalog_file:
+        return Catalog.from_dict(json.load(catalog_file))
+
+
+class CatalogRegistry:
+    # Serves the current catalog and every version a session may still point
+    # at. The catalog file is re-checked at most every ``check_interval``
+    # seconds; a changed file is loaded in full and validated before it
+    # replaces the current version, so a bad edit never reaches requests.
+    # Each version is also snapshotted to ``snapshot_dir`` so participants
+    # who started on it can finish after a restart.
+
+    def __init__(self, path, snapshot_dir, check_interval=2.0):
+        self.path = path
+        self.snapshot_dir = snapshot_dir
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._signature = None
+        self._checked_at = 0.0
+        self._current = None
+        self._reload()
+        if self._current is None:
+            raise CatalogError(f"Could not load the stimulus catalog from {path}")
+
+    def _file_signature(self):
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def _reload(self):
+        try:
+            signature = self._file_signature()
+        except OSError:
+            logger.exception("Cannot stat the stimulus catalog %s", self.path)
+            return
+        if signature == self._signature:
+            return
+        # Remembered even if loading fails, so a bad edit is reported once.
+        self._signature = signature
+        try:
+            catalog = load_catalog(self.path)
+        except (OSError, ValueError):
+            logger.exception(
+                "Keeping catalog version %s; reloading %s failed",
+                self._current.version if self._current else None,
+                self.path,
+            )
+            return
+
+        known = self._versions.get(catalog.version)
+        if known is not None and known.to_dict() != catalog.to_dict():
+            logger.error("Catalog %s changed without a new version; keeping the loaded copy", catalog.version)
+            return
+
+        self._write_snapshot(catalog)
+        self._versions[catalog.version] = catalog
+        self._current = catalog
+
+    def _snapshot_path(self, version):
+        return os.path.join(self.snapshot_dir, f"{version}.json")
+
+    def _write_snapshot(self, catalog):
+        path = self._snapshot_path(catalog.version)
+        if os.path.exists(path):
+            return
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.snapshot_dir, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as snapshot_file:
+            json.dump(catalog.to_dict(), snapshot_file, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def current(self):
+        now = time.monotonic()
+        if now - self._checked_at >= self.check_interval:
+            with self._lock:
+                if now - self._checked_at >= self.check_interval:
+                    self._checked_at = now
+                    self._reload()
+        return self._current
+
+    def get(self, version):
+        if version is None:
+            return self.current()
+        catalog = self._versions.get(version)
+        if catalog is None:
+            with self._lock:
+                catalog = self._versions.get(version)
+                if catalog is None:
+                    path = self._snapshot_path(version)
+                    if not os.path.exists(path):
+                        raise CatalogError(f"Unknown catalog version {version!r}")
+                    catalog = self._versions[version] = load_catalog(path)
+        return catalog
+
+
+def init_app(app):
+    path = app.config.get("STIMULI_PATH") or os.path.join(app.root_path, "stimuli.json")
+    app.extensions["catalog"] = CatalogRegistry(
+        path,
+        os.path.join(app.config["STATE_DIR"], "catalogs"),
+        check_interval=app.config["CATALOG_CHECK_INTERVAL"],
+    )
@@ -0,0 +1,171 @@
+import json
+import logging
+import os
+import sqlite3
+
+import db
+import storage
+from aggregates import DIMENSIONS
+
+
+logger = logging.getLogger(__name__)
+
+
+def conditions(rows):
+    # What the participant saw: trials and mean rating per cell, plus the
+    # control variable, stored next to the comment for the search results.
+    cells = {}
+    for row in rows:
+        cell = cells.setdefault(f'{row["ErrorType"]}/{row["ExplanationQuality"]}', [0, 0.0])
+        cell[0] += 1
+        cell[1] += sum(float(row[dimension]) for dimension in DIMENSIONS) / len(DIMENSIONS)
+    return {
+        "ControlVar": rows[0].get("ControlVar", "") if rows else "",
+        "cells": {
+            key: {"trials": count, "mean_rating": round(total / count, 3)} for key, (count, total) in cells.items()
+        },
+    }
+
+
+class CommentIndex:
+    # Debrief comments in an SQLite FTS5 index (Porter-stemmed, so "trust"
+    # also finds "trusted"), with participant, save time and conditions in
+    # an ordinary table beside it. Comments are added as they are saved and
+    # recorded by ref, so each is indexed once however often it is seen.
+
+    def __init__(self, path):
+        self.path = path
+        conn = db.connect(self.path)
+        conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS comments (
+                id INTEGER PRIMARY KEY,
+                ref TEXT NOT NULL UNIQUE,
+                participant_id TEXT NOT NULL,
+                saved_at REAL NOT NULL,
+                comment TEXT NOT NULL,
+                conditions TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS comments_participant ON comments (participant_id);
+            CREATE INDEX IF NOT EXISTS comments_saved_at ON comments (saved_at);
+            CREATE VIRTUAL TABLE IF NOT EXISTS comments_fts USING fts5 (
+                comment, content='comments', content_rowid='id', tokenize='porter unicode61'
+            );
+            CREATE TABLE IF NOT EXISTS comment_meta (
+                key TEXT PRIMARY KEY,
+                value REAL NOT NULL
+            );
+            """
+        )
+
+    def add(self, submissions):
+        conn = db.connect(self.path)
+        added = 0
+        with db.transaction(conn):
+            for ref, participant_id, saved_at, rows, comment in submissions:
+                if not comment or not comment.strip():
+                    continue
+                cursor = conn.execute(
+                    "INSERT INTO comments (ref, participant_id, saved_at, comment, conditions)"
+                    " VALUES (?, ?, ?, ?, ?) ON CONFLICT (ref) DO NOTHING",
+                    (ref, participant_id, saved_at, comment, json.dumps(conditions(rows))),
+                )
+                if cursor.rowcount == 0:
+                    continue
+                conn.execute(
+                    "INSERT INTO comments_fts (rowid, comment) VALUES (?, ?)", (cursor.lastrowid, comment)
+                )
+                added += 1
+        return added
+
+    def rebuild(self, store):
+        # Same warm start as the aggregates.
+        return storage.replay_since_checkpoint(self.path, "comment_meta", store, self.add)
+
+    @staticmethod
+    def _plain_query(query):
+        # Each word as a quoted term, for input that is not valid FTS5
+        # syntax (stray quotes, a lone "-", ...).
+        return " ".join('"{}"'.format(word.replace('"', '""')) for word in query.split())
+
+    def search(self, query, participant_id=None, since=None, until=None, sort="rank", limit=50, offset=0):
+        # Best matches first (bm25) or, with sort="recent", newest first,
+        # which skips scoring and stays fast for very common terms. ``query``
+        # accepts FTS5 syntax: phrases, prefix*, AND / OR / NOT, NEAR.
+        order = "score" if sort == "rank" else "comments_fts.rowid DESC"
+        filters = []
+        params = []
+        if participant_id is not None:
+            # Driven from the participant index rather than checked per match.
+            filters.append("comments_fts.rowid IN (SELECT id FROM comments WHERE participant_id = ?)")
+            params.append(participant_id)
+        if since is not None:
+            filters.append("c.saved_at > ?")
+            params.append(since)
+        if until is not None:
+            filters.append("c.saved_at <= ?")
+            params.append(until)
+        # The join is only paid for when filtering on dates.
+        select_ids = """
+            SELECT comments_fts.rowid, bm25(comments_fts) AS score
+            FROM comments_fts {join}
+            WHERE comments_fts MATCH ? {filters}
+            ORDER BY {order}
+            LIMIT ? OFFSET ?
+        """.format(
+            join="" if since is None and until is None else "JOIN comments AS c ON c.id = comments_fts.rowid",
+            filters="".join(f" AND {clause}" for clause in filters),
+            order=order,
+        )
+        conn = db.connect(self.path)
+        try:
+            ranked = conn.execute(select_ids, [query] + params + [limit, offset]).fetchall()
+        except sqlite3.OperationalError:
+            query = self._plain_query(query)
+            ranked = conn.execute(select_ids, [query] + params + [limit, offset]).fetchall()
+        if not ranked:
+            return []
+
+        # Snippets only for the page being returned, not for every match.
+        details = {
+            row[0]: row[1:]
+            for row in conn.execute(
+                "SELECT comments_fts.rowid, c.participant_id, c.saved_at, c.conditions, c.comment,"
+                " snippet(comments_fts, 0, '[', ']', '...', 16)"
+                " FROM comments_fts JOIN comments AS c ON c.id = comments_fts.rowid"
+                " WHERE comments_fts MATCH ? AND comments_fts.rowid IN ({})".format(", ".join("?" * len(ranked))),
+                [query] + [rowid for rowid, _ in ranked],
+            )
+        }
+        results = []
+        for rowid, score in ranked:
+            participant, saved_at, conditions_json, comment, snippet = details[rowid]
+            results.append(
+                {
+                    "participant_id": participant,
+                    "saved_at": saved_at,
+                    "conditions": json.loads(conditions_json),
+                    "comment": comment,
+                    "snippet": snippet,
+                    "score": -score,
+                }
+            )
+        return results
+
+    def count(self):
+        return db.connect(self.path).execute("SELECT COUNT(*) FROM comments").fetchone()[0]
+
+
+def init_app(app):
+    path = app.config.get("COMMENTS_DB") or os.path.join(app.config["STATE_DIR"], "comments.sqlite3")
+    index = CommentIndex(path)
+    app.extensions["comments"] = index
+
+    def on_saved(sender, submissions):
+        try:
+            index.add(submissions)
+        except Exception:
+            # The comment is already saved; the next rebuild picks it up.
+            logger.exception("Indexing comments failed")
+
+    storage.responses_saved.connect(on_saved, sender=app, weak=False)
@@ -0,0 +1,98 @@
+import csv
+import datetime
+import io
+import zipfile
+
+import timing
+from storage import FIELDNAMES
+
+
+def parse_since(value):
+    # Accepts Unix seconds or an ISO 8601 timestamp; returns Unix seconds.
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+
+class _CsvChunks:
+    # A csv.writer target that hands back whatever was written since the
+    # last drain, so one submission at a time is held in memory.
+
+    def __init__(self, header):
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+        self.writer.writerow(header)
+
+    def drain(self):
+        data = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return data.encode("utf-8")
+
+
+def iter_response_csv(store, since=None, until=None, comments=False, timings=None):
+    # The participant's comment goes in a trailing Comment column on their
+    # first row, so the file stays one row per trial. With a timing store,
+    # each row also gets the client timings joined for that trial.
+    header = FIELDNAMES + (["Comment"] if comments else []) + (timing.FIELDS if timings is not None else [])
+    chunks = _CsvChunks(header)
+    yield chunks.drain()
+    for _, participant_id, _, rows, comment in store.iter_submissions(since=since, until=until):
+        joined = timings.attach(participant_id, rows) if timings is not None else None
+        for idx, row in enumerate(rows):
+            values = [row.get(field, "") for field in FIELDNAMES]
+            if comments:
+                values.append(comment if idx == 0 else "")
+            if joined is not None:
+                values.extend(joined[idx])
+            chunks.writer.writerow(values)
+        yield chunks.drain()
+
+
+def iter_comment_csv(store, since=None, until=None):
+    chunks = _CsvChunks(["ParticipantID", "SavedAt", "Comment"])
+    yield chunks.drain()
+    for _, participant_id, saved_at, _, comment in store.iter_submissions(since=since, until=until):
+        if comment:
+            saved = datetime.datetime.fromtimestamp(saved_at).isoformat(timespec="seconds")
+            chunks.writer.writerow([participant_id, saved, comment])
+            yield chunks.drain()
+
+
+class _ZipChunks(io.RawIOBase):
+    # Unseekable sink for zipfile: entries are written with data descriptors
+    # and the bytes are passed on as they are produced.
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def iter_zip(store, since=None, until=None, comments=False, timings=None):
+    sink = _ZipChunks()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        entries = [("responses.csv", iter_response_csv(store, since, until, timings=timings))]
+        if comments:
+            entries.append(("comments.csv", iter_comment_csv(store, since, until)))
+        for name, chunks in entries:
+            with archive.open(name, "w", force_zip64=True) as entry:
+                for chunk in chunks:
+                    entry.write(chunk)
+                    data = sink.drain()
+                    if data:
+                        yield data
+    yield sink.drain()
@@ -0,0 +1,319 @@
+import atexit
+import bisect
+import contextlib
+import cProfile
+import json
+import logging
+import os
+import random
+import secrets
+import tempfile
+import threading
+import time
+
+from flask import before_render_template, g, request, template_rendered
+
+import db
+
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HELP = {
+    "hcai_requests_total": ("counter", "Requests served, by endpoint, method and status."),
+    "hcai_request_duration_seconds": ("histogram", "Time spent handling a request."),
+    "hcai_template_render_seconds": ("histogram", "Time spent rendering a top-level template."),
+    "hcai_io_seconds": ("histogram", "Time spent in response-log and response-store I/O."),
+    "hcai_sessions_started_total": ("counter", "Participants who passed the intro page."),
+    "hcai_admissions_total": ("counter", "New sessions admitted or sent to the waiting room."),
+    "hcai_trials_submitted_total": ("counter", "Study trials submitted, by trial number."),
+    "hcai_sessions_completed_total": ("counter", "Participants who submitted the debrief page."),
+    "hcai_timing_events_total": ("counter", "Client trial timings received on /beacon."),
+}
+
+
+def _owner_alive(name):
+    # Snapshots are named "<pid>-<token>.json"; the token tells a recycled
+    # PID's new worker from the one that wrote the file.
+    try:
+        os.kill(int(name.split("-", 1)[0].removesuffix(".json")), 0)
+    except ValueError:
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _add_snapshot(snapshot, counters, histograms):
+    for name, labels, value in snapshot["counters"]:
+        key = (name, tuple(tuple(pair) for pair in labels))
+        counters[key] = counters.get(key, 0) + value
+    for name, labels, values in snapshot["histograms"]:
+        key = (name, tuple(tuple(pair) for pair in labels))
+        merged = histograms.setdefault(key, [0] * len(values))
+        for position, value in enumerate(values):
+            merged[position] += value
+
+
+class Metrics:
+    # Counters and fixed-bucket histograms kept in memory per process. Each
+    # process writes a snapshot to ``directory`` at most every
+    # ``flush_interval`` seconds, and the exposition sums the snapshots of
+    # every worker, so the numbers are the same whichever worker serves the
+    # scrape. Snapshots of workers that have exited are folded into one
+    # retired total, kept in SQLite beside them, and deleted. ``trials`` is
+    # the number of study trials in a session.
+
+    def __init__(self, directory, flush_interval=1.0, trials=16):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.trials = trials
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._flushed_at = 0.0
+        self._pid = os.getpid()
+        self._token = secrets.token_hex(4)
+        self._retired_path = os.path.join(self.directory, "retired.sqlite3")
+        os.makedirs(self.directory, exist_ok=True)
+        conn = db.connect(self._retired_path)
+        conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS retired_totals (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                snapshot TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS retired_files (
+                name TEXT PRIMARY KEY
+            );
+            """
+        )
+        atexit.register(self.flush)
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def _check_fork(self):
+        # A forked worker must not report its parent's numbers as its own.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._token = secrets.token_hex(4)
+            self._counters = {}
+            self._histograms = {}
+
+    def inc(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._check_fork()
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._check_fork()
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+            histogram[bisect.bisect_left(BUCKETS, seconds)] += 1
+            histogram[-1] += seconds
+
+    @contextlib.contextmanager
+    def timed(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def _snapshot(self):
+        # The snapshot and the file name it goes under.
+        with self._lock:
+            self._check_fork()
+            snapshot = {
+                "counters": [[name, labels, value] for (name, labels), value in self._counters.items()],
+                "histograms": [[name, labels, list(values)] for (name, labels), values in self._histograms.items()],
+            }
+            return snapshot, f"{self._pid}-{self._token}.json"
+
+    def flush(self):
+        snapshot, name = self._snapshot()
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as snapshot_file:
+            json.dump(snapshot, snapshot_file)
+        os.replace(tmp_path, os.path.join(self.directory, name))
+        self._flushed_at = time.monotonic()
+
+    def maybe_flush(self):
+        if time.monotonic() - self._flushed_at >= self.flush_interval:
+            try:
+                self.flush()
+            except OSError:
+                logger.exception("Writing metrics snapshot failed")
+
+    def collect(self):
+        # Snapshots from every worker, this one's taken fresh, plus the
+        # retired total. Exited workers' snapshots are retired in the same
+        # transaction that reads it, recorded by name, so each file counts
+        # exactly once: from disk until it is retired, from the total after,
+        # whichever worker retires it and whenever the file is deleted.
+        self.flush()
+        snapshots = {}
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                with open(entry.path, encoding="utf-8") as snapshot_file:
+                    snapshots[entry.name] = json.load(snapshot_file)
+            except (OSError, ValueError):
+                continue
+
+        counters = {}
+        histograms = {}
+        conn = db.connect(self._retired_path)
+        with db.transaction(conn):
+            retired = {name for (name,) in conn.execute("SELECT name FROM retired_files")}
+            row = conn.execute("SELECT snapshot FROM retired_totals").fetchone()
+            if row is not None:
+                _add_snapshot(json.loads(row[0]), counters, histograms)
+            exited = [name for name in snapshots if name not in retired and not _owner_alive(name)]
+            if exited:
+                for name in exited:
+                    _add_snapshot(snapshots[name], counters, histograms)
+                conn.executemany("INSERT INTO retired_files (name) VALUES (?)", [(name,) for name in exited])
+                total = {
+                    "counters": [[name, labels, value] for (name, labels), value in counters.items()],
+                    "histograms": [[name, labels, values] for (name, labels), values in histograms.items()],
+                }
+                conn.execute(
+                    "INSERT OR REPLACE INTO retired_totals (id, snapshot) VALUES (1, ?)", (json.dumps(total),)
+                )
+                retired.update(exited)
+
+        for name, snapshot in snapshots.items():
+            if name in retired:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+            else:
+                _add_snapshot(snapshot, counters, histograms)
+        return counters, histograms
+
+    def render(self):
+        counters, histograms = self.collect()
+        lines = []
+        described = set()
+
+        def describe(name):
+            if name not in described:
+                described.add(name)
+                kind, text = HELP.get(name, ("untyped", name))
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(counters.items()):
+            describe(name)
+            lines.append(f"{name}{_labels(labels)} {value}")
+
+        for (name, labels), values in sorted(histograms.items()):
+            describe(name)
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), values[:-1]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(labels + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {values[-1]}")
+            lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+
+        # Sessions that reached a trial (or, after the last one, the debrief
+        # page) but have not submitted it yet: abandoned ones plus those
+        # still in progress.
+        started = sum(value for (name, _), value in counters.items() if name == "hcai_sessions_started_total")
+        completed = sum(value for (name, _), value in counters.items() if name == "hcai_sessions_completed_total")
+        submitted = {}
+        for (name, labels), value in counters.items():
+            if name == "hcai_trials_submitted_total":
+                trial = int(dict(labels)["trial"])
+                submitted[trial] = submitted.get(trial, 0) + value
+        if started:
+            lines.append("# HELP hcai_sessions_stopped_at_trial Sessions that reached a trial without submitting it.")
+            lines.append("# TYPE hcai_sessions_stopped_at_trial gauge")
+            reached = started
+            for trial in range(1, self.trials + 1):
+                stopped = reached - submitted.get(trial, 0)
+                lines.append(f'hcai_sessions_stopped_at_trial{{trial="{trial}"}} {stopped}')
+                reached = submitted.get(trial, 0)
+            lines.append("# HELP hcai_sessions_stopped_at_debrief Sessions past the last trial without a debrief.")
+            lines.append("# TYPE hcai_sessions_stopped_at_debrief gauge")
+            lines.append(f"hcai_sessions_stopped_at_debrief {reached - completed}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+def init_app(app, trials):
+    directory = app.config.get("METRICS_DIR") or os.path.join(app.config["STATE_DIR"], "metrics")
+    metrics = Metrics(directory, flush_interval=app.config["METRICS_FLUSH_INTERVAL"], trials=trials)
+    app.extensions["metrics"] = metrics
+    profile_dir = os.path.join(app.config["STATE_DIR"], "profiles")
+
+    @app.before_request
+    def start_timer():
+        g.metrics_started = time.perf_counter()
+        rate = app.config["PROFILE_SAMPLE_RATE"]
+        token = app.config["RESEARCHER_TOKEN"]
+        wanted = token and secrets.compare_digest(request.headers.get("X-Profile", "").encode(), token.encode())
+        if wanted or (rate and random.random() < rate):
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another profiler is already active in this thread.
+                return
+            g.profiler = profiler
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop("metrics_started", None)
+        if started is not None:
+            endpoint = request.endpoint or "unmatched"
+            metrics.observe(
+                "hcai_request_duration_seconds",
+                time.perf_counter() - started,
+                endpoint=endpoint,
+                method=request.method,
+            )
+            metrics.inc("hcai_requests_total", endpoint=endpoint, method=request.method, status=response.status_code)
+
+        profiler = g.pop("profiler", None)
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(profile_dir, exist_ok=True)
+            name = f"{time.strftime('%Y%m%d_%H%M%S')}_{os.getpid()}_{request.endpoint}.prof"
+            profiler.dump_stats(os.path.join(profile_dir, name))
+
+        metrics.maybe_flush()
+        return response
+
+    def render_started(sender, template, context, **extra):
+        g.setdefault("render_started", {})[template.name] = time.perf_counter()
+
+    def render_finished(sender, template, context, **extra):
+        started = g.get("render_started", {}).pop(template.name, None)
+        if started is not None:
+            metrics.observe("hcai_template_render_seconds", time.perf_counter() - started, template=template.name)
+
+    before_render_template.connect(render_started, app, weak=False)
+    template_rendered.connect(render_finished, app, weak=False)
@@ -0,0 +1,198 @@
+import collections
+import fcntl
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# On startup the tailer only reads this far back for each slot in the ring.
+BYTES_PER_EVENT = 256
+
+
+class EventFeed:
+    # Recent session events from every worker. Publishing is a single
+    # O_APPEND write of one JSON line to a file shared by all workers on the
+    # host (atomic for lines this short), so it never waits on anything.
+    # In a worker that serves the monitor, one tailer thread reads new
+    # lines into a bounded ring buffer and wakes every open stream; streams
+    # never touch the file themselves. Event IDs are the line's inode and
+    # byte offset, the same in every worker, so a reconnecting viewer picks
+    # up where it left off whichever worker it lands on. Past ``max_bytes``
+    # the file is rotated to ``path + ".1"``. Appends hold a shared flock on
+    # ``path + ".lock"`` and rotation an exclusive one, so only one worker
+    # rotates and nothing is appended to the old file after its rename.
+
+    def __init__(self, path, capacity=1000, max_bytes=16 * 1024 * 1024, poll_interval=0.25):
+        self.path = path
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.poll_interval = poll_interval
+        self._events = collections.deque(maxlen=capacity)
+        self._changed = threading.Condition()
+        self._writer_lock = threading.Lock()
+        self._fd = None
+        self._lock_fd = None
+        self._lock_fd_pid = None
+        self._fd_pid = None
+        self._tailer_pid = None
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+    def _writer(self):
+        # The append descriptor, reopened after a fork or once another
+        # worker has rotated the file. Called with the shared lock held.
+        if self._fd is not None and self._fd_pid == os.getpid():
+            try:
+                if os.stat(self.path).st_ino == os.fstat(self._fd).st_ino:
+                    return self._fd
+            except FileNotFoundError:
+                pass
+            os.close(self._fd)
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._fd_pid = os.getpid()
+        return self._fd
+
+    def _rotation_lock(self):
+        # Not shared with a parent process: flocks belong to the open file.
+        if self._lock_fd is None or self._lock_fd_pid != os.getpid():
+            self._lock_fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+            self._lock_fd_pid = os.getpid()
+        return self._lock_fd
+
+    def publish(self, event_type, participant_id, **fields):
+        event = dict(fields, type=event_type, participant=participant_id, ts=round(time.time(), 3))
+        line = (json.dumps(event, separators=(",", ":")) + "\n").encode("utf-8")
+        try:
+            with self._writer_lock:
+                lock_fd = self._rotation_lock()
+                fcntl.flock(lock_fd, fcntl.LOCK_SH)
+                try:
+                    fd = self._writer()
+                    os.write(fd, line)
+                    if os.fstat(fd).st_size > self.max_bytes:
+                        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+                        # Another worker may have rotated while we waited.
+                        try:
+                            rotated = os.stat(self.path).st_ino != os.fstat(fd).st_ino
+                        except FileNotFoundError:
+                            rotated = True
+                        if not rotated:
+                            os.replace(self.path, self.path + ".1")
+                finally:
+                    fcntl.flock(lock_fd, fcntl.LOCK_UN)
+        except OSError:
+            # The monitor is a convenience; the participant's request goes on.
+            logger.exception("Publishing a session event failed")
+
+    def _start_tailer(self):
+        if self._tailer_pid != os.getpid():
+            self._tailer_pid = os.getpid()
+            threading.Thread(target=self._tail, name="event-feed-tailer", daemon=True).start()
+
+    def _tail(self):
+        handle = None
+        inode = None
+        offset = 0
+        pending = b""
+        first = True
+        draining = False
+        while True:
+            try:
+                if handle is None:
+                    handle = open(self.path, "rb")
+                    inode = os.fstat(handle.fileno()).st_ino
+                    offset = 0
+                    pending = b""
+                    draining = False
+                    if first:
+                        # Only the tail end is needed to fill the ring.
+                        size = os.fstat(handle.fileno()).st_size
+                        offset = max(0, size - self.capacity * BYTES_PER_EVENT)
+                        handle.seek(offset)
+                        if offset:
+                            offset += len(handle.readline())
+                    first = False
+                chunk = handle.read()
+            except FileNotFoundError:
+                time.sleep(self.poll_interval)
+                continue
+            except OSError:
+                logger.exception("Reading the session event feed failed")
+                time.sleep(self.poll_interval)
+                continue
+
+            if chunk:
+                pending += chunk
+                events = []
+                *lines, pending = pending.split(b"\n")
+                for line in lines:
+                    events.append((f"{inode:x}-{offset:x}", line.decode("utf-8", "replace")))
+                    offset += len(line) + 1
+                with self._changed:
+                    self._events.extend(events)
+                    self._changed.notify_all()
+                continue
+
+            # At the end of the file: follow a rotation once it is drained.
+            try:
+                rotated = os.stat(self.path).st_ino != inode
+            except FileNotFoundError:
+                rotated = True
+            if rotated and draining:
+                handle.close()
+                handle = None
+            elif rotated:
+                # Lines appended just before the rename may have landed since
+                # the last read; nothing is appended after it, so one more
+                # read gets them all.
+                draining = True
+            else:
+                time.sleep(self.poll_interval)
+
+    def _after(self, last_id):
+        if last_id is not None:
+            for position in range(len(self._events) - 1, -1, -1):
+                if self._events[position][0] == last_id:
+                    return list(itertools.islice(self._events, position + 1, None))
+        # New viewer, or one whose last event has left the ring (or was never
+        # in it): everything buffered.
+        return list(self._events)
+
+    def after(self, last_id=None):
+        # The same without waiting; starts the tailer if it is not running.
+        with self._changed:
+            self._start_tailer()
+            return self._after(last_id)
+
+    def wait(self, last_id=None, timeout=15.0):
+        # (id, JSON) pairs newer than ``last_id``, blocking up to ``timeout``
+        # seconds for the first one; an empty list means nothing happened.
+        with self._changed:
+            self._start_tailer()
+            events = self._after(last_id)
+            if not events:
+                self._changed.wait(timeout)
+                events = self._after(last_id)
+        return events
+
+
+# First line of every stream: how long the browser waits before reconnecting.
+SSE_PREAMBLE = "retry: 2000\n\n"
+SSE_KEEPALIVE = ": keep-alive\n\n"
+
+
+def format_events(events):
+    return "".join(f"id: {event_id}\ndata: {data}\n\n" for event_id, data in events)
+
+
+def init_app(app):
+    path = app.config.get("MONITOR_EVENTS_PATH") or os.path.join(app.config["STATE_DIR"], "events.jsonl")
+    app.extensions["event_feed"] = EventFeed(
+        path,
+        capacity=app.config["MONITOR_BUFFER_SIZE"],
+        max_bytes=app.config["MONITOR_MAX_BYTES"],
+    )
@@ -0,0 +1,81 @@
+import collections
+import hashlib
+import os
+import threading
+
+from flask import current_app, make_response, render_template, request, session
+
+
+class PageCache:
+    # A bounded LRU of rendered pages. A page is identified by a key that
+    # must capture everything the output depends on (template, catalog
+    # version, stimulus, trial counter); combined with a hash of the
+    # template and static sources (pages embed fingerprinted asset URLs) it
+    # gives a strong ETag that can be checked before anything is rendered.
+
+    def __init__(self, source_dirs, maxsize=256):
+        self.maxsize = maxsize
+        self.template_version = self._hash_sources(source_dirs)
+        self._pages = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _hash_sources(source_dirs):
+        digest = hashlib.sha1()
+        for source_dir in source_dirs:
+            for root, _, files in sorted(os.walk(source_dir)):
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    digest.update(os.path.relpath(path, source_dir).encode("utf-8"))
+                    with open(path, "rb") as source_file:
+                        digest.update(source_file.read())
+        return digest.hexdigest()[:16]
+
+    def etag(self, key):
+        raw = repr((self.template_version,) + tuple(key)).encode("utf-8")
+        return hashlib.sha1(raw).hexdigest()
+
+    def get(self, etag):
+        with self._lock:
+            body = self._pages.get(etag)
+            if body is not None:
+                self._pages.move_to_end(etag)
+            return body
+
+    def put(self, etag, body):
+        with self._lock:
+            self._pages[etag] = body
+            self._pages.move_to_end(etag)
+            while len(self._pages) > self.maxsize:
+                self._pages.popitem(last=False)
+
+
+def render_cached(template_name, key, **context):
+    cache = current_app.extensions.get("page_cache")
+    # Flashed messages are per-participant and consumed on render, so those
+    # pages bypass the cache, and so does everything while templates reload
+    # on edit (debug mode).
+    if cache is None or "_flashes" in session or current_app.jinja_env.auto_reload:
+        return render_template(template_name, **context)
+
+    etag = cache.etag((template_name,) + tuple(key))
+    if etag in request.if_none_match:
+        response = make_response("", 304)
+    else:
+        body = cache.get(etag)
+        if body is None:
+            body = render_template(template_name, **context)
+            cache.put(etag, body)
+        response = make_response(body)
+    response.set_etag(etag)
+    # The browser may keep the page but must revalidate before reusing it.
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+def init_app(app):
+    size = app.config["PAGE_CACHE_SIZE"]
+    if size:
+        app.extensions["page_cache"] = PageCache(
+            [os.path.join(app.root_path, app.template_folder), app.static_folder], maxsize=size
+        )
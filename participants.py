@@ -0,0 +1,113 @@
+import os
+import threading
+import time
+
+import db
+
+
+IN_PROGRESS = "in_progress"
+COMPLETED = "completed"
+
+
+class ParticipantIndex:
+    # Status of every participant ID ever seen, keyed by ID in SQLite so all
+    # workers share it. Completion never reverts, so completed IDs are cached
+    # in memory (loaded at startup) and answered without touching the
+    # database; anything else is one primary-key lookup.
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        conn = db.connect(self.path)
+        conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS participants (
+                participant_id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                log_id TEXT,
+                started_at REAL NOT NULL,
+                completed_at REAL
+            ) WITHOUT ROWID;
+            """
+        )
+        self._completed = {
+            participant_id
+            for (participant_id,) in conn.execute(
+                "SELECT participant_id FROM participants WHERE status = ?", (COMPLETED,)
+            )
+        }
+
+    def lookup(self, participant_id):
+        # Returns (status, log_id), or None for an ID that was never used.
+        if participant_id in self._completed:
+            return COMPLETED, None
+        row = db.connect(self.path).execute(
+            "SELECT status, log_id FROM participants WHERE participant_id = ?", (participant_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        if row[0] == COMPLETED:
+            with self._lock:
+                self._completed.add(participant_id)
+        return row[0], row[1]
+
+    def start(self, participant_id, log_id, replace=False):
+        # Registers a new session. Returns False when the ID is already taken,
+        # which also settles two workers racing on the same ID. ``replace``
+        # takes over an in-progress entry whose log has gone.
+        conn = db.connect(self.path)
+        if replace:
+            cursor = conn.execute(
+                "UPDATE participants SET log_id = ?, started_at = ? WHERE participant_id = ? AND status = ?",
+                (log_id, time.time(), participant_id, IN_PROGRESS),
+            )
+        else:
+            cursor = conn.execute(
+                "INSERT INTO participants (participant_id, status, log_id, started_at) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT (participant_id) DO NOTHING",
+                (participant_id, IN_PROGRESS, log_id, time.time()),
+            )
+        return cursor.rowcount == 1
+
+    def complete_many(self, participant_ids):
+        participant_ids = [pid for pid in participant_ids if pid not in self._completed]
+        if not participant_ids:
+            return
+        now = time.time()
+        conn = db.connect(self.path)
+        with db.transaction(conn):
+            conn.executemany(
+                "INSERT INTO participants (participant_id, status, started_at, completed_at) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT (participant_id) DO UPDATE SET status = excluded.status, log_id = NULL,"
+                " completed_at = excluded.completed_at",
+                [(participant_id, COMPLETED, now, now) for participant_id in participant_ids],
+            )
+        with self._lock:
+            self._completed.update(participant_ids)
+
+    def complete(self, participant_id):
+        self.complete_many([participant_id])
+
+    def rebuild(self, response_store, response_log):
+        # Backfills the index from saved submissions and open logs, e.g. for
+        # data collected before the index existed. Returns (completed, open).
+        completed = {participant_id for _, participant_id, _, _, _ in response_store.iter_submissions()}
+        self.complete_many(sorted(completed))
+        opened = 0
+        for log_id in response_log.log_ids():
+            state = response_log.read(log_id)
+            if state is None or not state["participant"]:
+                continue
+            participant_id = state["participant"]["id"]
+            if state["completed"]:
+                if participant_id not in completed:
+                    completed.add(participant_id)
+                    self.complete(participant_id)
+            elif self.start(participant_id, log_id):
+                opened += 1
+        return len(completed), opened
+
+
+def init_app(app):
+    path = app.config.get("PARTICIPANT_DB") or os.path.join(app.config["STATE_DIR"], "participants.sqlite3")
+    app.extensions["participants"] = ParticipantIndex(path)
@@ -0,0 +1,39 @@
+# Every rating the practice and study pages collect: form/JSON field name
+# and the label used in messages. Values are integers on a 1-7 scale.
+RATING_FIELDS = [
+    ("clarity", "Clarity"),
+    ("sufficiency", "Sufficiency"),
+    ("predictive_capability", "Predictive Capability"),
+    ("actionability", "Actionability"),
+    ("trustworthiness", "Trustworthiness"),
+    ("accountability", "Accountability"),
+    ("satisfaction", "Satisfaction"),
+]
+
+SCALE_MIN = 1
+SCALE_MAX = 7
+
+
+def validate_ratings(source):
+    # ``source`` is anything with .get(): request.form or a decoded JSON
+    # object. Returns (ratings, errors); ratings is None unless every field
+    # is present and on the scale.
+    ratings = {}
+    errors = []
+    for field, label in RATING_FIELDS:
+        value = source.get(field)
+        if value is None or value == "":
+            errors.append(f"{label} is missing.")
+            continue
+        try:
+            if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+                raise ValueError(value)
+            number = int(value)
+        except (TypeError, ValueError):
+            errors.append(f"{label} must be a whole number.")
+            continue
+        if not SCALE_MIN <= number <= SCALE_MAX:
+            errors.append(f"{label} must be between {SCALE_MIN} and {SCALE_MAX}.")
+            continue
+        ratings[field] = number
+    return (None if errors else ratings), errors
@@ -0,0 +1,215 @@
+import hashlib
+import json
+import os
+import secrets
+import threading
+import time
+
+
+class _Batch:
+    def __init__(self):
+        self.fds = []
+        self.done = threading.Event()
+        self.error = None
+
+
+class ResponseLog:
+    # One append-only JSON-lines file per participant session. Appends are
+    # made durable with group commit: the first writer to arrive waits up to
+    # ``commit_interval`` seconds for appends already under way in other
+    # threads to join its batch, then fsyncs every file in the batch once and
+    # releases all of them together. A writer with no company fsyncs at once.
+
+    def __init__(self, directory, commit_interval=0.0):
+        self.directory = directory
+        self.commit_interval = commit_interval
+        self._lock = threading.Lock()
+        self._joined = threading.Condition(self._lock)
+        self._open_batch = None
+        # Appends that have started but not yet joined a batch.
+        self._unbatched = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, log_id):
+        return os.path.join(self.directory, f"{log_id}.log")
+
+    def _claimed_path(self, log_id):
+        return os.path.join(self.directory, f"{log_id}.claimed")
+
+    def _failed_path(self, log_id):
+        return os.path.join(self.directory, f"{log_id}.failed")
+
+    @staticmethod
+    def _prefix(participant_id):
+        return hashlib.sha1(participant_id.encode("utf-8")).hexdigest()[:12]
+
+    def start(self, participant, order, catalog_version, allocators=None, resume_code=None):
+        log_id = "{}-{}-{}".format(
+            self._prefix(participant["id"]),
+            time.strftime("%Y%m%d%H%M%S"),
+            secrets.token_hex(4),
+        )
+        self.append(
+            log_id,
+            {
+                "k": "start",
+                "participant": participant,
+                "order": order,
+                "catalog_version": catalog_version,
+                "allocators": allocators or [],
+                "resume_code": resume_code,
+            },
+        )
+        return log_id
+
+    def append(self, log_id, record):
+        self.append_many(log_id, [record])
+
+    def append_many(self, log_id, records):
+        # Several records in one write() and one commit.
+        now = time.time()
+        data = "".join(
+            json.dumps(dict(record, ts=now), separators=(",", ":")) + "\n" for record in records
+        ).encode("utf-8")
+        with self._lock:
+            self._unbatched += 1
+        try:
+            fd = os.open(self._path(log_id), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, data)
+            except BaseException:
+                os.close(fd)
+                raise
+        except BaseException:
+            with self._joined:
+                self._unbatched -= 1
+                self._joined.notify_all()
+            raise
+        self._commit(fd)
+
+    def _commit(self, fd):
+        with self._joined:
+            self._unbatched -= 1
+            batch = self._open_batch
+            leader = batch is None
+            if leader:
+                batch = self._open_batch = _Batch()
+            batch.fds.append(fd)
+            self._joined.notify_all()
+
+        if not leader:
+            batch.done.wait()
+            if batch.error is not None:
+                raise batch.error
+            return
+
+        deadline = time.monotonic() + self.commit_interval
+        with self._joined:
+            # Each append under way wakes the leader when it joins.
+            while self._unbatched and (remaining := deadline - time.monotonic()) > 0:
+                self._joined.wait(remaining)
+            self._open_batch = None
+
+        try:
+            for batch_fd in batch.fds:
+                os.fsync(batch_fd)
+        except OSError as exc:
+            batch.error = exc
+        finally:
+            for batch_fd in batch.fds:
+                os.close(batch_fd)
+            batch.done.set()
+
+        if batch.error is not None:
+            raise batch.error
+
+    def claim(self, log_id):
+        # Renaming is atomic, so exactly one process gets to persist a log.
+        try:
+            os.rename(self._path(log_id), self._claimed_path(log_id))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def exists(self, log_id):
+        return os.path.exists(self._path(log_id)) or os.path.exists(self._claimed_path(log_id))
+
+    def mark_failed(self, log_ids):
+        # An empty marker beside each log that is still there after a failed
+        # save; the log itself stays for "flask compact-logs", and remove()
+        # clears the marker with it.
+        for log_id in log_ids:
+            if self.exists(log_id):
+                with open(self._failed_path(log_id), "a"):
+                    pass
+
+    def failed(self, log_id):
+        return os.path.exists(self._failed_path(log_id))
+
+    def read(self, log_id):
+        path = self._path(log_id)
+        if not os.path.exists(path):
+            path = self._claimed_path(log_id)
+            if not os.path.exists(path):
+                return None
+
+        state = {
+            "log_id": log_id,
+            "participant": None,
+            "order": [],
+            "allocators": [],
+            "catalog_version": None,
+            "resume_code": None,
+            "trials": {},
+            "comment": "",
+            "completed": False,
+            "started_at": None,
+            "completed_at": None,
+        }
+        with open(path, "r", encoding="utf-8") as log_file:
+            for line in log_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A torn final line from a crash mid-append.
+                    continue
+                kind = record.get("k")
+                if kind == "start":
+                    state["participant"] = record["participant"]
+                    state["order"] = record["order"]
+                    state["catalog_version"] = record.get("catalog_version")
+                    state["allocators"] = record.get("allocators", [])
+                    state["resume_code"] = record.get("resume_code")
+                    state["started_at"] = record["ts"]
+                elif kind == "trial":
+                    # Keyed by trial number so a replayed POST overwrites
+                    # instead of duplicating.
+                    state["trials"][record["n"]] = record
+                elif kind == "end":
+                    state["comment"] = record.get("comment", "")
+                    state["completed"] = True
+                    state["completed_at"] = record["ts"]
+
+        state["responses"] = [state["trials"][n] for n in sorted(state["trials"])]
+        return state
+
+    def remove(self, log_id):
+        for path in (self._path(log_id), self._claimed_path(log_id), self._failed_path(log_id)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def log_ids(self, claimed=False):
+        suffix = ".claimed" if claimed else ".log"
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(suffix):
+                yield entry.name[: -len(suffix)]
+
+
+def init_app(app):
+    directory = app.config.get("RESPONSE_LOG_DIR") or os.path.join(app.config["STATE_DIR"], "wal")
+    app.extensions["response_log"] = ResponseLog(
+        directory,
+        commit_interval=app.config["RESPONSE_LOG_COMMIT_INTERVAL"],
+    )
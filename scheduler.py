@@ -0,0 +1,486 @@
+import atexit
+import heapq
+import logging
+import math
+import os
+import random
+import sqlite3
+import threading
+import time
+
+import db
+from ratings import RATING_FIELDS
+
+
+logger = logging.getLogger(__name__)
+
+
+def williams_square(n):
+    # Balanced Latin square: every position shows every slot once, and for
+    # even n every slot follows every other slot exactly once.
+    first = [0]
+    low, high = 1, n - 1
+    while len(first) < n:
+        first.append(low)
+        low += 1
+        if len(first) < n:
+            first.append(high)
+            high -= 1
+    rows = [[(value + shift) % n for value in first] for shift in range(n)]
+    if n % 2:
+        rows += [list(reversed(row)) for row in rows]
+    return rows
+
+
+class BalancedTable:
+    # Row r of the assignment table is one session's trial order. Items are
+    # drawn in equal numbers from every ErrorType x ExplanationQuality cell,
+    # row r starting r items into each cell, so every stimulus is shown
+    # equally often over a period. The slots are then ordered by a Williams
+    # square so presentation position and carry-over are balanced too.
+    # Rows are computed on demand in O(per_session), so the pool can grow
+    # to thousands of stimuli; the 16 x 16 square is the only precomputed
+    # part.
+
+    def __init__(self, catalog, per_session):
+        cells = [[stimulus["stimulus_id"] for stimulus in stimuli] for stimuli in catalog.by_cell.values()]
+        per_cell, remainder = divmod(per_session, len(cells))
+        if remainder or any(len(items) < per_cell for items in cells):
+            # Uneven pool: fall back to rotating through the whole pool.
+            cells = [[stimulus["stimulus_id"] for stimulus in catalog.trials]]
+            per_cell = per_session
+
+        self.cells = cells
+        self.per_cell = per_cell
+        self.orders = williams_square(per_session)
+        self.period = math.lcm(len(self.orders), *(len(items) for items in cells))
+
+    def row(self, number):
+        picks = [
+            [items[(number + offset) % len(items)] for offset in range(self.per_cell)]
+            for items in self.cells
+        ]
+        # Interleave the cells so neighbouring slots come from different
+        # conditions before the Latin-square reordering.
+        slots = [cell[offset] for offset in range(self.per_cell) for cell in picks]
+        return [slots[position] for position in self.orders[number % len(self.orders)]]
+
+    def exposure(self, rows):
+        # How often each stimulus appears in rows 0 .. rows - 1.
+        counts = {}
+        for items in self.cells:
+            size = len(items)
+            full, partial = divmod(rows, size)
+            for position, stimulus_id in enumerate(items):
+                # Row r shows position p when (p - r) mod size < per_cell.
+                extra = sum(
+                    1 for offset in range(self.per_cell) if (position - offset) % size < partial
+                )
+                counts[stimulus_id] = full * self.per_cell + extra
+        return counts
+
+
+class SequenceCounter:
+    # A cross-process counter kept in SQLite. Each process leases a block of
+    # ``block_size`` numbers at a time and hands them out from memory, so
+    # only one request in ``block_size`` touches the database.
+
+    def __init__(self, path, name, block_size=8):
+        self.path = path
+        self.name = name
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._next = 0
+        self._end = 0
+        conn = db.connect(self.path)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sequences (name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+        )
+        conn.execute("INSERT OR IGNORE INTO sequences (name, value) VALUES (?, 0)", (self.name,))
+
+    def next(self):
+        with self._lock:
+            if self._pid != os.getpid() or self._next >= self._end:
+                (end,) = db.connect(self.path).execute(
+                    "UPDATE sequences SET value = value + ? WHERE name = ? RETURNING value",
+                    (self.block_size, self.name),
+                ).fetchall()[0]
+                self._pid = os.getpid()
+                self._next = end - self.block_size
+                self._end = end
+            value = self._next
+            self._next += 1
+            return value
+
+    def issued(self):
+        row = db.connect(self.path).execute(
+            "SELECT value FROM sequences WHERE name = ?", (self.name,)
+        ).fetchone()
+        return row[0] if row else 0
+
+
+class RandomScheduler:
+    name = "random"
+
+    def __init__(self, catalogs, per_session):
+        self.catalogs = catalogs
+        self.per_session = per_session
+
+    def next_assignment(self, catalog):
+        # The trial order, and which allocator chose each item.
+        selected = random.sample([stimulus["stimulus_id"] for stimulus in catalog.trials], self.per_session)
+        random.shuffle(selected)
+        return selected, [self.name] * len(selected)
+
+    def observe(self, responses):
+        pass
+
+    def report(self):
+        return {"scheduler": self.name}
+
+
+class BalancedScheduler:
+    name = "balanced"
+
+    def __init__(self, catalogs, per_session, counter):
+        self.catalogs = catalogs
+        self.per_session = per_session
+        self.counter = counter
+        self._tables = {}
+
+    def _table(self, catalog):
+        table = self._tables.get(catalog.version)
+        if table is None:
+            table = self._tables[catalog.version] = BalancedTable(catalog, self.per_session)
+        return table
+
+    def next_assignment(self, catalog):
+        row = self._table(catalog).row(self.counter.next())
+        return row, [self.name] * len(row)
+
+    def observe(self, responses):
+        pass
+
+    def report(self):
+        # Exposure over every sequence number handed out, including numbers
+        # a worker has leased but not used yet, laid over the current
+        # catalog.
+        catalog = self.catalogs.current()
+        issued = self.counter.issued()
+        table = self._table(catalog)
+        exposure = table.exposure(issued)
+
+        cells = {}
+        for stimulus_id, count in exposure.items():
+            stimulus = catalog.by_id[stimulus_id]
+            key = f'{stimulus["error_type"]}/{stimulus["explanation_quality"]}'
+            cells[key] = cells.get(key, 0) + count
+
+        return {
+            "scheduler": self.name,
+            "catalog_version": catalog.version,
+            "period": table.period,
+            "assigned_sessions": issued,
+            "cells": cells,
+            "exposure": exposure,
+        }
+
+
+# Variance of a trial's mean rating assumed for stimuli with few ratings of
+# their own, and how many ratings' worth of weight that assumption carries.
+PRIOR_VARIANCE = 2.0
+PRIOR_WEIGHT = 2
+
+
+def shrunk_variance(n, total, total_sq):
+    # Sample variance pulled towards PRIOR_VARIANCE while ``n`` is small.
+    dof = max(n - 1, 0)
+    sample = (total_sq - total * total / n) / dof if dof else 0.0
+    return (dof * max(sample, 0.0) + PRIOR_WEIGHT * PRIOR_VARIANCE) / (dof + PRIOR_WEIGHT)
+
+
+def variance_reduction(variance, count):
+    # Drop in the variance of a mean from one more rating, with the count
+    # offset by one so unrated items have a finite (and the largest) gain.
+    return variance / ((count + 1) * (count + 2))
+
+
+class StimulusStats:
+    # How often each stimulus was assigned, and the count, sum and sum of
+    # squares of the mean rating it received, in SQLite so all workers and
+    # restarts share them. Each process keeps a copy in memory and adds its
+    # own assignments to it as it makes them. Only the first read in a
+    # process waits for the database; after that a copy older than
+    # ``refresh_interval`` seconds is still served while a background thread
+    # writes the pending assignments in one batch (also done at exit, not
+    # one write per session), re-reads the table and calls ``on_refresh``
+    # with the result. Every re-read returns a new dict.
+
+    def __init__(self, path, refresh_interval=5.0, on_refresh=None):
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.on_refresh = on_refresh
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._pending = {}
+        self._loaded_at = None
+        self._refreshing = False
+        self._pid = None
+        db.connect(self.path).execute(
+            """
+            CREATE TABLE IF NOT EXISTS stimulus_stats (
+                stimulus_id TEXT PRIMARY KEY,
+                assigned INTEGER NOT NULL DEFAULT 0,
+                n INTEGER NOT NULL DEFAULT 0,
+                total REAL NOT NULL DEFAULT 0,
+                total_sq REAL NOT NULL DEFAULT 0
+            )
+            """
+        )
+        atexit.register(self.flush)
+
+    def flush(self):
+        # Runs without the lock so assignments are not held up by the write.
+        # Counts that fail to write are kept for the next attempt.
+        with self._lock:
+            if not self._pending or self._pid != os.getpid():
+                return
+            pending, self._pending = self._pending, {}
+        conn = db.connect(self.path)
+        try:
+            with db.transaction(conn):
+                conn.executemany(
+                    "INSERT INTO stimulus_stats (stimulus_id, assigned) VALUES (?, ?)"
+                    " ON CONFLICT (stimulus_id) DO UPDATE SET assigned = assigned + excluded.assigned",
+                    list(pending.items()),
+                )
+        except sqlite3.Error:
+            logger.exception("Recording stimulus assignments failed")
+            with self._lock:
+                for stimulus_id, count in pending.items():
+                    self._pending[stimulus_id] = self._pending.get(stimulus_id, 0) + count
+
+    def _reload(self):
+        self.flush()
+        rows = db.connect(self.path).execute("SELECT stimulus_id, assigned, n, total, total_sq FROM stimulus_stats")
+        stats = {row[0]: list(row[1:]) for row in rows}
+        with self._lock:
+            # Assignments made since the flush are not in the table yet.
+            for stimulus_id, count in self._pending.items():
+                stats.setdefault(stimulus_id, [0, 0, 0.0, 0.0])[0] += count
+            self._stats = stats
+            self._loaded_at = time.monotonic()
+        return stats
+
+    def _refresh(self):
+        try:
+            stats = self._reload()
+            if self.on_refresh is not None:
+                self.on_refresh(stats)
+        except Exception:
+            # The stale copy stays in use; the next call tries again.
+            logger.exception("Refreshing stimulus statistics failed")
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def current(self):
+        # stimulus_id -> [assigned, n, total, total_sq]
+        with self._lock:
+            if self._pid != os.getpid():
+                # A forked worker: the parent's unwritten counts are its own.
+                self._pending = {}
+                self._pid = os.getpid()
+                self._loaded_at = None
+                self._refreshing = False
+            if self._loaded_at is not None:
+                if not self._refreshing and time.monotonic() - self._loaded_at >= self.refresh_interval:
+                    self._refreshing = True
+                    threading.Thread(target=self._refresh, name="stimulus-stats-refresh", daemon=True).start()
+                return self._stats
+        return self._reload()
+
+    def add_assigned(self, stimulus_ids):
+        with self._lock:
+            for stimulus_id in stimulus_ids:
+                self._stats.setdefault(stimulus_id, [0, 0, 0.0, 0.0])[0] += 1
+                self._pending[stimulus_id] = self._pending.get(stimulus_id, 0) + 1
+
+    def add_scores(self, scores):
+        # ``scores``: (stimulus_id, mean rating) pairs.
+        conn = db.connect(self.path)
+        with db.transaction(conn):
+            conn.executemany(
+                "INSERT INTO stimulus_stats (stimulus_id, n, total, total_sq) VALUES (?, 1, ?, ?)"
+                " ON CONFLICT (stimulus_id) DO UPDATE SET n = n + 1, total = total + excluded.total,"
+                " total_sq = total_sq + excluded.total_sq",
+                [(stimulus_id, score, score * score) for stimulus_id, score in scores],
+            )
+        with self._lock:
+            for stimulus_id, score in scores:
+                entry = self._stats.setdefault(stimulus_id, [0, 0, 0.0, 0.0])
+                entry[1] += 1
+                entry[2] += score
+                entry[3] += score * score
+
+
+class AdaptiveScheduler:
+    # Picks each session's items to shrink the uncertainty of the
+    # ErrorType x ExplanationQuality cell means fastest. Every slot goes to
+    # the cell whose mean gains most from one more rating (its variance over
+    # (k + 1)(k + 2), k = items assigned so far), and within that cell to
+    # the stimulus with the largest gain by the same measure, so thin cells
+    # and noisy, under-rated stimuli fill first. Assigned rather than rated
+    # counts are used so a burst of new sessions spreads out instead of
+    # piling onto the same items. The per-cell heaps are rebuilt on the
+    # statistics' refresh thread (and for a new catalog version); a session
+    # pops its items and pushes them back with their new gain, so its cost
+    # does not grow with the pool. Selection stops at ``time_budget``
+    # seconds; slots left over are drawn at random and recorded as such.
+
+    name = "adaptive"
+
+    def __init__(self, catalogs, per_session, stats, time_budget=0.0015):
+        self.catalogs = catalogs
+        self.per_session = per_session
+        self.stats = stats
+        self.time_budget = time_budget
+        self._lock = threading.Lock()
+        self._cells = None
+        self._cells_version = None
+        stats.on_refresh = self._rebuild
+
+    @staticmethod
+    def _cell_totals(stimuli, stats):
+        assigned = n = 0
+        total = total_sq = 0.0
+        for stimulus in stimuli:
+            entry = stats.get(stimulus["stimulus_id"])
+            if entry is not None:
+                assigned += entry[0]
+                n += entry[1]
+                total += entry[2]
+                total_sq += entry[3]
+        return assigned, n, total, total_sq
+
+    @staticmethod
+    def _heap_entry(stimulus_id, stats):
+        entry = stats.get(stimulus_id, (0, 0, 0.0, 0.0))
+        gain = variance_reduction(shrunk_variance(*entry[1:]), max(entry[0], entry[1]))
+        # Random tie-break so equally good items rotate.
+        return (-gain, random.random(), stimulus_id)
+
+    def _build_cells(self, catalog, stats):
+        # [cell variance, cell count, heap of stimuli] per cell.
+        cells = []
+        for stimuli in catalog.by_cell.values():
+            assigned, n, total, total_sq = self._cell_totals(stimuli, stats)
+            heap = [self._heap_entry(stimulus["stimulus_id"], stats) for stimulus in stimuli]
+            heapq.heapify(heap)
+            cells.append([shrunk_variance(n, total, total_sq), max(assigned, n), heap])
+        return cells
+
+    def _rebuild(self, stats):
+        # Runs on the statistics' refresh thread, not in a request.
+        catalog = self.catalogs.current()
+        cells = self._build_cells(catalog, stats)
+        with self._lock:
+            self._cells = cells
+            self._cells_version = catalog.version
+
+    def _cells_for(self, catalog, stats):
+        # Called with the lock held. Only the first session and the first
+        # after a catalog change build the heaps themselves.
+        if self._cells is None or self._cells_version != catalog.version:
+            self._cells = self._build_cells(catalog, stats)
+            self._cells_version = catalog.version
+        return self._cells
+
+    def _select(self, catalog, stats, deadline):
+        cells = self._cells_for(catalog, stats)
+        picks = []
+        taken_from = []
+        while len(picks) < self.per_session and time.perf_counter() < deadline:
+            open_cells = [cell for cell in cells if cell[2]]
+            if not open_cells:
+                break
+            cell = max(open_cells, key=lambda cell: variance_reduction(cell[0], cell[1]))
+            picks.append(heapq.heappop(cell[2])[2])
+            taken_from.append(cell)
+            cell[1] += 1
+        return picks, taken_from
+
+    def next_assignment(self, catalog):
+        stats = self.stats.current()
+        with self._lock:
+            picks, taken_from = self._select(catalog, stats, time.perf_counter() + self.time_budget)
+            allocators = [self.name] * len(picks)
+            if len(picks) < self.per_session:
+                chosen = set(picks)
+                rest = [stimulus["stimulus_id"] for stimulus in catalog.trials]
+                extra = random.sample([item for item in rest if item not in chosen], self.per_session - len(picks))
+                picks += extra
+                allocators += ["random"] * len(extra)
+            self.stats.add_assigned(picks)
+            # Back into their heaps, ranked by the counts they have now.
+            for stimulus_id, cell in zip(picks, taken_from):
+                heapq.heappush(cell[2], self._heap_entry(stimulus_id, stats))
+
+        # Presentation order stays random; the allocator travels with its item.
+        paired = list(zip(picks, allocators))
+        random.shuffle(paired)
+        return [stimulus_id for stimulus_id, _ in paired], [allocator for _, allocator in paired]
+
+    def observe(self, responses):
+        # Saved trial records, each with its stimulus_id and ratings.
+        scores = []
+        for response in responses:
+            score = sum(response[field] for field, _ in RATING_FIELDS) / len(RATING_FIELDS)
+            scores.append((response["stimulus_id"], score))
+        try:
+            self.stats.add_scores(scores)
+        except Exception:
+            # The responses are saved either way; only the estimates lag.
+            logger.exception("Updating stimulus statistics failed")
+
+    def report(self):
+        catalog = self.catalogs.current()
+        stats = self.stats.current()
+        cells = {}
+        for (error_type, quality), stimuli in catalog.by_cell.items():
+            assigned, n, total, total_sq = self._cell_totals(stimuli, stats)
+            variance = shrunk_variance(n, total, total_sq)
+            cells[f"{error_type}/{quality}"] = {
+                "assigned": assigned,
+                "rated": n,
+                "mean": total / n if n else None,
+                "standard_error": math.sqrt(variance / n) if n else None,
+            }
+        return {
+            "scheduler": self.name,
+            "catalog_version": catalog.version,
+            "time_budget_ms": self.time_budget * 1000,
+            "cells": cells,
+            "exposure": {
+                stimulus["stimulus_id"]: stats.get(stimulus["stimulus_id"], [0])[0] for stimulus in catalog.trials
+            },
+        }
+
+
+def init_app(app, per_session):
+    catalogs = app.extensions["catalog"]
+    name = app.config["TRIAL_SCHEDULER"]
+    if name == "random":
+        scheduler = RandomScheduler(catalogs, per_session)
+    elif name == "balanced":
+        path = app.config.get("SCHEDULER_DB") or os.path.join(app.config["STATE_DIR"], "scheduler.sqlite3")
+        counter = SequenceCounter(path, "assignments", app.config["SCHEDULER_BLOCK_SIZE"])
+        scheduler = BalancedScheduler(catalogs, per_session, counter)
+    elif name == "adaptive":
+        path = app.config.get("SCHEDULER_DB") or os.path.join(app.config["STATE_DIR"], "scheduler.sqlite3")
+        stats = StimulusStats(path, refresh_interval=app.config["SCHEDULER_REFRESH_INTERVAL"])
+        scheduler = AdaptiveScheduler(catalogs, per_session, stats, time_budget=app.config["SCHEDULER_TIME_BUDGET"])
+    else:
+        raise ValueError(f"Unknown TRIAL_SCHEDULER: {name!r}")
+    app.extensions["scheduler"] = scheduler
@@ -0,0 +1,181 @@
+import logging
+import os
+
+import db
+from aggregates import DIMENSIONS
+
+
+logger = logging.getLogger(__name__)
+
+FLAGS = ("zero_variance", "identical_run", "too_fast")
+
+
+def seconds_per_trial(state):
+    # From the response log: server time between the start of the session
+    # and the last study trial, per study trial. Practice is included, but
+    # it is the same for everyone. Per-trial gaps are not used because the
+    # JSON API stores a whole block of trials with one timestamp.
+    responses = state["responses"]
+    if not responses or state["started_at"] is None:
+        return None
+    return (responses[-1]["ts"] - state["started_at"]) / len(responses)
+
+
+def measure(rows):
+    # (trials with all seven answers equal, longest run of identical
+    # consecutive answers over all trials in order)
+    straightline = 0
+    longest = run = 0
+    previous = None
+    for row in rows:
+        answers = [str(row[dimension]) for dimension in DIMENSIONS]
+        if len(set(answers)) == 1:
+            straightline += 1
+        for answer in answers:
+            run = run + 1 if answer == previous else 1
+            previous = answer
+            longest = max(longest, run)
+    return straightline, longest
+
+
+class QualityScreen:
+    # Per-submission screening measures and the flags they raise, written
+    # as each session is saved, so an exclusion list is one indexed query.
+    # The raw measures are kept too: re-screening with other thresholds
+    # never needs the response files.
+
+    def __init__(self, path, straightline_fraction=0.75, run_length=21, min_seconds_per_trial=4.0):
+        self.path = path
+        self.straightline_fraction = straightline_fraction
+        self.run_length = run_length
+        self.min_seconds_per_trial = min_seconds_per_trial
+        conn = db.connect(self.path)
+        conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS quality_measures (
+                ref TEXT PRIMARY KEY,
+                participant_id TEXT NOT NULL,
+                saved_at REAL NOT NULL,
+                trials INTEGER NOT NULL,
+                straightline_trials INTEGER NOT NULL,
+                longest_run INTEGER NOT NULL,
+                seconds_per_trial REAL
+            );
+            CREATE TABLE IF NOT EXISTS quality_flags (
+                ref TEXT NOT NULL,
+                participant_id TEXT NOT NULL,
+                flag TEXT NOT NULL,
+                detail TEXT NOT NULL,
+                PRIMARY KEY (ref, flag)
+            );
+            CREATE INDEX IF NOT EXISTS quality_flags_flag ON quality_flags (flag, participant_id);
+            CREATE INDEX IF NOT EXISTS quality_flags_participant ON quality_flags (participant_id);
+            """
+        )
+
+    def flags(self, trials, straightline, longest, seconds):
+        raised = []
+        if trials and straightline / trials >= self.straightline_fraction:
+            detail = f"{straightline} of {trials} trials rated the same on every dimension"
+            raised.append(("zero_variance", detail))
+        if longest >= self.run_length:
+            raised.append(("identical_run", f"{longest} identical answers in a row"))
+        if seconds is not None and seconds < self.min_seconds_per_trial:
+            raised.append(("too_fast", f"{seconds:.1f} s per trial"))
+        return raised
+
+    def add(self, submissions):
+        # ``submissions``: (ref, participant_id, saved_at, rows,
+        # seconds_per_trial or None) tuples. Returns how many were new.
+        conn = db.connect(self.path)
+        added = 0
+        with db.transaction(conn):
+            for ref, participant_id, saved_at, rows, seconds in submissions:
+                straightline, longest = measure(rows)
+                cursor = conn.execute(
+                    "INSERT INTO quality_measures (ref, participant_id, saved_at, trials, straightline_trials,"
+                    " longest_run, seconds_per_trial) VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (ref) DO NOTHING",
+                    (ref, participant_id, saved_at, len(rows), straightline, longest, seconds),
+                )
+                if cursor.rowcount == 0:
+                    continue
+                conn.executemany(
+                    "INSERT INTO quality_flags (ref, participant_id, flag, detail) VALUES (?, ?, ?, ?)",
+                    [
+                        (ref, participant_id, flag, detail)
+                        for flag, detail in self.flags(len(rows), straightline, longest, seconds)
+                    ],
+                )
+                added += 1
+        return added
+
+    def observe(self, submissions):
+        try:
+            self.add(submissions)
+        except Exception:
+            # The responses are saved either way; "flask screen-responses"
+            # catches up.
+            logger.exception("Screening saved responses failed")
+
+    def rebuild(self, store):
+        # Screens every saved submission not screened yet. Response files
+        # carry no timestamps, so these cannot be flagged as too fast.
+        batch = []
+        added = 0
+        for ref, participant_id, saved_at, rows, _ in store.iter_submissions():
+            batch.append((ref, participant_id, saved_at, rows, None))
+            if len(batch) >= 500:
+                added += self.add(batch)
+                batch = []
+        if batch:
+            added += self.add(batch)
+        return added
+
+    def rescreen(self):
+        # Re-derives every flag from the stored measures with the current
+        # thresholds.
+        conn = db.connect(self.path)
+        with db.transaction(conn):
+            measures = conn.execute(
+                "SELECT ref, participant_id, trials, straightline_trials, longest_run, seconds_per_trial"
+                " FROM quality_measures"
+            ).fetchall()
+            conn.execute("DELETE FROM quality_flags")
+            conn.executemany(
+                "INSERT INTO quality_flags (ref, participant_id, flag, detail) VALUES (?, ?, ?, ?)",
+                [
+                    (ref, participant_id, flag, detail)
+                    for ref, participant_id, *values in measures
+                    for flag, detail in self.flags(*values)
+                ],
+            )
+        return len(measures)
+
+    def exclusions(self, flags=FLAGS):
+        # participant_id -> {flag: detail} for everyone with any of ``flags``.
+        conn = db.connect(self.path)
+        excluded = {}
+        rows = conn.execute(
+            "SELECT participant_id, flag, detail FROM quality_flags WHERE flag IN ({})"
+            " ORDER BY participant_id, flag".format(", ".join("?" * len(flags))),
+            list(flags),
+        )
+        for participant_id, flag, detail in rows:
+            excluded.setdefault(participant_id, {})[flag] = detail
+        return excluded
+
+    def summary(self):
+        conn = db.connect(self.path)
+        (screened,) = conn.execute("SELECT COUNT(*) FROM quality_measures").fetchone()
+        counts = dict(conn.execute("SELECT flag, COUNT(DISTINCT participant_id) FROM quality_flags GROUP BY flag"))
+        return {"screened": screened, "flagged": {flag: counts.get(flag, 0) for flag in FLAGS}}
+
+
+def init_app(app):
+    path = app.config.get("SCREENING_DB") or os.path.join(app.config["STATE_DIR"], "screening.sqlite3")
+    app.extensions["screening"] = QualityScreen(
+        path,
+        straightline_fraction=app.config["SCREEN_STRAIGHTLINE_FRACTION"],
+        run_length=app.config["SCREEN_RUN_LENGTH"],
+        min_seconds_per_trial=app.config["SCREEN_MIN_SECONDS_PER_TRIAL"],
+    )
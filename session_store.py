@@ -0,0 +1,180 @@
+import collections
+import os
+import secrets
+import threading
+import time
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+import db
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+
+class SqliteSessionStore:
+    # Sessions live in a SQLite file shared by every worker on the host. Each
+    # worker keeps a small LRU of decoded sessions in front of it; a cached
+    # entry is only reused while its version still matches the row on disk,
+    # so a request landing on another worker never sees stale data.
+
+    PURGE_EVERY = 500
+
+    def __init__(self, path, ttl, cache_size):
+        self.path = path
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.serializer = TaggedJSONSerializer()
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._saves = 0
+
+        conn = db.connect(self.path)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " sid TEXT PRIMARY KEY,"
+            " data TEXT NOT NULL,"
+            " version TEXT NOT NULL,"
+            " expires REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)")
+
+    def _cache_get(self, sid, now):
+        with self._lock:
+            entry = self._cache.get(sid)
+            if entry is None:
+                return None
+            if entry[2] < now:
+                del self._cache[sid]
+                return None
+            self._cache.move_to_end(sid)
+            return entry
+
+    def _cache_put(self, sid, data, version, expires):
+        with self._lock:
+            self._cache[sid] = (data, version, expires)
+            self._cache.move_to_end(sid)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _cache_drop(self, sid):
+        with self._lock:
+            self._cache.pop(sid, None)
+
+    def load(self, sid):
+        now = time.time()
+        conn = db.connect(self.path)
+        cached = self._cache_get(sid, now)
+
+        if cached is not None:
+            row = conn.execute(
+                "SELECT version FROM sessions WHERE sid = ? AND expires >= ?", (sid, now)
+            ).fetchone()
+            if row is None:
+                self._cache_drop(sid)
+                return None
+            if row[0] == cached[1]:
+                return self.serializer.loads(cached[0])
+
+        row = conn.execute(
+            "SELECT data, version, expires FROM sessions WHERE sid = ? AND expires >= ?",
+            (sid, now),
+        ).fetchone()
+        if row is None:
+            return None
+        self._cache_put(sid, row[0], row[1], row[2])
+        return self.serializer.loads(row[0])
+
+    def save(self, sid, data):
+        payload = self.serializer.dumps(dict(data))
+        version = secrets.token_hex(8)
+        expires = time.time() + self.ttl
+        conn = db.connect(self.path)
+        conn.execute(
+            "INSERT OR REPLACE INTO sessions (sid, data, version, expires) VALUES (?, ?, ?, ?)",
+            (sid, payload, version, expires),
+        )
+        self._cache_put(sid, payload, version, expires)
+
+        self._saves += 1
+        if self._saves % self.PURGE_EVERY == 0:
+            self.purge()
+
+    def delete(self, sid):
+        db.connect(self.path).execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+        self._cache_drop(sid)
+
+    def purge(self):
+        now = time.time()
+        db.connect(self.path).execute("DELETE FROM sessions WHERE expires < ?", (now,))
+        with self._lock:
+            for sid in [sid for sid, entry in self._cache.items() if entry[2] < now]:
+                del self._cache[sid]
+
+
+class ServerSessionInterface(SessionInterface):
+    # The cookie only carries an opaque random session ID; everything else
+    # stays in the store.
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            data = self.store.load(sid)
+            if data is not None:
+                return ServerSession(data, sid=sid)
+        return ServerSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.modified:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if not session.modified:
+            return
+
+        self.store.save(session.sid, session)
+        response.set_cookie(
+            name,
+            session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+
+def init_app(app):
+    backend = app.config["SESSION_BACKEND"]
+    if backend == "cookie":
+        return
+    if backend != "sqlite":
+        raise ValueError(f"Unknown SESSION_BACKEND: {backend!r}")
+
+    path = app.config.get("SESSION_DB") or os.path.join(app.config["STATE_DIR"], "sessions.sqlite3")
+    store = SqliteSessionStore(
+        path,
+        ttl=app.config["SESSION_TTL"],
+        cache_size=app.config["SESSION_CACHE_SIZE"],
+    )
+    app.session_interface = ServerSessionInterface(store)
@@ -0,0 +1,89 @@
+// Client-side trial timings: when a trial was shown, when its first rating
+// was chosen and when it was submitted, measured with performance.now().
+// Records wait in sessionStorage across page loads and go to /beacon in
+// batches with navigator.sendBeacon, which never holds up the page or the
+// rating POST. A page whose script tag has data-flush sends whatever is left.
+(function () {
+    var script = document.currentScript;
+    var url = script.dataset.beaconUrl;
+    var key = "hcai-timing";
+    var batchSize = 8;
+    var current = null;
+
+    function now() {
+        return performance.timeOrigin + performance.now();
+    }
+
+    function tenths(ms) {
+        return ms === null ? null : Math.round(ms * 10) / 10;
+    }
+
+    function pending() {
+        try {
+            return JSON.parse(sessionStorage.getItem(key)) || [];
+        } catch (error) {
+            return [];
+        }
+    }
+
+    function store(records) {
+        try {
+            sessionStorage.setItem(key, JSON.stringify(records));
+        } catch (error) {
+            // Storage full or disabled: timings are best effort.
+        }
+    }
+
+    function flush(force) {
+        var records = pending();
+        if (!records.length || (!force && records.length < batchSize) || !navigator.sendBeacon) {
+            return;
+        }
+        if (navigator.sendBeacon(url, JSON.stringify(records))) {
+            store([]);
+        }
+    }
+
+    function begin(kind, number, stimulusId) {
+        current = {kind: kind, number: number, stimulusId: stimulusId, shown: null, first: null};
+        var trial = current;
+        requestAnimationFrame(function () {
+            trial.shown = now();
+        });
+    }
+
+    function rated() {
+        if (current && current.first === null && current.shown !== null) {
+            current.first = now() - current.shown;
+        }
+    }
+
+    function submitted() {
+        if (!current || current.shown === null) {
+            return;
+        }
+        var records = pending();
+        records.push([
+            current.kind, current.number, current.stimulusId,
+            tenths(current.shown), tenths(current.first), tenths(now() - current.shown)
+        ]);
+        store(records);
+        current = null;
+    }
+
+    window.HCAITiming = {begin: begin, rated: rated, submitted: submitted, flush: flush};
+
+    // Server-rendered trial and practice pages describe themselves on the form.
+    var form = document.querySelector("form[data-timing-kind]");
+    if (form) {
+        begin(form.dataset.timingKind, Number(form.dataset.timingNumber), form.dataset.timingStimulus);
+        form.addEventListener("change", rated);
+        form.addEventListener("submit", submitted);
+    }
+    if ("flush" in script.dataset) {
+        flush(true);
+    }
+    window.addEventListener("pagehide", function () {
+        flush(false);
+    });
+})();
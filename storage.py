@@ -0,0 +1,311 @@
+import csv
+import datetime
+import os
+import threading
+import time
+
+from blinker import Namespace
+
+import db
+
+
+_signals = Namespace()
+
+# Sent by the app after submissions have been written and their logs
+# removed, with ``submissions`` as a list of (ref, participant_id, saved_at,
+# rows, comment) tuples. ``ref`` is what the store returned for the rows.
+responses_saved = _signals.signal("responses-saved")
+
+# A CSV store's files are written under a temporary name and renamed into
+# place, so a file's mtime is from just before it appeared. Files stamped
+# this recently are left out of the cursor in case their rename is still
+# to come.
+CSV_CURSOR_LAG = 1.0
+
+
+FIELDNAMES = [
+    "ParticipantID",
+    "TrialNum",
+    "ErrorType",
+    "ExplanationQuality",
+    "Clarity",
+    "Sufficiency",
+    "PredictiveCapability",
+    "Actionability",
+    "Trustworthiness",
+    "Accountability",
+    "Satisfaction",
+    "ControlVar",
+    # Which scheduler chose the item; empty in files saved before it was
+    # recorded.
+    "Allocator",
+]
+
+# SQLite column for each CSV field, in FIELDNAMES order.
+COLUMNS = [
+    "participant_id",
+    "trial_num",
+    "error_type",
+    "explanation_quality",
+    "clarity",
+    "sufficiency",
+    "predictive_capability",
+    "actionability",
+    "trustworthiness",
+    "accountability",
+    "satisfaction",
+    "control_var",
+    "allocator",
+]
+
+
+def csv_filename(participant_id, saved_at):
+    timestamp = datetime.datetime.fromtimestamp(saved_at).strftime("%Y%m%d_%H%M%S")
+    return f"participant_{participant_id}_{timestamp}.csv"
+
+
+def read_csv(file_path):
+    with open(file_path, newline="", encoding="utf-8") as csvfile:
+        return list(csv.DictReader(csvfile))
+
+
+def temp_path(file_path):
+    # Starts with a dot, so nothing looking for participant_* picks it up.
+    directory, name = os.path.split(file_path)
+    return os.path.join(directory, f".{name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+
+def write_csv(file_path, rows):
+    # Readers see either no file or the whole file.
+    partial_path = temp_path(file_path)
+    with open(partial_path, "w", newline="", encoding="utf-8") as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=FIELDNAMES)
+        writer.writeheader()
+        writer.writerows(rows)
+    os.replace(partial_path, file_path)
+
+
+def replay_since_checkpoint(path, meta_table, store, add, batch_size=500):
+    # Warm start for a table kept beside the response store: passes ``add``
+    # the submissions ``store`` wrote after the checkpoint in
+    # ``meta_table`` of the database at ``path``, in batches, then moves
+    # the checkpoint up to where the store stood when the replay began.
+    # ``add`` must skip submissions it has seen (they arrive live through
+    # responses_saved too) and return how many it took. Returns the total.
+    conn = db.connect(path)
+    row = conn.execute(f"SELECT value FROM {meta_table} WHERE key = 'checkpoint'").fetchone()
+    until = store.cursor()
+    batch = []
+    added = 0
+    for submission in store.iter_submissions(since=row[0] if row else None, until=until):
+        batch.append(submission)
+        if len(batch) >= batch_size:
+            added += add(batch)
+            batch = []
+    if batch:
+        added += add(batch)
+    conn.execute(
+        f"INSERT INTO {meta_table} (key, value) VALUES ('checkpoint', ?)"
+        " ON CONFLICT (key) DO UPDATE SET value = MAX(value, excluded.value)",
+        (until,),
+    )
+    return added
+
+
+class CsvResponseStore:
+    # The original layout: one CSV (plus an optional comment file) per
+    # participant in DATA_DIR.
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+
+    def save(self, participant_id, rows, comment="", saved_at=None):
+        saved_at = time.time() if saved_at is None else saved_at
+        os.makedirs(self.data_dir, exist_ok=True)
+
+        filename = csv_filename(participant_id, saved_at)
+        file_path = os.path.join(self.data_dir, filename)
+
+        # The comment goes first: once the CSV is visible, so is its comment.
+        comment_path = None
+        if comment:
+            comment_path = os.path.join(self.data_dir, filename.replace(".csv", "_comment.txt"))
+            partial_path = temp_path(comment_path)
+            with open(partial_path, "w", encoding="utf-8") as comment_file:
+                comment_file.write(comment)
+            os.replace(partial_path, comment_path)
+
+        write_csv(file_path, rows)
+        return file_path, comment_path
+
+    def save_many(self, submissions):
+        return [self.save(*submission) for submission in submissions]
+
+    def cursor(self):
+        # Files are ordered by when they were written (their mtime).
+        return time.time() - CSV_CURSOR_LAG
+
+    def iter_submissions(self, since=None, until=None):
+        # ``since`` and ``until`` are cursors: submissions written after
+        # one and up to the other.
+        if not os.path.isdir(self.data_dir):
+            return
+        for entry in os.scandir(self.data_dir):
+            if not (entry.name.startswith("participant_") and entry.name.endswith(".csv")):
+                continue
+            saved_at = entry.stat().st_mtime
+            if (since is not None and saved_at <= since) or (until is not None and saved_at > until):
+                continue
+            rows = read_csv(entry.path)
+            if not rows:
+                continue
+            comment = ""
+            comment_path = entry.path.replace(".csv", "_comment.txt")
+            if os.path.exists(comment_path):
+                with open(comment_path, encoding="utf-8") as comment_file:
+                    comment = comment_file.read()
+            yield entry.path, rows[0]["ParticipantID"], saved_at, rows, comment
+
+
+class SqliteResponseStore:
+    # Every participant's rows and comment in one SQLite database (WAL mode),
+    # so a large study is one file rather than tens of thousands. Besides
+    # saved_at (when the participant finished), each submission records
+    # inserted_at, when the store wrote it: strictly increasing in commit
+    # order, since writers are serialised, so it orders cursors exactly
+    # however late a session is saved.
+
+    def __init__(self, path):
+        self.path = path
+        conn = db.connect(self.path)
+        conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS submissions (
+                id INTEGER PRIMARY KEY,
+                participant_id TEXT NOT NULL,
+                saved_at REAL NOT NULL,
+                comment TEXT NOT NULL DEFAULT '',
+                inserted_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS responses (
+                id INTEGER PRIMARY KEY,
+                submission_id INTEGER NOT NULL REFERENCES submissions (id),
+                participant_id TEXT NOT NULL,
+                trial_num INTEGER NOT NULL,
+                error_type TEXT NOT NULL,
+                explanation_quality TEXT NOT NULL,
+                clarity INTEGER NOT NULL,
+                sufficiency INTEGER NOT NULL,
+                predictive_capability INTEGER NOT NULL,
+                actionability INTEGER NOT NULL,
+                trustworthiness INTEGER NOT NULL,
+                accountability INTEGER NOT NULL,
+                satisfaction INTEGER NOT NULL,
+                control_var TEXT NOT NULL DEFAULT '',
+                allocator TEXT NOT NULL DEFAULT ''
+            );
+            CREATE INDEX IF NOT EXISTS submissions_participant ON submissions (participant_id);
+            CREATE INDEX IF NOT EXISTS submissions_saved_at ON submissions (saved_at);
+            CREATE INDEX IF NOT EXISTS responses_submission ON responses (submission_id);
+            CREATE INDEX IF NOT EXISTS responses_participant ON responses (participant_id);
+            CREATE INDEX IF NOT EXISTS responses_error_type ON responses (error_type);
+            CREATE INDEX IF NOT EXISTS responses_explanation_quality ON responses (explanation_quality);
+            """
+        )
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(responses)")}
+        if "allocator" not in columns:
+            conn.execute("ALTER TABLE responses ADD COLUMN allocator TEXT NOT NULL DEFAULT ''")
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(submissions)")}
+        if "inserted_at" not in columns:
+            # Older databases: their submissions count as written at save time.
+            with db.transaction(conn):
+                conn.execute("ALTER TABLE submissions ADD COLUMN inserted_at REAL")
+                conn.execute("UPDATE submissions SET inserted_at = saved_at")
+        conn.execute("CREATE INDEX IF NOT EXISTS submissions_inserted_at ON submissions (inserted_at)")
+
+    def save(self, participant_id, rows, comment="", saved_at=None):
+        return self.save_many([(participant_id, rows, comment, saved_at)])[0]
+
+    def save_many(self, submissions):
+        # All submissions go in one transaction and each one's rows in a
+        # single executemany.
+        insert_rows = "INSERT INTO responses (submission_id, {}) VALUES (?, {})".format(
+            ", ".join(COLUMNS), ", ".join("?" for _ in COLUMNS)
+        )
+        conn = db.connect(self.path)
+        refs = []
+        with db.transaction(conn):
+            (last,) = conn.execute("SELECT MAX(inserted_at) FROM submissions").fetchone()
+            inserted_at = time.time() if last is None else max(time.time(), last + 1e-6)
+            for participant_id, rows, comment, saved_at in submissions:
+                saved_at = inserted_at if saved_at is None else saved_at
+                cursor = conn.execute(
+                    "INSERT INTO submissions (participant_id, saved_at, comment, inserted_at) VALUES (?, ?, ?, ?)",
+                    (participant_id, saved_at, comment or "", inserted_at),
+                )
+                submission_id = cursor.lastrowid
+                conn.executemany(
+                    insert_rows,
+                    [[submission_id] + [row.get(field, "") for field in FIELDNAMES] for row in rows],
+                )
+                ref = f"{self.path}#{submission_id}"
+                refs.append((ref, ref if comment else None))
+        return refs
+
+    def cursor(self):
+        (last,) = db.connect(self.path).execute("SELECT MAX(inserted_at) FROM submissions").fetchone()
+        return 0.0 if last is None else last
+
+    def iter_submissions(self, since=None, until=None):
+        # ``since`` and ``until`` are cursors: submissions inserted after
+        # one and up to the other.
+        conn = db.connect(self.path)
+        # Iterated lazily so an export never holds the whole table.
+        submissions = conn.execute(
+            "SELECT id, participant_id, saved_at, comment FROM submissions"
+            " WHERE inserted_at > ? AND inserted_at <= ? ORDER BY id",
+            (
+                since if since is not None else float("-inf"),
+                until if until is not None else float("inf"),
+            ),
+        )
+        select_rows = "SELECT {} FROM responses WHERE submission_id = ? ORDER BY trial_num".format(
+            ", ".join(COLUMNS)
+        )
+        for submission_id, participant_id, saved_at, comment in submissions:
+            rows = [dict(zip(FIELDNAMES, row)) for row in conn.execute(select_rows, (submission_id,))]
+            yield f"{self.path}#{submission_id}", participant_id, saved_at, rows, comment
+
+    def export_csv(self, csvfile):
+        # One merged CSV with the same columns as the per-participant files.
+        conn = db.connect(self.path)
+        writer = csv.writer(csvfile)
+        writer.writerow(FIELDNAMES)
+        writer.writerows(
+            conn.execute(
+                "SELECT {} FROM responses ORDER BY submission_id, trial_num".format(", ".join(COLUMNS))
+            )
+        )
+
+    def export_files(self, directory):
+        # Recreates the one-file-per-participant layout for scripts that glob
+        # participant_*.csv.
+        os.makedirs(directory, exist_ok=True)
+        csv_store = CsvResponseStore(directory)
+        exported = 0
+        for _, participant_id, saved_at, rows, comment in self.iter_submissions():
+            csv_store.save(participant_id, rows, comment, saved_at)
+            exported += 1
+        return exported
+
+
+def init_app(app):
+    backend = app.config["RESPONSE_STORE"]
+    if backend == "csv":
+        store = CsvResponseStore(app.config["DATA_DIR"])
+    elif backend == "sqlite":
+        path = app.config.get("RESPONSE_DB") or os.path.join(app.config["DATA_DIR"], "responses.sqlite3")
+        store = SqliteResponseStore(path)
+    else:
+        raise ValueError(f"Unknown RESPONSE_STORE: {backend!r}")
+    app.extensions["response_store"] = store
@@ -0,0 +1,145 @@
+import concurrent.futures
+import datetime
+import math
+import os
+import random
+
+from aggregates import DIMENSIONS
+from ratings import RATING_FIELDS
+
+
+# Marks generated rows in the Allocator column; participant IDs carry the
+# same prefix, so synthetic data can always be told apart from real data.
+ALLOCATOR = "synthetic"
+
+# Mean rating shift per ErrorType/ExplanationQuality cell, in scale points
+# around the midpoint: a main effect of explanation quality and a smaller
+# one of error type.
+DEFAULT_EFFECTS = {"FP/Good": 0.8, "FN/Good": 0.5, "FP/Poor": 0.0, "FN/Poor": -0.3}
+MIDPOINT = 4.0
+# Between-participant and trial-level spread, in scale points.
+PARTICIPANT_SD = 0.7
+TRIAL_SD = 0.9
+# Attentive participants spend around this long per trial (log-normal);
+# straight-liners click through in a fraction of it.
+SECONDS_PER_TRIAL = 14.0
+STRAIGHTLINER_SECONDS = 1.5
+
+COMMENTS = [
+    "The explanations were clear and easy to follow.",
+    "Some explanations did not match what I saw in the image.",
+    "I would not trust the system without a doctor checking it.",
+    "The good explanations made me more confident in the AI decision.",
+    "Hard to judge accountability from such short descriptions.",
+    "I found the false negatives more worrying than the false positives.",
+    "Some explanations seemed to focus on irrelevant parts of the image.",
+    "Interesting study, a bit long.",
+]
+
+# Epoch of the first synthetic session unless a start time is given.
+DEFAULT_START = datetime.datetime(2025, 1, 1).timestamp()
+
+
+def parse_effect(value):
+    # "FP/Good=0.8" -> ("FP/Good", 0.8)
+    cell, sep, shift = value.partition("=")
+    if not sep or "/" not in cell:
+        raise ValueError(f"Expected ERRORTYPE/QUALITY=SHIFT, got {value!r}")
+    return cell.strip(), float(shift)
+
+
+def _rating(rng, mean):
+    return min(7, max(1, round(rng.gauss(mean, TRIAL_SD))))
+
+
+def generate_chunk(job):
+    # Generates one chunk of participants in a worker process. Every chunk
+    # has its own seeded random stream, so the output depends only on the
+    # seed and the chunk number, never on the number of workers or the
+    # order chunks finish in. Returns, per completed participant,
+    # (submission, observed trial records, seconds per trial), shaped like
+    # what compact_logs() builds from a response log, plus the dropouts.
+    (seed, number, first, count, trials, per_session, effects, dropout, straightliners, comments, start,
+     interval) = job
+    rng = random.Random(f"{seed}:{number}")
+    results = []
+    dropped = 0
+    for index in range(first, first + count):
+        if rng.random() < dropout:
+            # Left before the debrief: nothing reaches the response store.
+            dropped += 1
+            continue
+        participant_id = f"{ALLOCATOR}-{seed}-{index:08d}"
+        control_var = str(rng.randint(1, 7))
+        straightliner = rng.random() < straightliners
+        offset = rng.gauss(0, PARTICIPANT_SD)
+        fixed = rng.randint(1, 7)
+
+        rows = []
+        observed = []
+        for trial_num, stimulus in enumerate(rng.sample(trials, per_session), start=1):
+            cell = f'{stimulus["error_type"]}/{stimulus["explanation_quality"]}'
+            mean = MIDPOINT + effects.get(cell, 0.0) + offset
+            answers = [fixed if straightliner else _rating(rng, mean) for _ in DIMENSIONS]
+            row = {
+                "ParticipantID": participant_id,
+                "TrialNum": trial_num,
+                "ErrorType": stimulus["error_type"],
+                "ExplanationQuality": stimulus["explanation_quality"],
+                "ControlVar": control_var,
+                "Allocator": ALLOCATOR,
+            }
+            row.update(zip(DIMENSIONS, answers))
+            rows.append(row)
+            record = {"stimulus_id": stimulus["stimulus_id"], "n": trial_num}
+            record.update((field, answer) for (field, _), answer in zip(RATING_FIELDS, answers))
+            observed.append(record)
+
+        if straightliner:
+            seconds = rng.uniform(0.5, 2) * STRAIGHTLINER_SECONDS
+        else:
+            seconds = rng.lognormvariate(math.log(SECONDS_PER_TRIAL), 0.4)
+        comment = rng.choice(COMMENTS) if rng.random() < comments else ""
+        saved_at = start + index * interval + seconds * per_session
+        results.append(((participant_id, rows, comment, saved_at), observed, seconds))
+    return results, dropped
+
+
+def generate(
+    catalog,
+    participants,
+    per_session,
+    seed=0,
+    effects=None,
+    dropout=0.1,
+    straightliners=0.05,
+    comments=0.3,
+    start=DEFAULT_START,
+    interval=30.0,
+    chunk_size=500,
+    workers=None,
+):
+    # Yields (results, dropped) per chunk of ``chunk_size`` participants, in
+    # order. Chunks are generated over a process pool with at most two per
+    # worker in flight, so memory stays bounded however many participants
+    # are asked for.
+    trials = [
+        {key: stimulus[key] for key in ("stimulus_id", "error_type", "explanation_quality")}
+        for stimulus in catalog.trials
+    ]
+    effects = dict(DEFAULT_EFFECTS if effects is None else effects)
+    jobs = (
+        (seed, number, first, min(chunk_size, participants - first), trials, per_session, effects, dropout,
+         straightliners, comments, start, interval)
+        for number, first in enumerate(range(0, participants, chunk_size))
+    )
+    workers = workers or os.cpu_count() or 1
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        window = 2 * workers
+        pending = []
+        for job in jobs:
+            pending.append(executor.submit(generate_chunk, job))
+            if len(pending) >= window:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
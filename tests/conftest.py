@@ -0,0 +1,49 @@
+import os
+import sys
+
+import pytest
+
+# The app's modules sit at the top of the repository rather than in a package.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from catalog import Catalog  # noqa: E402
+
+
+def stimulus(stimulus_id, error_type, quality):
+    return {
+        "stimulus_id": stimulus_id,
+        "description": f"Case {stimulus_id}",
+        "ai_decision": "The AI flags the case.",
+        "ground_truth": "The case was fine.",
+        "error_type": error_type,
+        "explanation_quality": quality,
+        "explanation": "Because of the pattern.",
+    }
+
+
+@pytest.fixture
+def make_catalog():
+    # Catalogs with ``per_cell`` trial stimuli in each ErrorType x
+    # ExplanationQuality cell, named like the real ones (FP_Poor_1, ...).
+    def make(per_cell=8, version="test"):
+        trials = [
+            stimulus(f"{error_type}_{quality}_{number}", error_type, quality)
+            for error_type in ("FN", "FP")
+            for quality in ("Good", "Poor")
+            for number in range(1, per_cell + 1)
+        ]
+        return Catalog(version, [stimulus("practice_1", "FP", "Good")], trials)
+
+    return make
+
+
+@pytest.fixture
+def app(tmp_path):
+    from app import create_app
+
+    return create_app({"TESTING": True, "STATE_DIR": str(tmp_path / "state"), "DATA_DIR": str(tmp_path / "data")})
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
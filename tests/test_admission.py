@@ -0,0 +1,125 @@
+import pytest
+
+import admission
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(admission, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def make_gate(tmp_path, clock):
+    def make(**options):
+        return admission.AdmissionController(str(tmp_path / "admission.sqlite3"), **options)
+
+    return make
+
+
+def test_burst_is_admitted_then_the_rest_queue_in_order(make_gate):
+    gate = make_gate(rate=1.0, burst=2)
+    assert [gate.enqueue()[1] for _ in range(2)] == [0, 0]
+    assert [gate.enqueue()[1] for _ in range(3)] == [1, 2, 3]
+
+
+def test_tokens_refill_at_the_rate(make_gate, clock):
+    gate = make_gate(rate=0.5, burst=1)
+    gate.enqueue()
+    ticket, position = gate.enqueue()
+    assert position == 1
+    clock.now += 1.0
+    assert gate.poll(ticket) == 1
+    clock.now += 1.0
+    assert gate.poll(ticket) == 0
+
+
+def test_bucket_does_not_fill_past_burst(make_gate, clock):
+    gate = make_gate(rate=1.0, burst=2)
+    clock.now += 3600
+    assert [gate.enqueue()[1] for _ in range(4)] == [0, 0, 1, 2]
+
+
+def test_later_ticket_cannot_jump_the_queue(make_gate, clock):
+    gate = make_gate(rate=1.0, burst=1)
+    gate.enqueue()
+    first, _ = gate.enqueue()
+    second, _ = gate.enqueue()
+    clock.now += 1.0
+    # One token: the later ticket asks first but is still second in line.
+    assert gate.poll(second) == 2
+    assert gate.poll(first) == 0
+    assert gate.poll(second) == 1
+    clock.now += 1.0
+    assert gate.poll(second) == 0
+
+
+def test_abandoned_tickets_stop_holding_their_place(make_gate, clock):
+    gate = make_gate(rate=1.0, burst=1)
+    gate.enqueue()
+    gate.enqueue()
+    waiting, position = gate.enqueue()
+    assert position == 2
+    # The waiting ticket keeps polling; the one ahead of it went away.
+    for _ in range(3):
+        clock.now += admission.ABANDON_AFTER / 2
+        gate.poll(waiting)
+    assert gate.poll(waiting) == 0
+
+
+def test_max_active_counts_unreleased_sessions(make_gate):
+    gate = make_gate(max_active=2)
+    first, _ = gate.enqueue()
+    gate.enqueue()
+    waiting, position = gate.enqueue()
+    assert position == 1
+    assert gate.poll(waiting) == 1
+    gate.release(first)
+    assert gate.poll(waiting) == 0
+
+
+def test_timed_out_sessions_free_their_slot(make_gate, clock):
+    gate = make_gate(max_active=1, session_timeout=600)
+    gate.enqueue()
+    waiting, _ = gate.enqueue()
+    clock.now += 300
+    assert gate.poll(waiting) == 1
+    clock.now += 301
+    assert gate.poll(waiting) == 0
+
+
+def test_unknown_ticket(make_gate):
+    assert make_gate(max_active=1).poll(12345) is None
+
+
+def test_waiting_room_admits_after_a_session_finishes(tmp_path):
+    from app import create_app
+
+    app = create_app(
+        {
+            "TESTING": True,
+            "STATE_DIR": str(tmp_path / "state"),
+            "DATA_DIR": str(tmp_path / "data"),
+            "ADMISSION_MAX_ACTIVE": 1,
+        }
+    )
+    first, second = app.test_client(), app.test_client()
+
+    response = first.post("/", data={"consent": "yes", "participant_id": "first", "control_var": "4"})
+    assert response.headers["Location"].endswith("/practice")
+    response = second.post("/", data={"consent": "yes", "participant_id": "second", "control_var": "4"})
+    assert response.headers["Location"].endswith("/waiting")
+    assert second.get("/waiting/status").get_json() == {"position": 1, "ready": False}
+
+    first.post("/debrief", data={"comment": ""})
+    assert second.get("/waiting/status").get_json() == {"position": 0, "ready": True}
+    assert second.get("/waiting").headers["Location"].endswith("/practice")
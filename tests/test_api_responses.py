@@ -0,0 +1,108 @@
+import json
+
+import pytest
+
+
+RATINGS = {
+    "clarity": 5,
+    "sufficiency": 4,
+    "predictive_capability": 3,
+    "actionability": 5,
+    "trustworthiness": 6,
+    "accountability": 2,
+    "satisfaction": 7,
+}
+
+
+@pytest.fixture
+def started(client):
+    response = client.post("/", data={"consent": "yes", "participant_id": "api-test", "control_var": "4"})
+    assert response.status_code == 302
+    return client
+
+
+def trials(client, count=16):
+    return client.get(f"/api/trials?count={count}").get_json()["trials"]
+
+
+def responses(items):
+    return {
+        "responses": [
+            {"number": item["number"], "stimulus_id": item["stimulus_id"], "ratings": dict(RATINGS)} for item in items
+        ]
+    }
+
+
+def logged_trials(app, client):
+    # Raw trial lines, before read() folds repeats together.
+    with client.session_transaction() as session:
+        log_id = session["log_id"]
+    path = app.extensions["response_log"]._path(log_id)
+    with open(path, encoding="utf-8") as log_file:
+        return [record["n"] for record in map(json.loads, log_file) if record["k"] == "trial"]
+
+
+def test_requires_a_session(client):
+    response = client.post("/api/responses", json={"responses": []})
+    assert response.status_code == 401
+
+
+def test_rejects_a_malformed_body(started):
+    response = started.post("/api/responses", json=[1, 2])
+    assert response.status_code == 400
+    assert "responses" in response.get_json()["error"]
+
+
+def test_saves_a_batch(app, started):
+    batch = trials(started, 4)
+    response = started.post("/api/responses", json=responses(batch))
+    assert response.status_code == 200
+    assert response.get_json()["current_trial"] == 4
+    assert logged_trials(app, started) == [1, 2, 3, 4]
+    assert trials(started, 1)[0]["number"] == 5
+
+
+def test_retried_batch_is_not_stored_twice(app, started):
+    body = responses(trials(started, 4))
+    first = started.post("/api/responses", json=body)
+    retry = started.post("/api/responses", json=body)
+    assert retry.status_code == 200
+    assert retry.get_json() == first.get_json()
+    assert logged_trials(app, started) == [1, 2, 3, 4]
+
+
+def test_retry_overlapping_new_trials_stores_only_the_new_ones(app, started):
+    batch = trials(started, 6)
+    started.post("/api/responses", json=responses(batch[:4]))
+    response = started.post("/api/responses", json=responses(batch))
+    assert response.get_json()["current_trial"] == 6
+    assert logged_trials(app, started) == [1, 2, 3, 4, 5, 6]
+
+
+@pytest.mark.parametrize(
+    "spoil",
+    [
+        lambda body: body["responses"][2]["ratings"].update(clarity=9),
+        lambda body: body["responses"][1]["ratings"].pop("satisfaction"),
+        lambda body: body["responses"][2].update(stimulus_id="not-shown"),
+        lambda body: body["responses"][3].update(number=99),
+        lambda body: body["responses"].pop(1),
+        lambda body: body["responses"].append("not an object"),
+    ],
+    ids=["out-of-scale", "missing-rating", "wrong-stimulus", "out-of-range", "gap", "not-an-object"],
+)
+def test_one_bad_response_rejects_the_whole_batch(app, started, spoil):
+    body = responses(trials(started, 4))
+    spoil(body)
+    response = started.post("/api/responses", json=body)
+    assert response.status_code == 400
+    assert response.get_json()["details"]
+    assert logged_trials(app, started) == []
+    assert trials(started, 1)[0]["number"] == 1
+
+
+def test_last_batch_reports_done(started):
+    response = started.post("/api/responses", json=responses(trials(started)))
+    body = response.get_json()
+    assert body["done"] is True
+    assert body["current_trial"] == body["total"] == 16
@@ -0,0 +1,168 @@
+import collections
+import time
+
+import pytest
+
+import db
+import scheduler
+
+
+def follows(rows):
+    # How often each ordered pair of slots appears side by side.
+    return collections.Counter(pair for row in rows for pair in zip(row, row[1:]))
+
+
+@pytest.mark.parametrize("n", [2, 4, 6, 16])
+def test_williams_square_even(n):
+    rows = scheduler.williams_square(n)
+    assert len(rows) == n
+    for line in rows + [list(column) for column in zip(*rows)]:
+        assert sorted(line) == list(range(n))
+    pairs = follows(rows)
+    assert len(pairs) == n * (n - 1)
+    assert set(pairs.values()) == {1}
+
+
+@pytest.mark.parametrize("n", [3, 5, 7])
+def test_williams_square_odd_needs_both_halves(n):
+    rows = scheduler.williams_square(n)
+    assert len(rows) == 2 * n
+    for column in zip(*rows):
+        assert set(collections.Counter(column).values()) == {2}
+    pairs = follows(rows)
+    assert len(pairs) == n * (n - 1)
+    assert set(pairs.values()) == {2}
+
+
+def test_balanced_table_rows_draw_evenly_from_cells(make_catalog):
+    catalog = make_catalog(per_cell=8)
+    table = scheduler.BalancedTable(catalog, 16)
+    cell_of = {stimulus["stimulus_id"]: cell for cell, stimuli in catalog.by_cell.items() for stimulus in stimuli}
+    for number in range(table.period):
+        row = table.row(number)
+        assert len(set(row)) == 16
+        assert set(collections.Counter(cell_of[item] for item in row).values()) == {4}
+
+
+def test_balanced_table_exposure_is_even_over_a_period(make_catalog):
+    catalog = make_catalog(per_cell=6)
+    table = scheduler.BalancedTable(catalog, 16)
+    shown = collections.Counter(item for number in range(table.period) for item in table.row(number))
+    assert set(shown) == {stimulus["stimulus_id"] for stimulus in catalog.trials}
+    assert len(set(shown.values())) == 1
+    assert table.exposure(table.period) == dict(shown)
+
+
+@pytest.mark.parametrize("rows", [0, 1, 5, 17])
+def test_balanced_table_exposure_matches_rows(make_catalog, rows):
+    table = scheduler.BalancedTable(make_catalog(per_cell=6), 16)
+    shown = collections.Counter(item for number in range(rows) for item in table.row(number))
+    assert {item: count for item, count in table.exposure(rows).items() if count} == dict(shown)
+
+
+def test_balanced_table_uneven_pool_falls_back(make_catalog):
+    # 14 slots do not split evenly over four cells.
+    table = scheduler.BalancedTable(make_catalog(per_cell=8), 14)
+    assert len(table.cells) == 1
+    assert all(len(set(table.row(number))) == 14 for number in range(table.period))
+
+
+def test_sequence_counter_blocks_do_not_overlap(tmp_path):
+    path = str(tmp_path / "scheduler.sqlite3")
+    first = scheduler.SequenceCounter(path, "assignments", block_size=4)
+    second = scheduler.SequenceCounter(path, "assignments", block_size=4)
+    issued = [counter.next() for _ in range(6) for counter in (first, second)]
+    assert sorted(issued) == sorted(set(issued))
+    assert first.issued() == 16
+
+
+class Catalogs:
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+    def current(self):
+        return self.catalog
+
+
+def adaptive(tmp_path, catalog, assigned=(), time_budget=1.0, refresh_interval=60.0):
+    # ``assigned``: (stimulus_id, count) already recorded by other sessions.
+    path = str(tmp_path / "scheduler.sqlite3")
+    stats = scheduler.StimulusStats(path, refresh_interval=refresh_interval)
+    db.connect(path).executemany("INSERT INTO stimulus_stats (stimulus_id, assigned) VALUES (?, ?)", assigned)
+    return scheduler.AdaptiveScheduler(Catalogs(catalog), 16, stats, time_budget=time_budget)
+
+
+def cell_counts(catalog, picks):
+    return collections.Counter(
+        f'{catalog.by_id[item]["error_type"]}/{catalog.by_id[item]["explanation_quality"]}' for item in picks
+    )
+
+
+def test_gain_falls_as_ratings_accumulate():
+    variance = scheduler.shrunk_variance(0, 0.0, 0.0)
+    assert variance == scheduler.PRIOR_VARIANCE
+    gains = [scheduler.variance_reduction(variance, count) for count in range(5)]
+    assert gains == sorted(gains, reverse=True)
+    # A noisier item gains more from the same number of ratings.
+    noisy = scheduler.shrunk_variance(4, 4 * 4.0, 4 * 16.0 + 24.0)
+    steady = scheduler.shrunk_variance(4, 4 * 4.0, 4 * 16.0)
+    assert scheduler.variance_reduction(noisy, 4) > scheduler.variance_reduction(steady, 4)
+
+
+def test_adaptive_spreads_an_empty_pool_over_all_cells(tmp_path, make_catalog):
+    catalog = make_catalog()
+    order, allocators = adaptive(tmp_path, catalog).next_assignment(catalog)
+    assert len(set(order)) == 16
+    assert set(allocators) == {"adaptive"}
+    assert set(cell_counts(catalog, order).values()) == {4}
+
+
+def test_adaptive_fills_thin_cells_first(tmp_path, make_catalog):
+    catalog = make_catalog()
+    assigned = [(f"FP_Poor_{number}", 50) for number in range(1, 9)]
+    order, _ = adaptive(tmp_path, catalog, assigned).next_assignment(catalog)
+    assert "FP/Poor" not in cell_counts(catalog, order)
+
+
+def test_adaptive_prefers_less_shown_items_within_a_cell(tmp_path, make_catalog):
+    catalog = make_catalog()
+    cells = ("FN_Good", "FN_Poor", "FP_Good", "FP_Poor")
+    assigned = [(f"{cell}_{number}", 10) for cell in cells for number in (1, 2, 3, 4)]
+    order, _ = adaptive(tmp_path, catalog, assigned).next_assignment(catalog)
+    assert sorted(int(item.rsplit("_", 1)[1]) for item in order) == sorted([5, 6, 7, 8] * 4)
+
+
+def test_adaptive_sessions_rotate_through_the_pool(tmp_path, make_catalog):
+    catalog = make_catalog()
+    scheduler_ = adaptive(tmp_path, catalog)
+    first, _ = scheduler_.next_assignment(catalog)
+    second, _ = scheduler_.next_assignment(catalog)
+    assert not set(first) & set(second)
+
+
+def test_adaptive_falls_back_to_random_past_the_budget(tmp_path, make_catalog):
+    catalog = make_catalog()
+    order, allocators = adaptive(tmp_path, catalog, time_budget=0.0).next_assignment(catalog)
+    assert len(set(order)) == 16
+    assert set(allocators) == {"random"}
+
+
+def test_stale_statistics_are_served_while_they_refresh(tmp_path, make_catalog):
+    catalog = make_catalog()
+    scheduler_ = adaptive(tmp_path, catalog, refresh_interval=0.0)
+    stats = scheduler_.stats
+    scheduler_.next_assignment(catalog)
+    loaded = stats.current()
+    # Another worker's ratings arrive only through the database.
+    other = scheduler.StimulusStats(stats.path)
+    other.add_scores([("FN_Good_1", 6.0)])
+
+    deadline = time.monotonic() + 5
+    while stats.current() is loaded and time.monotonic() < deadline:
+        time.sleep(0.01)
+    refreshed = stats.current()
+    assert refreshed is not loaded
+    assert refreshed["FN_Good_1"][1:] == [1, 6.0, 36.0]
+    # Every assignment made so far is counted exactly once.
+    assert sum(entry[0] for entry in refreshed.values()) == 16
+    assert scheduler_._cells_version == catalog.version
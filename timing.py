@@ -0,0 +1,281 @@
+import atexit
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+from flask import after_this_request, current_app, request
+from itsdangerous import BadSignature, Signer
+from werkzeug.http import parse_cookie
+
+import db
+
+
+logger = logging.getLogger(__name__)
+
+COOKIE_NAME = "hcai_timing"
+BEACON_PATH = "/beacon"
+KINDS = ("practice", "trial")
+# Larger beacons are refused outright.
+MAX_BODY = 16 * 1024
+MAX_EVENTS = 64
+
+# Columns added to exported trial rows by the join, in this order.
+FIELDS = ["ShownAt", "FirstRatingMs", "SubmitMs"]
+
+
+def _number(value):
+    # Exact type check: it is the hot path, and it keeps out booleans.
+    return value if type(value) in (int, float) and math.isfinite(value) else None
+
+
+def clean_events(events):
+    # Keeps well-formed [kind, n, stimulus_id, shown_at, first_ms, submit_ms]
+    # entries: shown_at in epoch milliseconds, the others in milliseconds
+    # after it. Anything else is dropped rather than rejected.
+    cleaned = []
+    if not isinstance(events, list):
+        return cleaned
+    for event in events[:MAX_EVENTS]:
+        if not isinstance(event, list) or len(event) != 6:
+            continue
+        kind, number, stimulus_id, shown_at, first_ms, submit_ms = event
+        if kind not in KINDS or type(number) is not int or not 0 < number < 1000:
+            continue
+        if type(stimulus_id) is not str or len(stimulus_id) > 64:
+            continue
+        cleaned.append([kind, number, stimulus_id, _number(shown_at), _number(first_ms), _number(submit_ms)])
+    return cleaned
+
+
+class TimingLog:
+    # Per-process append-only file of beacon batches, one JSON line per
+    # beacon, written through a large userspace buffer and flushed at most
+    # every ``flush_interval`` seconds (and at exit). Nothing here takes a
+    # lock shared with other workers or touches SQLite; "flask join-timings"
+    # folds the files into the timing store later.
+
+    def __init__(self, directory, flush_interval=1.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._file = None
+        self._pid = None
+        self._flushed_at = time.monotonic()
+        os.makedirs(self.directory, exist_ok=True)
+        atexit.register(self.flush)
+
+    def _open(self):
+        # Each worker appends to its own file; a forked worker opens a new one
+        # rather than sharing its parent's buffer.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            path = os.path.join(self.directory, f"timing-{self._pid}.jsonl")
+            self._file = open(path, "a", encoding="utf-8", buffering=256 * 1024)
+        return self._file
+
+    def write(self, participant_id, events):
+        line = json.dumps([participant_id, round(time.time(), 3), events], separators=(",", ":")) + "\n"
+        with self._lock:
+            self._open().write(line)
+        self.maybe_flush()
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None and self._pid == os.getpid():
+                self._file.flush()
+        self._flushed_at = time.monotonic()
+
+    def maybe_flush(self):
+        if time.monotonic() - self._flushed_at >= self.flush_interval:
+            try:
+                self.flush()
+            except OSError:
+                logger.exception("Writing client timings failed")
+
+
+class BeaconMiddleware:
+    # Answers POST /beacon in front of Flask: no request context, session,
+    # before/after-request hooks or database, just the signed cookie, a JSON
+    # body and one buffered write. Every other request passes straight
+    # through (and gives an idle worker the chance to flush its buffer).
+
+    def __init__(self, wsgi_app, log, signer, metrics=None):
+        self.wsgi_app = wsgi_app
+        self.log = log
+        self.signer = signer
+        self.metrics = metrics
+
+    def __call__(self, environ, start_response):
+        if environ.get("PATH_INFO") != BEACON_PATH:
+            self.log.maybe_flush()
+            return self.wsgi_app(environ, start_response)
+        status = self.ingest(environ)
+        start_response(status, [("Content-Length", "0"), ("Cache-Control", "no-store")])
+        return [b""]
+
+    def ingest(self, environ):
+        if environ.get("REQUEST_METHOD") != "POST":
+            return "405 Method Not Allowed"
+        try:
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            return "400 Bad Request"
+        if not 0 < length <= MAX_BODY:
+            return "413 Request Entity Too Large" if length else "400 Bad Request"
+        token = parse_cookie(environ).get(COOKIE_NAME)
+        if not token:
+            return "403 Forbidden"
+        try:
+            participant_id = self.signer.unsign(token).decode("utf-8")
+        except BadSignature:
+            return "403 Forbidden"
+        try:
+            events = clean_events(json.loads(environ["wsgi.input"].read(length)))
+        except ValueError:
+            return "400 Bad Request"
+        if events:
+            self.log.write(participant_id, events)
+            if self.metrics is not None:
+                self.metrics.inc("hcai_timing_events_total", len(events))
+        return "204 No Content"
+
+
+class TimingStore:
+    # Client timings per participant, trial kind and number, folded in from
+    # the per-worker beacon files. How far each file has been read is kept
+    # beside the data, so a join only reads what was appended since the last
+    # one. A trial page shown twice (e.g. after a validation error) keeps
+    # the timings joined last.
+
+    def __init__(self, path):
+        self.path = path
+        conn = db.connect(self.path)
+        conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS trial_timings (
+                participant_id TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                n INTEGER NOT NULL,
+                stimulus_id TEXT NOT NULL,
+                shown_at REAL,
+                first_rating_ms REAL,
+                submit_ms REAL,
+                received_at REAL NOT NULL,
+                PRIMARY KEY (participant_id, kind, n)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS timing_offsets (
+                name TEXT PRIMARY KEY,
+                offset INTEGER NOT NULL
+            );
+            """
+        )
+
+    def join(self, directory):
+        # Returns how many timing records were written.
+        if not os.path.isdir(directory):
+            return 0
+        conn = db.connect(self.path)
+        offsets = dict(conn.execute("SELECT name, offset FROM timing_offsets"))
+        joined = 0
+        for entry in os.scandir(directory):
+            if not (entry.name.startswith("timing-") and entry.name.endswith(".jsonl")):
+                continue
+            offset = offsets.get(entry.name, 0)
+            if entry.stat().st_size <= offset:
+                continue
+            with open(entry.path, "rb") as log_file:
+                log_file.seek(offset)
+                data = log_file.read()
+            # A worker may be half-way through a line; it is read next time.
+            end = data.rfind(b"\n") + 1
+            records = []
+            for line in data[:end].splitlines():
+                try:
+                    participant_id, received_at, events = json.loads(line)
+                except ValueError:
+                    continue
+                records.extend([participant_id, *event, received_at] for event in events)
+            with db.transaction(conn):
+                conn.executemany(
+                    "INSERT INTO trial_timings (participant_id, kind, n, stimulus_id, shown_at, first_rating_ms,"
+                    " submit_ms, received_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+                    " ON CONFLICT (participant_id, kind, n) DO UPDATE SET stimulus_id = excluded.stimulus_id,"
+                    " shown_at = excluded.shown_at, first_rating_ms = excluded.first_rating_ms,"
+                    " submit_ms = excluded.submit_ms, received_at = excluded.received_at",
+                    records,
+                )
+                conn.execute(
+                    "INSERT INTO timing_offsets (name, offset) VALUES (?, ?)"
+                    " ON CONFLICT (name) DO UPDATE SET offset = excluded.offset",
+                    (entry.name, offset + end),
+                )
+            joined += len(records)
+        return joined
+
+    def for_participant(self, participant_id, kind="trial"):
+        # Trial number -> (stimulus_id, shown_at, first_rating_ms, submit_ms).
+        rows = db.connect(self.path).execute(
+            "SELECT n, stimulus_id, shown_at, first_rating_ms, submit_ms FROM trial_timings"
+            " WHERE participant_id = ? AND kind = ?",
+            (participant_id, kind),
+        )
+        return {n: rest for n, *rest in rows}
+
+    def attach(self, participant_id, rows):
+        # The FIELDS columns for each saved trial row, blank where no beacon
+        # arrived.
+        timings = self.for_participant(participant_id)
+        columns = []
+        for row in rows:
+            _, *values = timings.get(int(row["TrialNum"]), (None, None, None, None))
+            columns.append(["" if value is None else value for value in values])
+        return columns
+
+
+def signer(secret_key):
+    # The beacon cookie carries the participant ID, signed so a beacon
+    # cannot be filed under somebody else.
+    return Signer(secret_key, salt="hcai-timing")
+
+
+def issue_cookie(participant_id):
+    # Called when a session starts or resumes. The cookie is only ever sent
+    # to the beacon path, so it costs nothing on other requests.
+    config = current_app.config
+    if not config["CLIENT_TIMING"]:
+        return
+    token = signer(config["SECRET_KEY"]).sign(participant_id).decode("utf-8")
+
+    @after_this_request
+    def set_cookie(response):
+        response.set_cookie(
+            COOKIE_NAME,
+            token,
+            path=request.script_root + BEACON_PATH,
+            httponly=True,
+            secure=config["SESSION_COOKIE_SECURE"],
+            samesite="Lax",
+        )
+        return response
+
+
+def beacon_url():
+    return request.script_root + BEACON_PATH
+
+
+def init_app(app):
+    directory = app.config.get("TIMING_DIR") or os.path.join(app.config["STATE_DIR"], "timing")
+    log = TimingLog(directory, flush_interval=app.config["TIMING_FLUSH_INTERVAL"])
+    path = app.config.get("TIMING_DB") or os.path.join(app.config["STATE_DIR"], "timing.sqlite3")
+    app.extensions["timing"] = TimingStore(path)
+    app.extensions["timing_log"] = log
+    app.add_template_global(beacon_url, "beacon_url")
+    if app.config["CLIENT_TIMING"]:
+        beacon = BeaconMiddleware(
+            app.wsgi_app, log, signer(app.config["SECRET_KEY"]), metrics=app.extensions.get("metrics")
+        )
+        app.extensions["beacon"] = beacon
+        app.wsgi_app = beacon
@@ -0,0 +1,78 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class BackgroundWriter:
+    # A bounded queue drained by one thread per process. The thread hands
+    # jobs to ``handler`` in batches of up to ``batch_size``. ``submit``
+    # returns False when the queue stays full for ``put_timeout`` seconds, and
+    # the caller is expected to do the work itself: that is the backpressure.
+
+    def __init__(self, handler, maxsize=1000, batch_size=50, put_timeout=0.05):
+        self.handler = handler
+        self.batch_size = batch_size
+        self.put_timeout = put_timeout
+        self.queue = queue.Queue(maxsize)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def _ensure_started(self):
+        # Threads do not survive a fork, so each gunicorn worker starts its
+        # own writer on first use.
+        if self._pid == os.getpid() and self._thread is not None:
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None:
+                return
+            self._pid = os.getpid()
+            self.queue = queue.Queue(self.queue.maxsize)
+            self._thread = threading.Thread(target=self._run, name="response-writer", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def submit(self, job):
+        self._ensure_started()
+        try:
+            self.queue.put(job, timeout=self.put_timeout)
+        except queue.Full:
+            return False
+        return True
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            job = self.queue.get()
+            if job is _STOP:
+                break
+            batch = [job]
+            while len(batch) < self.batch_size:
+                try:
+                    job = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is _STOP:
+                    stopping = True
+                    break
+                batch.append(job)
+            try:
+                self.handler(batch)
+            except Exception:
+                logger.exception("Background write of %d job(s) failed", len(batch))
+
+    def close(self, timeout=30):
+        # Called at interpreter exit (gunicorn's graceful shutdown included):
+        # everything already queued is written before the process goes away.
+        thread = self._thread
+        if thread is None or self._pid != os.getpid() or not thread.is_alive():
+            return
+        self.queue.put(_STOP)
+        thread.join(timeout)